@@ -16,10 +16,11 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     PreCheckoutQueryHandler,
+    TypeHandler,
     filters
 )
 
-from config import BOT_TOKEN
+from config import BOT_TOKEN, ADMIN_OPERATOR_ID
 from keyboards import (
     get_main_menu_keyboard, get_language_selection_keyboard,
     get_tools_menu_keyboard, get_generators_menu_keyboard, get_settings_menu_keyboard,
@@ -27,10 +28,13 @@ from keyboards import (
     get_exif_menu_keyboard, get_selfie_menu_keyboard,
     get_gplay_menu_keyboard, get_address_menu_keyboard, get_card_menu_keyboard,
     get_antidetect_menu_keyboard, get_subscription_menu_keyboard, get_language_keyboard,
-    get_tiktok_menu_keyboard, get_cancel_keyboard
+    get_tiktok_menu_keyboard, get_cancel_keyboard, get_subscription_buy_keyboard,
+    get_variation_count_keyboard, get_admin_panel_keyboard, get_admin_vip_keyboard,
+    get_admin_ban_keyboard, get_admin_maintenance_keyboard, get_admin_antiflood_keyboard,
+    get_admin_back_keyboard
 )
 from utils.localization import (
-    is_new_user, set_user_language, get_user_language, t
+    is_new_user, set_user_language, get_user_language, compile_locales, t
 )
 from utils.subscription import get_user_subscription, SUBSCRIPTION_PLANS
 from utils.performance import (
@@ -38,13 +42,28 @@ from utils.performance import (
     cache, performance_monitor, rate_limit
 )
 from utils.security import (
-    security_check, anti_flood, anti_spam, input_validator,
+    anti_spam, input_validator,
     security_logger, bot_detector, validate_url_input,
-    sanitize_user_input, get_security_stats
+    sanitize_user_input, get_security_stats,
+    set_antiflood_limit, set_antiflood_ban_duration, reset_all_flood_bans,
+    enable_antiflood, disable_antiflood
 )
+from utils.admission import admission, admission_middleware
+from utils import json_store
+from utils.admin_utils import (
+    is_maintenance_mode, set_maintenance_mode, get_all_users, get_bot_stats, get_banned_list
+)
+from utils.whitelist import get_vip_list, get_vip_count
 from utils.subscription_manager import SubscriptionManager
 from utils.rate_limiter import RateLimiter, rate_limit as rate_limit_decorator
 from utils.error_monitor import ErrorMonitor, handle_errors
+from utils.database import get_db, get_async_db
+from utils.callback_router import CallbackRouter
+from handlers.generator_handler import (
+    subscription_callback, address_callback, card_callback, antidetect_callback
+)
+from handlers.mimesis_handler import mimesis_callback
+from handlers.misc_handler import selfie_callback
 
 # Настройка логирования
 logging.basicConfig(
@@ -54,20 +73,17 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-@security_check
 async def start(update: Update, context):
     """Обработчик команды /start"""
-    from utils.admin_utils import is_banned, is_maintenance_mode, get_maintenance_message, register_user
-    from utils.whitelist import is_admin
+    from utils.admin_utils import register_user
     
     user = update.effective_user
     user_id = user.id
     
-    # Регистрируем пользователя
+    # Регистрируем пользователя (отложенная запись в БД, вместе с активностью)
     register_user(user_id, user.username, user.first_name)
     
     # ПРЕЖДЕ ВСЕГО проверяем админ-оператора - показываем админ-панель
-    ADMIN_OPERATOR_ID = int(os.getenv("ADMIN_OPERATOR_ID", "0"))
     if user_id == ADMIN_OPERATOR_ID:
         from keyboards import get_admin_panel_keyboard
         from utils.admin_utils import is_maintenance_mode
@@ -83,22 +99,7 @@ async def start(update: Update, context):
         )
         return
     
-    # Проверяем бан (админы не банятся)
-    if is_banned(user_id) and not is_admin(user_id):
-        await update.message.reply_text(
-            "🚫 **Вы заблокированы**\n\n"
-            "Доступ к боту ограничен.",
-            parse_mode="Markdown"
-        )
-        return
-    
-    # Проверяем режим обслуживания (админы могут работать)
-    if is_maintenance_mode() and not is_admin(user_id):
-        await update.message.reply_text(
-            get_maintenance_message(),
-            parse_mode="Markdown"
-        )
-        return
+    # Бан и тех. работы уже проверены admission_middleware
     
     # Проверяем, новый ли пользователь
     if is_new_user(user_id):
@@ -155,964 +156,1073 @@ async def safe_edit_text(query, text, reply_markup=None, parse_mode=None):
             # НЕ отправляем новое сообщение - это создаёт дубликаты
 
 
-async def main_callback_handler(update: Update, context):
-    """Единый обработчик всех callback кнопок"""
+def format_db_stats(top: int = 5) -> str:
+    """Очередь и задержки запросов к БД для админской статистики"""
+    db_stats = get_async_db().get_stats()
+    text = (
+        f"\n🗄 **База данных:**\n"
+        f"Очередь: {db_stats['queue_depth']} (макс. {db_stats['max_queue_depth']}), "
+        f"объединено запросов: {db_stats['coalesced']}\n"
+    )
+    wb = get_db().write_buffer.get_stats()
+    text += (
+        f"Отложенная запись: в буфере {wb['pending']}, записано {wb['rows']} "
+        f"за {wb['flushes']} сбросов, {wb['rows_per_sec']} строк/с\n"
+    )
+    queries = sorted(db_stats['queries'].items(), key=lambda x: x[1]['count'], reverse=True)
+    for name, q in queries[:top]:
+        text += f"• `{name}`: {q['count']} шт, ср. {q['avg_ms']} мс, макс. {q['max_ms']} мс\n"
+    return text
+
+
+def format_admission_stats() -> str:
+    """Счётчики конвейера допуска для админской статистики"""
+    stats = admission.get_stats()
+    rejected = ", ".join(f"{k}: {v}" for k, v in stats['rejected'].items()) or "нет"
+    return (
+        f"\n🛡 **Допуск:** {stats['checks']} проверок, ср. {stats['avg_us']} мкс, "
+        f"отклонено — {rejected}\n"
+    )
+
+
+def format_perf_stats(top: int = 5) -> str:
+    """Задержки хендлеров (p50/p95/p99) и загрузка пулов потоков для админской статистики"""
+    stats = performance_monitor.get_stats()
+    text = (
+        f"\n⏱ **Хендлеры:** {stats['total_requests']} апдейтов, ошибок {stats['error_rate']}, "
+        f"p50 {stats['p50_response_ms']} / p95 {stats['p95_response_ms']} / "
+        f"p99 {stats['p99_response_ms']} мс\n"
+    )
+    for h in performance_monitor.get_handler_stats(top):
+        text += f"• `{h['handler']}`: {h['count']} шт, p50 {h['p50_ms']} / p95 {h['p95_ms']} / p99 {h['p99_ms']} мс\n"
+    for name, ex in performance_monitor.get_executor_stats().items():
+        text += (
+            f"• пул `{name}`: занято {ex['busy']}/{ex['workers']}, в очереди {ex['queued']}, "
+            f"ожидание p95 {ex['wait_p95_ms']} мс\n"
+        )
+    return text
+
+
+# Маршруты callback кнопок: точные значения — словарь, префиксы — префиксное дерево;
+# время обработки каждого маршрута пишется в гистограмму (/metrics)
+callback_router = CallbackRouter(latency=performance_monitor.callback_latency)
+
+
+# === Первый выбор языка ===
+@callback_router.prefix("set_lang_")
+async def cb_set_lang(update: Update, context):
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
     data = query.data
+    lang_code = data.replace("set_lang_", "")
+    set_user_language(user_id, lang_code)
     
-    # Проверка безопасности - антифлуд
-    allowed, ban_time = anti_flood.check(user_id)
-    if not allowed:
-        try:
-            await query.message.reply_text(
-                f"⚠️ Слишком много запросов! Подождите {ban_time} секунд."
-            )
-        except:
-            pass
-        return
-    
-    # Записываем действие для детектора ботов
-    bot_detector.record_action(user_id, f"callback_{data[:20]}")
-    
-    # === Первый выбор языка ===
-    if data.startswith("set_lang_"):
-        lang_code = data.replace("set_lang_", "")
-        set_user_language(user_id, lang_code)
-        
-        await safe_edit_text(query, 
-            t("welcome", user_id),
-            reply_markup=get_main_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === АДМИН-ПАНЕЛЬ ===
-    ADMIN_OPERATOR_ID = int(os.getenv("ADMIN_OPERATOR_ID", "0"))
-    
-    if data == "admin_back":
-        from keyboards import get_admin_panel_keyboard
-        from utils.admin_utils import is_maintenance_mode
-        status = "✅ Включён" if not is_maintenance_mode() else "🔧 Тех. работы"
-        await safe_edit_text(query, 
-            f"🔐 **Админ-панель**\n\n"
-            f"🤖 Статус бота: {status}\n\n"
-            f"Выберите действие:",
-            reply_markup=get_admin_panel_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    await safe_edit_text(query, 
+        t("welcome", user_id),
+        reply_markup=get_main_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === АДМИН-ПАНЕЛЬ ===
+@callback_router.exact("admin_back")
+async def cb_admin_back(update: Update, context):
+    query = update.callback_query
+    status = "✅ Включён" if not is_maintenance_mode() else "🔧 Тех. работы"
+    await safe_edit_text(query, 
+        f"🔐 **Админ-панель**\n\n"
+        f"🤖 Статус бота: {status}\n\n"
+        f"Выберите действие:",
+        reply_markup=get_admin_panel_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_vip")
+async def cb_admin_vip(update: Update, context):
+    query = update.callback_query
+    await safe_edit_text(query, 
+        "👑 **VIP управление**\n\n"
+        "Выберите действие:",
+        reply_markup=get_admin_vip_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_vip_add")
+async def cb_admin_vip_add(update: Update, context):
+    query = update.callback_query
+    context.user_data['waiting_for'] = 'admin_vip_add'
+    await safe_edit_text(query, 
+        "➕ **Добавить VIP**\n\n"
+        "Отправьте ID пользователя:\n"
+        "Формат: `ID` или `ID примечание`\n\n"
+        "Пример: `123456789 Друг`",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_vip_remove")
+async def cb_admin_vip_remove(update: Update, context):
+    query = update.callback_query
+    context.user_data['waiting_for'] = 'admin_vip_remove'
+    await safe_edit_text(query, 
+        "➖ **Удалить VIP**\n\n"
+        "Отправьте ID пользователя:",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_vip_list")
+async def cb_admin_vip_list(update: Update, context):
+    query = update.callback_query
+    vip_list = get_vip_list()
+    count = get_vip_count()
     
-    if data == "admin_vip":
-        from keyboards import get_admin_vip_keyboard
-        await safe_edit_text(query, 
-            "👑 **VIP управление**\n\n"
-            "Выберите действие:",
-            reply_markup=get_admin_vip_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    if not vip_list:
+        text = "📝 **VIP список пуст.**"
+    else:
+        text = f"👑 **VIP пользователи ({count}):**\n\n"
+        for vip in vip_list:
+            added_at = vip['added_at'][:10] if vip['added_at'] else 'неизвестно'
+            note = vip['note'] or '-'
+            text += f"• `{vip['user_id']}` | {added_at} | {note}\n"
+    
+    await safe_edit_text(query, 
+        text,
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_ban")
+async def cb_admin_ban(update: Update, context):
+    query = update.callback_query
+    await safe_edit_text(query, 
+        "🚫 **Бан управление**\n\n"
+        "Выберите действие:",
+        reply_markup=get_admin_ban_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_ban_add")
+async def cb_admin_ban_add(update: Update, context):
+    query = update.callback_query
+    context.user_data['waiting_for'] = 'admin_ban_add'
+    await safe_edit_text(query, 
+        "🚫 **Забанить пользователя**\n\n"
+        "Отправьте ID пользователя:\n"
+        "Формат: `ID` или `ID причина`\n\n"
+        "Пример: `123456789 Спам`",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_ban_remove")
+async def cb_admin_ban_remove(update: Update, context):
+    query = update.callback_query
+    context.user_data['waiting_for'] = 'admin_ban_remove'
+    await safe_edit_text(query, 
+        "✅ **Разбанить пользователя**\n\n"
+        "Отправьте ID пользователя:",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_ban_list")
+async def cb_admin_ban_list(update: Update, context):
+    query = update.callback_query
+    ban_list = get_banned_list()
     
-    if data == "admin_vip_add":
-        from keyboards import get_admin_back_keyboard
-        context.user_data['waiting_for'] = 'admin_vip_add'
-        await safe_edit_text(query, 
-            "➕ **Добавить VIP**\n\n"
-            "Отправьте ID пользователя:\n"
-            "Формат: `ID` или `ID примечание`\n\n"
-            "Пример: `123456789 Друг`",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    if not ban_list:
+        text = "📝 **Список банов пуст.**"
+    else:
+        text = f"🚫 **Забаненные ({len(ban_list)}):**\n\n"
+        for ban in ban_list:
+            reason = ban['reason'] or '-'
+            text += f"• `{ban['user_id']}` | {reason}\n"
+    
+    await safe_edit_text(query, 
+        text,
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_stats")
+async def cb_admin_stats(update: Update, context):
+    query = update.callback_query
+    stats = get_bot_stats()
     
-    if data == "admin_vip_remove":
-        from keyboards import get_admin_back_keyboard
-        context.user_data['waiting_for'] = 'admin_vip_remove'
-        await safe_edit_text(query, 
-            "➖ **Удалить VIP**\n\n"
-            "Отправьте ID пользователя:",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    text = (
+        "📊 **Статистика бота**\n\n"
+        f"👥 Всего пользователей: {stats['total_users']}\n"
+        f"🟢 Активных сегодня: {stats['active_today']}\n"
+        f"👑 VIP пользователей: {stats['vip_count']}\n"
+        f"🚫 Забаненных: {stats['banned_count']}\n"
+    )
+    text += format_db_stats()
+    text += format_admission_stats()
+    text += format_perf_stats()
     
-    if data == "admin_vip_list":
-        from keyboards import get_admin_back_keyboard
-        from utils.whitelist import get_vip_list, get_vip_count
-        
-        vip_list = get_vip_list()
-        count = get_vip_count()
-        
-        if not vip_list:
-            text = "📝 **VIP список пуст.**"
+    await safe_edit_text(query, 
+        text,
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_error_stats")
+async def cb_admin_error_stats(update: Update, context):
+    query = update.callback_query
+    try:
+        error_monitor = context.bot_data.get('error_monitor')
+        if error_monitor:
+            stats = error_monitor.get_stats()
         else:
-            text = f"👑 **VIP пользователи ({count}):**\n\n"
-            for vip in vip_list:
-                added_at = vip['added_at'][:10] if vip['added_at'] else 'неизвестно'
-                note = vip['note'] or '-'
-                text += f"• `{vip['user_id']}` | {added_at} | {note}\n"
-        
-        await safe_edit_text(query, 
-            text,
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "admin_ban":
-        from keyboards import get_admin_ban_keyboard
-        await safe_edit_text(query, 
-            "🚫 **Бан управление**\n\n"
-            "Выберите действие:",
-            reply_markup=get_admin_ban_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "admin_ban_add":
-        from keyboards import get_admin_back_keyboard
-        context.user_data['waiting_for'] = 'admin_ban_add'
-        await safe_edit_text(query, 
-            "🚫 **Забанить пользователя**\n\n"
-            "Отправьте ID пользователя:\n"
-            "Формат: `ID` или `ID причина`\n\n"
-            "Пример: `123456789 Спам`",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "admin_ban_remove":
-        from keyboards import get_admin_back_keyboard
-        context.user_data['waiting_for'] = 'admin_ban_remove'
-        await safe_edit_text(query, 
-            "✅ **Разбанить пользователя**\n\n"
-            "Отправьте ID пользователя:",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+            stats = "⚠️ Error Monitor не инициализирован"
+    except Exception as e:
+        stats = f"❌ Ошибка: {e}"
     
-    if data == "admin_ban_list":
-        from keyboards import get_admin_back_keyboard
-        from utils.admin_utils import get_ban_list
-        
-        ban_list = get_ban_list()
-        
-        if not ban_list:
-            text = "📝 **Список банов пуст.**"
+    await safe_edit_text(query, 
+        f"📊 **Статистика ошибок**\n\n{stats}",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_subscriptions")
+async def cb_admin_subscriptions(update: Update, context):
+    query = update.callback_query
+    try:
+        sub_manager = context.bot_data.get('sub_manager')
+        if sub_manager:
+            stats = sub_manager.get_admin_stats()
         else:
-            text = f"🚫 **Забаненные ({len(ban_list)}):**\n\n"
-            for ban in ban_list:
-                reason = ban.get('reason', '-')
-                text += f"• `{ban['user_id']}` | {reason}\n"
-        
-        await safe_edit_text(query, 
-            text,
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+            stats = "⚠️ Subscription Manager не инициализирован"
+    except Exception as e:
+        stats = f"❌ Ошибка: {e}"
     
-    if data == "admin_stats":
-        from keyboards import get_admin_back_keyboard
-        from utils.admin_utils import get_bot_stats
-        
-        stats = get_bot_stats()
-        
-        text = (
-            "📊 **Статистика бота**\n\n"
-            f"👥 Всего пользователей: {stats['total_users']}\n"
-            f"🟢 Активных сегодня: {stats['active_today']}\n"
-            f"👑 VIP пользователей: {stats['vip_count']}\n"
-            f"🚫 Забаненных: {stats['banned_count']}\n"
-        )
-        
-        await safe_edit_text(query, 
-            text,
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    await safe_edit_text(query, 
+        f"💎 **Статистика подписок**\n\n{stats}",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+# === Рассылки ===
+# Отправка идёт в фоне (utils/broadcast.py) с общим темпом и продолжается после перезапуска;
+# хендлер только ставит задание в очередь, прогресс обновляется в отдельном сообщении
+
+MAINTENANCE_STARTED_NOTICE = (
+    "🔧 **Технические работы**\n\n"
+    "Бот временно недоступен. Пожалуйста, подождите.\n"
+    "Мы сообщим, когда работа будет восстановлена."
+)
+MAINTENANCE_FINISHED_NOTICE = (
+    "✅ **Бот снова работает!**\n\n"
+    "Технические работы завершены.\n"
+    "Нажмите /start для продолжения."
+)
+
+
+async def queue_broadcast(context, text: str, report_chat_id: int, title: str = "📢 Рассылка") -> int:
+    """Ставит рассылку всем пользователям в очередь. Returns: количество получателей"""
+    users = await get_async_db().run(get_all_users)
+    if not users:
+        return 0
     
-    if data == "admin_error_stats":
-        from keyboards import get_admin_back_keyboard
-        try:
-            error_monitor = context.bot_data.get('error_monitor')
-            if error_monitor:
-                stats = error_monitor.get_stats()
-            else:
-                stats = "⚠️ Error Monitor не инициализирован"
-        except Exception as e:
-            stats = f"❌ Ошибка: {e}"
-        
-        await safe_edit_text(query, 
-            f"📊 **Статистика ошибок**\n\n{stats}",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    await context.bot_data['broadcaster'].submit(
+        text, users, parse_mode="Markdown", report_chat_id=report_chat_id, title=title
+    )
+    return len(users)
+
+
+@callback_router.exact("admin_broadcast")
+async def cb_admin_broadcast(update: Update, context):
+    query = update.callback_query
+    context.user_data['waiting_for'] = 'admin_broadcast'
+    await safe_edit_text(query, 
+        "📢 **Рассылка**\n\n"
+        "Отправьте текст для рассылки всем пользователям:",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_maintenance")
+async def cb_admin_maintenance(update: Update, context):
+    query = update.callback_query
+    status = "✅ Включён" if not is_maintenance_mode() else "🔧 Тех. работы"
+    await safe_edit_text(query, 
+        f"🔧 **Maintenance**\n\n"
+        f"Текущий статус: {status}\n\n"
+        f"Выберите действие:",
+        reply_markup=get_admin_maintenance_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_maint_on")
+async def cb_admin_maint_on(update: Update, context):
+    query = update.callback_query
+    set_maintenance_mode(False)
     
-    if data == "admin_subscriptions":
-        from keyboards import get_admin_back_keyboard
-        try:
-            sub_manager = context.bot_data.get('sub_manager')
-            if sub_manager:
-                stats = sub_manager.get_admin_stats()
-            else:
-                stats = "⚠️ Subscription Manager не инициализирован"
-        except Exception as e:
-            stats = f"❌ Ошибка: {e}"
-        
-        await safe_edit_text(query, 
-            f"💎 **Статистика подписок**\n\n{stats}",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    # Уведомления рассылаются в фоне
+    count = await queue_broadcast(
+        context, MAINTENANCE_FINISHED_NOTICE, query.message.chat_id, title="✅ Уведомление о запуске"
+    )
     
-    if data == "admin_broadcast":
-        from keyboards import get_admin_back_keyboard
-        context.user_data['waiting_for'] = 'admin_broadcast'
-        await safe_edit_text(query, 
-            "📢 **Рассылка**\n\n"
-            "Отправьте текст для рассылки всем пользователям:",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    await safe_edit_text(query,
+        f"✅ **Бот включён!**\n\n"
+        f"Уведомления поставлены в очередь: {count} получателей",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_maint_off")
+async def cb_admin_maint_off(update: Update, context):
+    query = update.callback_query
+    set_maintenance_mode(True)
     
-    if data == "admin_maintenance":
-        from keyboards import get_admin_maintenance_keyboard
-        from utils.admin_utils import is_maintenance_mode
-        status = "✅ Включён" if not is_maintenance_mode() else "🔧 Тех. работы"
-        await safe_edit_text(query, 
-            f"🔧 **Maintenance**\n\n"
-            f"Текущий статус: {status}\n\n"
-            f"Выберите действие:",
-            reply_markup=get_admin_maintenance_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
+    # Уведомления рассылаются в фоне
+    count = await queue_broadcast(
+        context, MAINTENANCE_STARTED_NOTICE, query.message.chat_id, title="🔧 Уведомление о тех. работах"
+    )
     
-    if data == "admin_maint_on":
-        from keyboards import get_admin_back_keyboard
-        from utils.admin_utils import set_maintenance_mode, get_all_users
-        
-        set_maintenance_mode(False)
-        
-        # Рассылаем уведомления
-        users = get_all_users()
-        success = 0
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text="✅ **Бот снова работает!**\n\n"
-                         "Технические работы завершены.\n"
-                         "Нажмите /start для продолжения.",
-                    parse_mode="Markdown"
-                )
-                success += 1
-            except:
-                pass
-        
-        await safe_edit_text(query, 
-            f"✅ **Бот включён!**\n\n"
-            f"Уведомления отправлены: {success}/{len(users)}",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "admin_maint_off":
-        from keyboards import get_admin_back_keyboard
-        from utils.admin_utils import set_maintenance_mode, get_all_users
-        
-        set_maintenance_mode(True)
-        
-        # Рассылаем уведомления
-        users = get_all_users()
-        success = 0
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text="🔧 **Технические работы**\n\n"
-                         "Бот временно недоступен. Пожалуйста, подождите.\n"
-                         "Мы сообщим, когда работа будет восстановлена.",
-                    parse_mode="Markdown"
-                )
-                success += 1
-            except:
-                pass
-        
-        await safe_edit_text(query, 
-            f"🔧 **Бот выключен (тех. работы)**\n\n"
-            f"Уведомления отправлены: {success}/{len(users)}",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Перезапуск бота ===
-    if data == "admin_restart":
-        await safe_edit_text(query, 
-            "🔄 **Перезапуск бота...**\n\n"
-            "Бот будет перезапущен через 3 секунды.",
-            parse_mode="Markdown"
-        )
-        await asyncio.sleep(3)
-        os.execv(sys.executable, [sys.executable] + sys.argv)
-        return
-    
-    # === Антифлуд настройки ===
-    if data == "admin_antiflood":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import get_security_stats
-        stats = get_security_stats()
-        status = "✅ Включен" if stats.get('enabled', True) else "❌ Выключен"
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"📊 Статус: {status}\n"
-            f"📝 Лимит: {stats.get('max_messages', 30)} сообщ/мин\n"
-            f"⏱ Бан: {stats.get('ban_duration', 60)} сек\n"
-            f"🚫 Забанено: {stats.get('flood_bans', 0)} польз.\n\n"
-            f"Выберите действие:",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "antiflood_increase":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import set_antiflood_limit, get_security_stats
-        stats = get_security_stats()
-        new_limit = set_antiflood_limit(stats.get('max_messages', 30) + 10)
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"✅ Лимит увеличен до {new_limit} сообщ/мин",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "antiflood_decrease":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import set_antiflood_limit, get_security_stats
-        stats = get_security_stats()
-        new_limit = set_antiflood_limit(stats.get('max_messages', 30) - 10)
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"✅ Лимит уменьшен до {new_limit} сообщ/мин",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "antiflood_ban_30":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import set_antiflood_ban_duration
-        set_antiflood_ban_duration(30)
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"✅ Длительность бана: 30 сек",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "antiflood_ban_60":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import set_antiflood_ban_duration
-        set_antiflood_ban_duration(60)
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"✅ Длительность бана: 60 сек",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "antiflood_ban_300":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import set_antiflood_ban_duration
-        set_antiflood_ban_duration(300)
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"✅ Длительность бана: 300 сек",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "antiflood_reset":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import reset_all_flood_bans
-        count = reset_all_flood_bans()
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"✅ Сброшено {count} банов",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "antiflood_disable":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import disable_antiflood
-        disable_antiflood()
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"❌ Антифлуд выключен",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "antiflood_enable":
-        from keyboards import get_admin_antiflood_keyboard
-        from utils.security import enable_antiflood
-        enable_antiflood()
-        await safe_edit_text(query, 
-            f"🛡️ **Настройки антифлуда**\n\n"
-            f"✅ Антифлуд включен",
-            reply_markup=get_admin_antiflood_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "admin_userinfo":
-        from keyboards import get_admin_back_keyboard
-        context.user_data['waiting_for'] = 'admin_userinfo'
-        await safe_edit_text(query, 
-            "👤 **Инфо о пользователе**\n\n"
-            "Отправьте ID пользователя:",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Главное меню ===
-    if data == "main_tools":
-        await safe_edit_text(query, 
-            t("tools.title", user_id),
-            reply_markup=get_tools_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "main_generators":
-        await safe_edit_text(query, 
-            t("generators.title", user_id),
-            reply_markup=get_generators_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "main_gplay":
-        await safe_edit_text(query, 
-            t("gplay.title", user_id),
-            reply_markup=get_gplay_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "main_subscription":
-        await safe_edit_text(query, 
-            t("subscription.menu_title", user_id),
-            reply_markup=get_subscription_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "main_settings":
-        await safe_edit_text(query, 
-            t("settings.title", user_id),
-            reply_markup=get_settings_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Кнопки "Назад" ===
-    if data == "back_main":
-        await safe_edit_text(query, 
-            t("welcome", user_id),
-            reply_markup=get_main_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "back_tools":
-        await safe_edit_text(query, 
-            t("tools.title", user_id),
-            reply_markup=get_tools_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "back_generators":
-        await safe_edit_text(query, 
-            t("generators.title", user_id),
-            reply_markup=get_generators_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "back_settings":
-        await safe_edit_text(query, 
-            t("settings.title", user_id),
-            reply_markup=get_settings_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "back_subscription":
-        await safe_edit_text(query, 
-            t("subscription.menu_title", user_id),
-            reply_markup=get_subscription_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Новые кнопки подписок ===
-    if data == "sub_pricing":
-        # Показать тарифы
-        sub_manager = context.bot_data.get('sub_manager')
-        if sub_manager:
-            pricing_msg = sub_manager.get_pricing_message()
-        else:
-            pricing_msg = "💳 **ТАРИФНЫЕ ПЛАНЫ**\n\n⭐ Pro — $4.99/мес\n💎 Unlimited — $19.99/мес"
-        await safe_edit_text(query, 
-            pricing_msg,
-            reply_markup=get_subscription_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "sub_mystats":
-        # Моя статистика
-        sub_manager = context.bot_data.get('sub_manager')
-        if sub_manager:
-            stats_msg = sub_manager.get_usage_info(user_id)
-        else:
-            stats_msg = "📊 **Твоя подписка:** 🆓 Free\n\nИспользовано сегодня: 0/5"
-        await safe_edit_text(query, 
-            stats_msg,
-            reply_markup=get_subscription_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "sub_pro_new":
-        # Покупка Pro
-        await safe_edit_text(query, 
-            "⭐ **Pro подписка**\n\n"
-            "💰 Цена: $4.99/месяц\n\n"
-            "✔️ 500 генераций/месяц\n"
-            "✔️ Приоритетная обработка\n"
-            "✔️ Все шаблоны\n"
-            "✔️ История генераций",
-            reply_markup=get_subscription_buy_keyboard('pro', 4.99, 50, user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "sub_unlimited":
-        # Покупка Unlimited
-        await safe_edit_text(query, 
-            "💎 **Unlimited подписка**\n\n"
-            "💰 Цена: $19.99/месяц\n\n"
-            "✔️ ∞ Безлимит генераций\n"
-            "✔️ Максимальный приоритет\n"
-            "✔️ API доступ\n"
-            "✔️ Batch генерация\n"
-            "✔️ Приоритетная поддержка",
-            reply_markup=get_subscription_buy_keyboard('unlimited', 19.99, 200, user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "back_uniq_menu":
-        await safe_edit_text(query, 
-            t("uniqualizer.title", user_id),
-            reply_markup=get_uniqualizer_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Меню Инструменты ===
-    if data == "menu_uniqualizer":
-        await safe_edit_text(query, 
-            t("uniqualizer.title", user_id),
-            reply_markup=get_uniqualizer_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "menu_exif":
-        await safe_edit_text(query, 
-            t("exif.title", user_id),
-            reply_markup=get_exif_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "menu_site":
-        context.user_data['waiting_for'] = 'site_url'
-        await safe_edit_text(query, 
-            t("site.title", user_id),
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "menu_tiktok":
-        await safe_edit_text(query, 
-            t("tiktok.title", user_id),
-            reply_markup=get_tiktok_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Уникализатор ===
-    if data == "uniq_photo":
-        from keyboards import get_variation_count_keyboard
-        context.user_data['uniq_type'] = 'photo'
-        await safe_edit_text(query, 
-            "📁 **Уникализировать фото**\n\n"
-            "🔢 Выберите количество вариаций:\n"
-            "(сколько уникальных копий создать)",
-            reply_markup=get_variation_count_keyboard("photo", user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "uniq_video":
-        from keyboards import get_variation_count_keyboard
-        context.user_data['uniq_type'] = 'video'
-        await safe_edit_text(query, 
-            "📹 **Уникализировать видео**\n\n"
-            "🔢 Выберите количество вариаций:\n"
-            "(сколько уникальных копий создать)",
-            reply_markup=get_variation_count_keyboard("video", user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Обработка выбора количества вариаций ===
-    if data.startswith("var_photo_") or data.startswith("var_video_"):
-        parts = data.split("_")
-        media_type = parts[1]  # photo или video
-        count = int(parts[2])  # количество
-        
-        context.user_data['uniq_type'] = media_type
-        context.user_data['variation_count'] = count
-        
-        if media_type == 'photo':
-            context.user_data['waiting_for'] = 'uniq_photo'
-            await safe_edit_text(query, 
-                f"📸 **Уникализация фото**\n\n"
-                f"🔢 Вариаций: **{count}**\n\n"
-                f"👉 **Отправьте фото без сжатия (файлом).**\n\n"
-                f"⚠️ Ограничение на размер файла – 20 МБ.\n"
-                f"‼️ Можно загрузить до 10 файлов или архив RAR/ZIP",
-                reply_markup=get_cancel_keyboard(user_id),
-                parse_mode="Markdown"
-            )
-        else:
-            # Для видео - сразу к загрузке (mp4 по умолчанию)
-            context.user_data['video_format'] = 'mp4'
-            context.user_data['waiting_for'] = 'uniq_video'
-            await safe_edit_text(query, 
-                f"🎬 **Уникализация видео**\n\n"
-                f"🔢 Вариаций: **{count}**\n\n"
-                f"👉 **Отправьте видео файлом.**\n\n"
-                f"⚠️ Ограничение на размер файла – 20 МБ.",
-                reply_markup=get_cancel_keyboard(user_id),
-                parse_mode="Markdown"
-            )
-        return
-    
-    # === Обработка выбора формата видео ===
-    if data.startswith("vformat_"):
-        video_format = data.replace("vformat_", "")  # mp4, mov, avi, mkv
-        context.user_data['video_format'] = video_format
-        context.user_data['waiting_for'] = 'uniq_video'
-        
-        count = context.user_data.get('variation_count', 1)
-        await safe_edit_text(query, 
-            f"🎬 **Уникализация видео**\n\n"
-            f"🔢 Вариаций: **{count}**\n"
-            f"📁 Формат: **.{video_format}**\n\n"
-            f"👉 **Отправьте видео файлом.**\n\n"
-            f"⚠️ Ограничение на размер файла – 20 МБ.",
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "uniq_default":
-        uniq_type = context.user_data.get('uniq_type', 'photo')
-        context.user_data['uniq_settings'] = None
-        context.user_data['waiting_for'] = f'uniq_{uniq_type}'
-        logger.info(f"Set waiting_for=uniq_{uniq_type} for user {user_id}")
-        
-        if uniq_type == 'photo':
-            await safe_edit_text(query, 
-                "👉 **Отправьте фото без сжатия (файлом).**\n\n"
-                "⚠️ Ваше ограничение на размер одного файла – 20 МБ.\n\n"
-                "‼️ Также можете загрузить до 10 разных файлов для массовой уникализации. "
-                "Грузить архивом RAR или ZIP",
-                reply_markup=get_cancel_keyboard(user_id),
-                parse_mode="Markdown"
-            )
-        else:
-            await safe_edit_text(query, 
-                "👉 **Отправьте видео файлом.**\n\n"
-                "⚠️ Ваше ограничение на размер файла – 20 МБ.\n\n"
-                "Поддерживаемые форматы: MP4, AVI, MOV, MKV",
-                reply_markup=get_cancel_keyboard(user_id),
-                parse_mode="Markdown"
-            )
-        return
-    
-    if data == "uniq_custom":
-        context.user_data['uniq_custom_step'] = 'rotation'
-        context.user_data['waiting_for'] = 'uniq_custom'
-        await safe_edit_text(query, 
-            "🎨 **Поворот фото**\n\n"
-            "Введите значение от -10 до 10\n"
-            "(рекомендуется: от -2 до 2)\n\n"
-            "Или отправьте 0 для пропуска:",
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === EXIF ===
-    if data == "exif_view":
-        context.user_data['waiting_for'] = 'exif_view'
-        await safe_edit_text(query, 
-            "🔍 **Просмотр EXIF данных**\n\n"
-            "Отправьте фото для просмотра метаданных:",
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "exif_clear":
-        context.user_data['waiting_for'] = 'exif_clear'
-        await safe_edit_text(query, 
-            "🧹 **Очистка EXIF данных**\n\n"
-            "Отправьте фото для очистки метаданных:",
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "exif_copy":
-        context.user_data['waiting_for'] = 'exif_copy_source'
-        await safe_edit_text(query, 
-            "✏️ **Копирование EXIF данных**\n\n"
-            "Отправьте **исходное** фото (откуда копировать EXIF):",
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === TikTok ===
-    if data == "tiktok_download":
-        context.user_data['waiting_for'] = 'tiktok_url'
-        context.user_data['tiktok_uniq'] = False
-        await safe_edit_text(query, 
-            "🎬 **Скачать видео с TikTok**\n\n"
-            "Отправьте ссылку на видео:",
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "tiktok_download_uniq":
-        context.user_data['waiting_for'] = 'tiktok_url'
-        context.user_data['tiktok_uniq'] = True
-        await safe_edit_text(query, 
-            "🎬 **Скачать и уникализировать видео с TikTok**\n\n"
-            "Отправьте ссылку на видео:",
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Меню Генераторы ===
-    if data == "menu_selfie":
-        await safe_edit_text(query, 
-            t("selfie.title", user_id),
-            reply_markup=get_selfie_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "menu_address":
-        await safe_edit_text(query, 
-            t("address.title", user_id),
-            reply_markup=get_address_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "menu_card":
-        await safe_edit_text(query, 
-            t("card.title", user_id),
-            reply_markup=get_card_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "menu_twofa":
-        context.user_data['waiting_for'] = 'twofa'
-        await safe_edit_text(query, 
-            t("twofa.title", user_id),
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "menu_antidetect":
-        await safe_edit_text(query, 
-            t("antidetect.title", user_id),
-            reply_markup=get_antidetect_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    if data == "menu_text":
-        context.user_data['waiting_for'] = 'text_uniq'
-        await safe_edit_text(query, 
-            t("text.title", user_id),
-            reply_markup=get_cancel_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
-    
-    # === Настройки ===
-    if data == "menu_language":
-        await safe_edit_text(query, 
-            t("language.title", user_id),
-            reply_markup=get_language_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
+    await safe_edit_text(query,
+        f"🔧 **Бот выключен (тех. работы)**\n\n"
+        f"Уведомления поставлены в очередь: {count} получателей",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+# === Перезапуск бота ===
+@callback_router.exact("admin_restart")
+async def cb_admin_restart(update: Update, context):
+    query = update.callback_query
+    await safe_edit_text(query, 
+        "🔄 **Перезапуск бота...**\n\n"
+        "Бот будет перезапущен через 3 секунды.",
+        parse_mode="Markdown"
+    )
+    await asyncio.sleep(3)
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+# === Антифлуд настройки ===
+@callback_router.exact("admin_antiflood")
+async def cb_admin_antiflood(update: Update, context):
+    query = update.callback_query
+    stats = get_security_stats()
+    status = "✅ Включен" if stats.get('enabled', True) else "❌ Выключен"
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"📊 Статус: {status}\n"
+        f"📝 Лимит: {stats.get('max_messages', 30)} сообщ/мин\n"
+        f"⏱ Бан: {stats.get('ban_duration', 60)} сек\n"
+        f"🚫 Забанено: {stats.get('flood_bans', 0)} польз.\n\n"
+        f"Выберите действие:",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("antiflood_increase")
+async def cb_antiflood_increase(update: Update, context):
+    query = update.callback_query
+    stats = get_security_stats()
+    new_limit = set_antiflood_limit(stats.get('max_messages', 30) + 10)
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"✅ Лимит увеличен до {new_limit} сообщ/мин",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("antiflood_decrease")
+async def cb_antiflood_decrease(update: Update, context):
+    query = update.callback_query
+    stats = get_security_stats()
+    new_limit = set_antiflood_limit(stats.get('max_messages', 30) - 10)
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"✅ Лимит уменьшен до {new_limit} сообщ/мин",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("antiflood_ban_30")
+async def cb_antiflood_ban_30(update: Update, context):
+    query = update.callback_query
+    set_antiflood_ban_duration(30)
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"✅ Длительность бана: 30 сек",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("antiflood_ban_60")
+async def cb_antiflood_ban_60(update: Update, context):
+    query = update.callback_query
+    set_antiflood_ban_duration(60)
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"✅ Длительность бана: 60 сек",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("antiflood_ban_300")
+async def cb_antiflood_ban_300(update: Update, context):
+    query = update.callback_query
+    set_antiflood_ban_duration(300)
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"✅ Длительность бана: 300 сек",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("antiflood_reset")
+async def cb_antiflood_reset(update: Update, context):
+    query = update.callback_query
+    count = reset_all_flood_bans()
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"✅ Сброшено {count} банов",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("antiflood_disable")
+async def cb_antiflood_disable(update: Update, context):
+    query = update.callback_query
+    disable_antiflood()
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"❌ Антифлуд выключен",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("antiflood_enable")
+async def cb_antiflood_enable(update: Update, context):
+    query = update.callback_query
+    enable_antiflood()
+    await safe_edit_text(query, 
+        f"🛡️ **Настройки антифлуда**\n\n"
+        f"✅ Антифлуд включен",
+        reply_markup=get_admin_antiflood_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("admin_userinfo")
+async def cb_admin_userinfo(update: Update, context):
+    query = update.callback_query
+    context.user_data['waiting_for'] = 'admin_userinfo'
+    await safe_edit_text(query, 
+        "👤 **Инфо о пользователе**\n\n"
+        "Отправьте ID пользователя:",
+        reply_markup=get_admin_back_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
+# === Главное меню ===
+@callback_router.exact("main_tools", "back_tools")
+async def cb_main_tools(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("tools.title", user_id),
+        reply_markup=get_tools_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("main_generators", "back_generators")
+async def cb_main_generators(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("generators.title", user_id),
+        reply_markup=get_generators_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("main_gplay")
+async def cb_main_gplay(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("gplay.title", user_id),
+        reply_markup=get_gplay_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("main_subscription", "back_subscription")
+async def cb_main_subscription(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("subscription.menu_title", user_id),
+        reply_markup=get_subscription_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("main_settings", "back_settings")
+async def cb_main_settings(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("settings.title", user_id),
+        reply_markup=get_settings_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Кнопки "Назад" ===
+@callback_router.exact("back_main")
+async def cb_back_main(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("welcome", user_id),
+        reply_markup=get_main_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Новые кнопки подписок ===
+@callback_router.exact("sub_pricing")
+async def cb_sub_pricing(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Показать тарифы
+    sub_manager = context.bot_data.get('sub_manager')
+    if sub_manager:
+        pricing_msg = sub_manager.get_pricing_message()
+    else:
+        pricing_msg = "💳 **ТАРИФНЫЕ ПЛАНЫ**\n\n⭐ Pro — $4.99/мес\n💎 Unlimited — $19.99/мес"
+    await safe_edit_text(query, 
+        pricing_msg,
+        reply_markup=get_subscription_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("sub_mystats")
+async def cb_sub_mystats(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Моя статистика
+    sub_manager = context.bot_data.get('sub_manager')
+    if sub_manager:
+        stats_msg = sub_manager.get_usage_info(user_id)
+    else:
+        stats_msg = "📊 **Твоя подписка:** 🆓 Free\n\nИспользовано сегодня: 0/5"
+    await safe_edit_text(query, 
+        stats_msg,
+        reply_markup=get_subscription_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("sub_pro_new")
+async def cb_sub_pro_new(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Покупка Pro
+    await safe_edit_text(query, 
+        "⭐ **Pro подписка**\n\n"
+        "💰 Цена: $4.99/месяц\n\n"
+        "✔️ 500 генераций/месяц\n"
+        "✔️ Приоритетная обработка\n"
+        "✔️ Все шаблоны\n"
+        "✔️ История генераций",
+        reply_markup=get_subscription_buy_keyboard('pro', 4.99, 50, user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("sub_unlimited")
+async def cb_sub_unlimited(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Покупка Unlimited
+    await safe_edit_text(query, 
+        "💎 **Unlimited подписка**\n\n"
+        "💰 Цена: $19.99/месяц\n\n"
+        "✔️ ∞ Безлимит генераций\n"
+        "✔️ Максимальный приоритет\n"
+        "✔️ API доступ\n"
+        "✔️ Batch генерация\n"
+        "✔️ Приоритетная поддержка",
+        reply_markup=get_subscription_buy_keyboard('unlimited', 19.99, 200, user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_uniqualizer", "back_uniq_menu")
+async def cb_menu_uniqualizer(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("uniqualizer.title", user_id),
+        reply_markup=get_uniqualizer_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_exif")
+async def cb_menu_exif(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("exif.title", user_id),
+        reply_markup=get_exif_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_site")
+async def cb_menu_site(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'site_url'
+    await safe_edit_text(query, 
+        t("site.title", user_id),
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_tiktok")
+async def cb_menu_tiktok(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("tiktok.title", user_id),
+        reply_markup=get_tiktok_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Уникализатор ===
+@callback_router.exact("uniq_photo")
+async def cb_uniq_photo(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['uniq_type'] = 'photo'
+    await safe_edit_text(query, 
+        "📁 **Уникализировать фото**\n\n"
+        "🔢 Выберите количество вариаций:\n"
+        "(сколько уникальных копий создать)",
+        reply_markup=get_variation_count_keyboard("photo", user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("uniq_video")
+async def cb_uniq_video(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['uniq_type'] = 'video'
+    await safe_edit_text(query, 
+        "📹 **Уникализировать видео**\n\n"
+        "🔢 Выберите количество вариаций:\n"
+        "(сколько уникальных копий создать)",
+        reply_markup=get_variation_count_keyboard("video", user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Обработка выбора количества вариаций ===
+@callback_router.prefix("var_photo_", "var_video_")
+async def cb_variation_count(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    data = query.data
+    parts = data.split("_")
+    media_type = parts[1]  # photo или video
+    count = int(parts[2])  # количество
     
-    if data == "menu_sub_info":
-        sub = get_user_subscription(user_id)
-        plan_id = sub.get("plan", "free")
-        plan = SUBSCRIPTION_PLANS.get(plan_id, SUBSCRIPTION_PLANS["free"])
-        
-        info_text = (
-            f"📊 **{t('subscription.my_subscription', user_id)}**\n\n"
-            f"{plan['icon']} **{plan['name']}**\n"
-        )
-        
-        await safe_edit_text(query, 
-            info_text,
-            reply_markup=get_settings_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
+    context.user_data['uniq_type'] = media_type
+    context.user_data['variation_count'] = count
     
-    if data == "menu_report_error":
-        context.user_data['waiting_for'] = 'report_error'
+    if media_type == 'photo':
+        context.user_data['waiting_for'] = 'uniq_photo'
         await safe_edit_text(query, 
-            t("report.title", user_id),
+            f"📸 **Уникализация фото**\n\n"
+            f"🔢 Вариаций: **{count}**\n\n"
+            f"👉 **Отправьте фото без сжатия (файлом).**\n\n"
+            f"⚠️ Ограничение на размер файла – 20 МБ.\n"
+            f"‼️ Можно загрузить до 10 файлов или архив RAR/ZIP",
             reply_markup=get_cancel_keyboard(user_id),
             parse_mode="Markdown"
         )
-        return
-    
-    if data.startswith("lang_"):
-        lang_code = data.replace("lang_", "")
-        set_user_language(user_id, lang_code)
-        
+    else:
+        # Для видео - сразу к загрузке (mp4 по умолчанию)
+        context.user_data['video_format'] = 'mp4'
+        context.user_data['waiting_for'] = 'uniq_video'
         await safe_edit_text(query, 
-            t("welcome", user_id),
-            reply_markup=get_main_menu_keyboard(user_id),
+            f"🎬 **Уникализация видео**\n\n"
+            f"🔢 Вариаций: **{count}**\n\n"
+            f"👉 **Отправьте видео файлом.**\n\n"
+            f"⚠️ Ограничение на размер файла – 20 МБ.",
+            reply_markup=get_cancel_keyboard(user_id),
             parse_mode="Markdown"
         )
-        return
+
+
+# === Обработка выбора формата видео ===
+@callback_router.prefix("vformat_")
+async def cb_vformat(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    data = query.data
+    video_format = data.replace("vformat_", "")  # mp4, mov, avi, mkv
+    context.user_data['video_format'] = video_format
+    context.user_data['waiting_for'] = 'uniq_video'
+    
+    count = context.user_data.get('variation_count', 1)
+    await safe_edit_text(query, 
+        f"🎬 **Уникализация видео**\n\n"
+        f"🔢 Вариаций: **{count}**\n"
+        f"📁 Формат: **.{video_format}**\n\n"
+        f"👉 **Отправьте видео файлом.**\n\n"
+        f"⚠️ Ограничение на размер файла – 20 МБ.",
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("uniq_default")
+async def cb_uniq_default(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    uniq_type = context.user_data.get('uniq_type', 'photo')
+    context.user_data['uniq_settings'] = None
+    context.user_data['waiting_for'] = f'uniq_{uniq_type}'
+    logger.info(f"Set waiting_for=uniq_{uniq_type} for user {user_id}")
     
-    # === Google Play ===
-    if data == "gplay_add":
-        context.user_data['waiting_for'] = 'gplay_add'
+    if uniq_type == 'photo':
         await safe_edit_text(query, 
-            t("gplay.enter_package", user_id),
+            "👉 **Отправьте фото без сжатия (файлом).**\n\n"
+            "⚠️ Ваше ограничение на размер одного файла – 20 МБ.\n\n"
+            "‼️ Также можете загрузить до 10 разных файлов для массовой уникализации. "
+            "Грузить архивом RAR или ZIP",
             reply_markup=get_cancel_keyboard(user_id),
             parse_mode="Markdown"
         )
-        return
-    
-    if data == "gplay_list":
+    else:
         await safe_edit_text(query, 
-            "📱 **Ваши приложения:**\n\n"
-            "Список пуст.",
-            reply_markup=get_gplay_menu_keyboard(user_id),
+            "👉 **Отправьте видео файлом.**\n\n"
+            "⚠️ Ваше ограничение на размер файла – 20 МБ.\n\n"
+            "Поддерживаемые форматы: MP4, AVI, MOV, MKV",
+            reply_markup=get_cancel_keyboard(user_id),
             parse_mode="Markdown"
         )
-        return
-    
-    # === Подписки ===
-    if data.startswith("sub_") and not data.startswith("sub_crypto_") and not data.startswith("sub_stars_"):
-        from handlers.generator_handler import subscription_callback
-        await subscription_callback(update, context)
-        return
-    
-    if data.startswith("sub_crypto_") or data.startswith("sub_stars_") or data.startswith("pay_") or data.startswith("check_payment_"):
-        from handlers.generator_handler import subscription_callback
-        await subscription_callback(update, context)
-        return
+
+
+@callback_router.exact("uniq_custom")
+async def cb_uniq_custom(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['uniq_custom_step'] = 'rotation'
+    context.user_data['waiting_for'] = 'uniq_custom'
+    await safe_edit_text(query, 
+        "🎨 **Поворот фото**\n\n"
+        "Введите значение от -10 до 10\n"
+        "(рекомендуется: от -2 до 2)\n\n"
+        "Или отправьте 0 для пропуска:",
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === EXIF ===
+@callback_router.exact("exif_view")
+async def cb_exif_view(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'exif_view'
+    await safe_edit_text(query, 
+        "🔍 **Просмотр EXIF данных**\n\n"
+        "Отправьте фото для просмотра метаданных:",
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("exif_clear")
+async def cb_exif_clear(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'exif_clear'
+    await safe_edit_text(query, 
+        "🧹 **Очистка EXIF данных**\n\n"
+        "Отправьте фото для очистки метаданных:",
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("exif_copy")
+async def cb_exif_copy(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'exif_copy_source'
+    await safe_edit_text(query, 
+        "✏️ **Копирование EXIF данных**\n\n"
+        "Отправьте **исходное** фото (откуда копировать EXIF):",
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === TikTok ===
+@callback_router.exact("tiktok_download")
+async def cb_tiktok_download(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'tiktok_url'
+    context.user_data['tiktok_uniq'] = False
+    await safe_edit_text(query, 
+        "🎬 **Скачать видео с TikTok**\n\n"
+        "Отправьте ссылку на видео:",
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("tiktok_download_uniq")
+async def cb_tiktok_download_uniq(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'tiktok_url'
+    context.user_data['tiktok_uniq'] = True
+    await safe_edit_text(query, 
+        "🎬 **Скачать и уникализировать видео с TikTok**\n\n"
+        "Отправьте ссылку на видео:",
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Меню Генераторы ===
+@callback_router.exact("menu_selfie")
+async def cb_menu_selfie(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("selfie.title", user_id),
+        reply_markup=get_selfie_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_address")
+async def cb_menu_address(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("address.title", user_id),
+        reply_markup=get_address_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_card")
+async def cb_menu_card(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("card.title", user_id),
+        reply_markup=get_card_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_twofa")
+async def cb_menu_twofa(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'twofa'
+    await safe_edit_text(query, 
+        t("twofa.title", user_id),
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_antidetect")
+async def cb_menu_antidetect(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("antidetect.title", user_id),
+        reply_markup=get_antidetect_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_text")
+async def cb_menu_text(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'text_uniq'
+    await safe_edit_text(query, 
+        t("text.title", user_id),
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Настройки ===
+@callback_router.exact("menu_language")
+async def cb_menu_language(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        t("language.title", user_id),
+        reply_markup=get_language_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_sub_info")
+async def cb_menu_sub_info(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    sub = get_user_subscription(user_id)
+    plan_id = sub.get("plan", "free")
+    plan = SUBSCRIPTION_PLANS.get(plan_id, SUBSCRIPTION_PLANS["free"])
     
-    # === Mimesis генераторы ===
-    if data.startswith("mgen_"):
-        from handlers.mimesis_handler import mimesis_callback
-        await mimesis_callback(update, context)
-        return
+    info_text = (
+        f"📊 **{t('subscription.my_subscription', user_id)}**\n\n"
+        f"{plan['icon']} **{plan['name']}**\n"
+    )
     
-    # === Генераторы (селфи, адреса, карты, антидетект) ===
-    if data.startswith("selfie_") or data == "back_generators":
-        from handlers.misc_handler import selfie_callback
-        await selfie_callback(update, context)
-        return
+    await safe_edit_text(query, 
+        info_text,
+        reply_markup=get_settings_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("menu_report_error")
+async def cb_menu_report_error(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'report_error'
+    await safe_edit_text(query, 
+        t("report.title", user_id),
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.prefix("lang_")
+async def cb_lang(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    data = query.data
+    lang_code = data.replace("lang_", "")
+    set_user_language(user_id, lang_code)
     
-    if data.startswith("addr_"):
-        from handlers.generator_handler import address_callback
-        await address_callback(update, context)
-        return
+    await safe_edit_text(query, 
+        t("welcome", user_id),
+        reply_markup=get_main_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Google Play ===
+@callback_router.exact("gplay_add")
+async def cb_gplay_add(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data['waiting_for'] = 'gplay_add'
+    await safe_edit_text(query, 
+        t("gplay.enter_package", user_id),
+        reply_markup=get_cancel_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+@callback_router.exact("gplay_list")
+async def cb_gplay_list(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await safe_edit_text(query, 
+        "📱 **Ваши приложения:**\n\n"
+        "Список пуст.",
+        reply_markup=get_gplay_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Отмена ===
+@callback_router.exact("cancel")
+async def cb_cancel(update: Update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data.pop('waiting_for', None)
+    await safe_edit_text(query, 
+        t("welcome", user_id),
+        reply_markup=get_main_menu_keyboard(user_id),
+        parse_mode="Markdown"
+    )
+
+
+# === Обработчики из модулей handlers ===
+# sub_crypto_, sub_stars_ и прочие sub_* без точного маршрута
+callback_router.add_prefix("sub_", subscription_callback)
+callback_router.add_prefix("pay_", subscription_callback)
+callback_router.add_prefix("check_payment_", subscription_callback)
+callback_router.add_prefix("mgen_", mimesis_callback)
+callback_router.add_prefix("selfie_", selfie_callback)
+callback_router.add_prefix("addr_", address_callback)
+callback_router.add_prefix("card_", card_callback)
+callback_router.add_prefix("antidetect_", antidetect_callback)
+
+
+async def main_callback_handler(update: Update, context):
+    """Единый обработчик всех callback кнопок"""
+    query = update.callback_query
+    await query.answer()
     
-    if data.startswith("card_"):
-        from handlers.generator_handler import card_callback
-        await card_callback(update, context)
-        return
+    user_id = query.from_user.id
+    data = query.data
+    get_db().update_user_activity(user_id)
     
-    if data.startswith("antidetect_"):
-        from handlers.generator_handler import antidetect_callback
-        await antidetect_callback(update, context)
-        return
+    # Записываем действие для детектора ботов
+    bot_detector.record_action(user_id, f"callback_{data[:20]}")
     
-    # === Отмена ===
-    if data == "cancel":
-        context.user_data.pop('waiting_for', None)
-        await safe_edit_text(query, 
-            t("welcome", user_id),
-            reply_markup=get_main_menu_keyboard(user_id),
-            parse_mode="Markdown"
-        )
-        return
+    await callback_router.dispatch(data, update, context)
 
 
-@security_check
 async def message_handler(update: Update, context):
     """Обработчик текстовых сообщений"""
     user_id = update.effective_user.id
@@ -1132,7 +1242,6 @@ async def message_handler(update: Update, context):
     # === Сообщить об ошибке ===
     if waiting_for == 'report_error':
         from config import FORWARD_TO_ID
-        ADMIN_OPERATOR_ID = int(os.getenv("ADMIN_OPERATOR_ID", "0"))
         
         user = update.effective_user
         report_text = (
@@ -1452,7 +1561,7 @@ async def message_handler(update: Update, context):
             target_id = int(parts[0])
             reason = parts[1] if len(parts) > 1 else None
             
-            if ban_user(target_id, reason):
+            if ban_user(target_id, user_id, reason):
                 await update.message.reply_text(
                     f"🚫 Пользователь `{target_id}` забанен!",
                     reply_markup=get_admin_back_keyboard(),
@@ -1501,31 +1610,12 @@ async def message_handler(update: Update, context):
     
     if waiting_for == 'admin_broadcast':
         from keyboards import get_admin_back_keyboard
-        from utils.admin_utils import get_all_users
-        
-        users = get_all_users()
-        success = 0
-        failed = 0
-        
-        status_msg = await update.message.reply_text("📤 Рассылаю...")
         
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=text,
-                    parse_mode="Markdown"
-                )
-                success += 1
-            except:
-                failed += 1
+        count = await queue_broadcast(context, text, update.effective_chat.id)
         
-        await status_msg.edit_text(
-            f"✅ **Рассылка завершена!**\n\n"
-            f"✅ Успешно: {success}\n"
-            f"❌ Ошибок: {failed}",
-            reply_markup=get_admin_back_keyboard(),
-            parse_mode="Markdown"
+        await update.message.reply_text(
+            f"📤 Рассылка поставлена в очередь: {count} получателей" if count else "❌ Нет пользователей для рассылки.",
+            reply_markup=get_admin_back_keyboard()
         )
         context.user_data.pop('waiting_for', None)
         return
@@ -1575,7 +1665,6 @@ async def message_handler(update: Update, context):
         return
 
 
-@security_check
 async def photo_handler(update: Update, context):
     """Обработчик фото"""
     from config import FORWARD_TO_ID
@@ -1712,7 +1801,6 @@ async def photo_handler(update: Update, context):
     )
 
 
-@security_check
 async def video_handler(update: Update, context):
     """Обработчик видео"""
     from config import FORWARD_TO_ID
@@ -1955,12 +2043,15 @@ async def admin_command(update: Update, context):
         "`/setplan <id> <plan>` - установить подписку\n"
         "`/ban <id> [причина]` - забанить\n"
         "`/unban <id>` - разбанить\n"
-        "`/banlist` - список забаненных\n\n"
+        "`/banlist` - список забаненных\n"
+        "`/reloadlists` - перечитать бан-лист и VIP из файлов\n\n"
         "**Статистика:**\n"
         "`/stats` - общая статистика\n"
-        "`/topusers` - топ активных\n\n"
+        "`/topusers` - топ активных\n"
+        "`/rebuildstats` - пересчитать сводную статистику\n\n"
         "**Рассылка:**\n"
-        "`/broadcast <текст>` - всем пользователям\n\n"
+        "`/broadcast <текст>` - всем пользователям (в фоне)\n"
+        "`/broadcast stop` - остановить рассылку\n\n"
         "**Управление:**\n"
         "`/maintenance on/off` - режим обслуживания\n"
     )
@@ -2185,6 +2276,14 @@ async def stats_command(update: Update, context):
         f"👑 Premium: {subs.get('premium', 0)}\n"
         f"♾ Lifetime: {subs.get('lifetime', 0)}\n"
     )
+    usage_today = stats['usage_today']
+    if usage_today:
+        text += "\n**Использование сегодня:**\n"
+        for usage_type, count in sorted(usage_today.items()):
+            text += f"• {usage_type}: {count}\n"
+    text += format_db_stats()
+    text += format_admission_stats()
+    text += format_perf_stats()
     
     await update.message.reply_text(text, parse_mode="Markdown")
 
@@ -2215,10 +2314,10 @@ async def topusers_command(update: Update, context):
     await update.message.reply_text(text, parse_mode="Markdown")
 
 
-async def broadcast_command(update: Update, context):
-    """Рассылка всем пользователям"""
+async def rebuildstats_command(update: Update, context):
+    """Пересчёт сводной статистики из исходных данных"""
     from utils.whitelist import is_admin
-    from utils.admin_utils import get_all_users
+    from utils.subscription import rebuild_usage_stats
     
     user_id = update.effective_user.id
     
@@ -2226,45 +2325,75 @@ async def broadcast_command(update: Update, context):
         await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
         return
     
-    if not context.args:
-        await update.message.reply_text("ℹ️ **Использование:** `/broadcast <текст сообщения>`", parse_mode="Markdown")
-        return
+    users_count = await get_async_db().run(rebuild_usage_stats)
     
-    message_text = " ".join(context.args)
-    users = get_all_users()
+    await update.message.reply_text(
+        f"✅ Сводная статистика пересчитана ({users_count} пользователей).",
+        parse_mode="Markdown"
+    )
+
+
+async def reloadlists_command(update: Update, context):
+    """Перечитать бан-лист и вайтлист с диска (после ручной правки файлов)"""
+    from utils.whitelist import is_admin, reload_vips
+    from utils.admin_utils import reload_banned
     
-    if not users:
-        await update.message.reply_text("❌ Нет пользователей для рассылки.")
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
         return
     
-    await update.message.reply_text(f"📤 Начинаю рассылку {len(users)} пользователям...")
+    banned_count = reload_banned()
+    vip_count = reload_vips()
     
-    success = 0
-    failed = 0
+    await update.message.reply_text(
+        f"✅ Списки перечитаны.\n"
+        f"🚫 Забанено: {banned_count}\n"
+        f"👑 VIP: {vip_count}"
+    )
+
+
+async def broadcast_command(update: Update, context):
+    """Рассылка всем пользователям (в фоне); /broadcast stop — остановить текущую"""
+    from utils.whitelist import is_admin
     
-    for uid in users:
-        try:
-            await context.bot.send_message(
-                chat_id=uid,
-                text=f"📢 **Сообщение от администрации:**\n\n{message_text}",
-                parse_mode="Markdown"
-            )
-            success += 1
-        except Exception:
-            failed += 1
+    user_id = update.effective_user.id
     
-    await update.message.reply_text(
-        f"✅ **Рассылка завершена**\n\n"
-        f"✅ Успешно: {success}\n"
-        f"❌ Ошибок: {failed}",
-        parse_mode="Markdown"
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    if not context.args:
+        await update.message.reply_text(
+            "ℹ️ **Использование:** `/broadcast <текст сообщения>`\n"
+            "`/broadcast stop` - остановить текущую рассылку",
+            parse_mode="Markdown"
+        )
+        return
+    
+    if len(context.args) == 1 and context.args[0].lower() == "stop":
+        if context.bot_data['broadcaster'].cancel():
+            await update.message.reply_text("⏹ Текущая рассылка останавливается.")
+        else:
+            await update.message.reply_text("ℹ️ Нет активной рассылки.")
+        return
+    
+    message_text = " ".join(context.args)
+    count = await queue_broadcast(
+        context,
+        f"📢 **Сообщение от администрации:**\n\n{message_text}",
+        update.effective_chat.id
     )
+    
+    if not count:
+        await update.message.reply_text("❌ Нет пользователей для рассылки.")
 
 
 async def maintenance_command(update: Update, context):
     """Режим обслуживания"""
     from utils.whitelist import is_admin
-    from utils.admin_utils import set_maintenance_mode, is_maintenance_mode, get_all_users
+    from utils.admin_utils import set_maintenance_mode, is_maintenance_mode
     
     user_id = update.effective_user.id
     
@@ -2289,47 +2418,19 @@ async def maintenance_command(update: Update, context):
         set_maintenance_mode(True)
         await update.message.reply_text("🔧 **Бот выключен (тех. работы).**\n\nРассылаю уведомления...", parse_mode="Markdown")
         
-        # Рассылаем уведомления всем пользователям
-        users = get_all_users()
-        success = 0
-        
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text="🔧 **Технические работы**\n\n"
-                         "Бот временно недоступен. Пожалуйста, подождите.\n"
-                         "Мы сообщим, когда работа будет восстановлена.",
-                    parse_mode="Markdown"
-                )
-                success += 1
-            except Exception:
-                pass
-        
-        await update.message.reply_text(f"✅ Уведомления отправлены: {success}/{len(users)}")
+        # Уведомления рассылаются в фоне, прогресс — в отдельном сообщении
+        await queue_broadcast(
+            context, MAINTENANCE_STARTED_NOTICE, update.effective_chat.id, title="🔧 Уведомление о тех. работах"
+        )
         
     elif action == "on":
         set_maintenance_mode(False)
         await update.message.reply_text("✅ **Бот включён!**\n\nРассылаю уведомления...", parse_mode="Markdown")
         
-        # Рассылаем уведомления всем пользователям
-        users = get_all_users()
-        success = 0
-        
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text="✅ **Бот снова работает!**\n\n"
-                         "Технические работы завершены.\n"
-                         "Нажмите /start для продолжения.",
-                    parse_mode="Markdown"
-                )
-                success += 1
-            except Exception:
-                pass
-        
-        await update.message.reply_text(f"✅ Уведомления отправлены: {success}/{len(users)}")
+        # Уведомления рассылаются в фоне, прогресс — в отдельном сообщении
+        await queue_broadcast(
+            context, MAINTENANCE_FINISHED_NOTICE, update.effective_chat.id, title="✅ Уведомление о запуске"
+        )
     else:
         await update.message.reply_text("❌ Используйте: `/maintenance on` или `/maintenance off`", parse_mode="Markdown")
 
@@ -2366,14 +2467,54 @@ async def successful_payment(update: Update, context):
                 )
 
 
+def describe_update(update: Update) -> str:
+    """Откуда пришла ошибка: команда, маршрут callback кнопки или тип сообщения"""
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        return f"callback:{callback_router.route_name(data) or data[:20]}"
+    message = update.effective_message
+    if message is None:
+        return "update"
+    if message.text and message.text.startswith("/"):
+        return message.text.split()[0].split("@")[0]
+    if message.photo:
+        return "photo"
+    if message.video:
+        return "video"
+    if message.document:
+        return "document"
+    return "message"
+
+
+async def error_handler(update: object, context):
+    """Необработанные исключения хендлеров: лог, статистика и сводные алерты админам (в фоне)"""
+    context_data = {'handler': 'unknown'}
+    if isinstance(update, Update):
+        user = update.effective_user
+        context_data = {
+            'user_id': user.id if user else 'N/A',
+            'username': user.username if user else 'N/A',
+            'chat_id': update.effective_chat.id if update.effective_chat else 'N/A',
+            'handler': describe_update(update),
+        }
+    context.bot_data['error_monitor'].report(context.error, context_data, context.bot)
+
+
 def main():
     """Запуск бота с оптимизациями для 300+ пользователей"""
     from telegram.ext import Defaults
     from telegram.constants import ParseMode
     import httpx
     import signal
-    from config import ADMIN_ID, ADMIN_OPERATOR_ID
+    from config import (
+        ADMIN_ID, LIMITER_STATE_BACKEND, LIMITER_SNAPSHOT_FILE, LIMITER_SNAPSHOT_INTERVAL,
+        BROADCAST_RATE, BROADCAST_CONCURRENCY
+    )
     from webhook_cryptopay import start_webhook
+    from utils.crypto_pay import start_session as start_crypto_pay, close_session as close_crypto_pay
+    from utils.limiter import FileSnapshotBackend, MemoryBackend, LimiterSnapshotter
+    from utils.broadcast import Broadcaster
+    from utils.payment_inbox import PaymentInbox
     
     # Оптимизированные настройки HTTP клиента
     # Увеличиваем пул соединений для многопользовательского режима
@@ -2399,9 +2540,12 @@ def main():
         .build()
     )
     
+    # === Локализация: компиляция каталогов и отчёт о недостающих ключах ===
+    compile_locales()
+    
     # === Инициализация новых модулей ===
     sub_manager = SubscriptionManager(data_dir='data')
-    rate_limiter_new = RateLimiter()
+    rate_limiter_new = RateLimiter(name='rate_limiter')
     error_monitor = ErrorMonitor(
         admin_ids=[ADMIN_ID, ADMIN_OPERATOR_ID],
         log_dir='logs'
@@ -2412,17 +2556,72 @@ def main():
     application.bot_data['rate_limiter'] = rate_limiter_new
     application.bot_data['error_monitor'] = error_monitor
     
+    # Фоновые рассылки; пользователи, заблокировавшие бота, удаляются из каталога
+    broadcaster = Broadcaster(
+        application.bot,
+        data_dir='data',
+        rate=BROADCAST_RATE,
+        concurrency=BROADCAST_CONCURRENCY,
+        on_blocked=get_db().delete_users
+    )
+    application.bot_data['broadcaster'] = broadcaster
+    
+    # Оплаты из вебхука CryptoPay: запись в БД, выдача подписки (та же таблица subscriptions,
+    # что и у оплаты звёздами) и уведомление через пул соединений бота — в фоне
+    payment_inbox = PaymentInbox(get_async_db(), application.bot)
+    application.bot_data['payment_inbox'] = payment_inbox
+    
+    # === Состояние антифлуда и лимитов между перезапусками ===
+    if LIMITER_STATE_BACKEND == "snapshot":
+        limiter_backend = FileSnapshotBackend(LIMITER_SNAPSHOT_FILE)
+    else:
+        limiter_backend = MemoryBackend()
+    limiter_snapshots = LimiterSnapshotter(limiter_backend, interval=LIMITER_SNAPSHOT_INTERVAL)
+    restored = limiter_snapshots.restore()
+    if restored:
+        logger.info(f"Восстановлено состояние ограничителей: {restored} записей")
+    limiter_snapshots.start()
+    
     # === Post init для запуска webhook ===
     async def post_init(app):
         import asyncio
+        # Сначала события, не обработанные до остановки, затем приём новых
+        app.bot_data['payment_inbox'].start()
         asyncio.create_task(start_webhook(
-            app.bot_data['sub_manager'],
-            app.bot,
+            app.bot_data['payment_inbox'],
             port=8443
         ))
+        # Незавершённые рассылки продолжаются с места остановки
+        app.bot_data['broadcaster'].resume()
+        # Пул соединений с Crypto Pay API на всё время работы бота
+        await start_crypto_pay()
     
     application.post_init = post_init
     
+    def flush_pending_writes():
+        """Сбросить отложенные записи (БД, подписки, JSON-файлы, ограничители) перед остановкой"""
+        # Рассылка и монитор ошибок останавливаются до сброса JSON — их состояние попадёт на диск
+        broadcaster.close()
+        error_monitor.close()
+        payment_inbox.close()
+        json_store.flush()
+        limiter_snapshots.close()
+        sub_manager.close()
+        db = get_db()
+        rows = db.write_buffer.pending
+        db.write_buffer.close()
+        stats = db.write_buffer.get_stats()
+        logger.info(
+            f"Отложенная запись: сброшено {rows} строк при остановке, "
+            f"всего {stats['rows']} ({stats['rows_per_sec']} строк/с)"
+        )
+    
+    async def post_shutdown(app):
+        flush_pending_writes()
+        await close_crypto_pay()
+    
+    application.post_shutdown = post_shutdown
+    
     # === Graceful shutdown ===
     is_shutting_down = False
     
@@ -2432,6 +2631,8 @@ def main():
             return
         is_shutting_down = True
         logger.info(f"Получен сигнал {sig}. Завершение работы...")
+        flush_pending_writes()
+        await close_crypto_pay()
     
     loop = asyncio.get_event_loop()
     for sig in (signal.SIGTERM, signal.SIGINT):
@@ -2443,6 +2644,9 @@ def main():
         except NotImplementedError:
             pass  # Windows не поддерживает signal handlers
     
+    # Допуск апдейтов (бан, тех. работы, флуд, спам, лимит тарифа) — до всех хендлеров
+    application.add_handler(TypeHandler(Update, admission_middleware), group=-1)
+    
     # Команды
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -2457,8 +2661,10 @@ def main():
     application.add_handler(CommandHandler("ban", ban_command))
     application.add_handler(CommandHandler("unban", unban_command))
     application.add_handler(CommandHandler("banlist", banlist_command))
+    application.add_handler(CommandHandler("reloadlists", reloadlists_command))
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("topusers", topusers_command))
+    application.add_handler(CommandHandler("rebuildstats", rebuildstats_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
     application.add_handler(CommandHandler("maintenance", maintenance_command))
     
@@ -2477,6 +2683,12 @@ def main():
     application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment))
     
+    # Гистограммы времени по каждому хендлеру (/metrics на порту вебхука, /stats)
+    performance_monitor.instrument(application)
+    
+    # Необработанные исключения — в ErrorMonitor (хендлер не ждёт ни диска, ни алертов)
+    application.add_error_handler(error_handler)
+    
     # Запускаем бота с оптимизированными настройками
     logger.info("Бот запущен с оптимизациями для 300+ пользователей!")
     application.run_polling(
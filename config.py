@@ -36,6 +36,27 @@ MAX_FILE_SIZE_MB = 20
 # Интервал проверки приложений (в секундах)
 APP_CHECK_INTERVAL = 1800  # 30 минут
 
+# Отложенная запись логов генераций и активности в БД:
+# сброс каждые DB_WRITE_FLUSH_INTERVAL секунд или при накоплении DB_WRITE_BATCH_SIZE строк
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "500"))
+DB_WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "1.0"))
+
+# Состояние антифлуда и лимитов между перезапусками:
+# "snapshot" — бинарный снимок в LIMITER_SNAPSHOT_FILE каждые LIMITER_SNAPSHOT_INTERVAL секунд,
+# "memory" — только в памяти процесса
+LIMITER_STATE_BACKEND = os.getenv("LIMITER_STATE_BACKEND", "snapshot")
+LIMITER_SNAPSHOT_FILE = os.getenv("LIMITER_SNAPSHOT_FILE", "data/limiter_state.bin")
+LIMITER_SNAPSHOT_INTERVAL = float(os.getenv("LIMITER_SNAPSHOT_INTERVAL", "5"))
+
+# Рассылки (/broadcast, уведомления о тех. работах): сообщений в секунду
+# (глобальный лимит Telegram ~30/с) и число одновременных отправок
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+
+# Crypto Pay API: таймаут одной попытки (сек) и число повторов при сетевых ошибках и 5xx
+CRYPTO_PAY_TIMEOUT = float(os.getenv("CRYPTO_PAY_TIMEOUT", "10"))
+CRYPTO_PAY_RETRIES = int(os.getenv("CRYPTO_PAY_RETRIES", "3"))
+
 # Пути
 TEMPLATES_DIR = "templates"
 DOCUMENTS_DIR = "templates/documents"
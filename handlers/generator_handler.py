@@ -48,8 +48,7 @@ from utils.subscription import (
     get_user_subscription,
     set_user_subscription,
     get_user_limits,
-    check_limit,
-    increment_usage,
+    consume_quota_async,
     format_subscription_info,
     format_plans_list,
     get_plan_details,
@@ -57,6 +56,7 @@ from utils.subscription import (
     SUBSCRIPTION_PLANS
 )
 
+from utils.database import get_db
 from utils.crypto_pay import (
     create_subscription_invoice,
     check_invoice,
@@ -71,6 +71,17 @@ from utils.crypto_pay import (
 (ADDRESS_MENU, CARD_MENU, ANTIDETECT_MENU, SUBSCRIPTION_MENU) = range(100, 104)
 
 
+async def _show_limit_reached(query, used: int, limit: int, unit: str):
+    """Сообщение о достижении дневного лимита"""
+    await query.edit_message_text(
+        f"❌ **Достигнут дневной лимит**\n\n"
+        f"Использовано: {used}/{limit} {unit}\n\n"
+        f"Для увеличения лимита приобретите подписку.",
+        reply_markup=get_after_generation_keyboard(),
+        parse_mode="Markdown"
+    )
+
+
 # === Генератор адресов ===
 async def address_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Меню генератора адресов"""
@@ -115,18 +126,6 @@ async def address_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return SUBSCRIPTION_MENU
     
-    # Проверяем лимиты
-    can_use, used, limit = check_limit(user_id, "addresses")
-    if not can_use:
-        await query.edit_message_text(
-            f"❌ **Достигнут дневной лимит**\n\n"
-            f"Использовано: {used}/{limit} адресов\n\n"
-            f"Для увеличения лимита приобретите подписку.",
-            reply_markup=get_after_generation_keyboard(),
-            parse_mode="Markdown"
-        )
-        return ADDRESS_MENU
-    
     # Генерация адреса
     if data.startswith("addr_"):
         country_code = data.replace("addr_", "").replace("copy_", "")
@@ -135,12 +134,16 @@ async def address_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             country_code = random.choice(list(ADDRESS_DATA.keys()))
         
         if country_code in ADDRESS_DATA:
+            # Проверяем лимит и списываем использование одной операцией
+            allowed, used, limit = await consume_quota_async(user_id, "addresses")
+            if not allowed:
+                await _show_limit_reached(query, used, limit, "адресов")
+                return ADDRESS_MENU
+            
             address = generate_address(country_code)
+            get_db().log_generation(user_id, "addresses")
             context.user_data['last_address'] = address
             
-            # Увеличиваем счётчик
-            increment_usage(user_id, "addresses")
-            
             text = format_address(address)
             
             await query.edit_message_text(
@@ -201,18 +204,6 @@ async def card_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return SUBSCRIPTION_MENU
     
-    # Проверяем лимиты
-    can_use, used, limit = check_limit(user_id, "cards")
-    if not can_use:
-        await query.edit_message_text(
-            f"❌ **Достигнут дневной лимит**\n\n"
-            f"Использовано: {used}/{limit} карт\n\n"
-            f"Для увеличения лимита приобретите подписку.",
-            reply_markup=get_after_generation_keyboard(),
-            parse_mode="Markdown"
-        )
-        return CARD_MENU
-    
     # Генерация карты
     if data.startswith("card_"):
         card_type = data.replace("card_", "").replace("copy_", "")
@@ -221,12 +212,16 @@ async def card_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             card_type = random.choice(list(CARD_BINS.keys()))
         
         if card_type in CARD_BINS:
+            # Проверяем лимит и списываем использование одной операцией
+            allowed, used, limit = await consume_quota_async(user_id, "cards")
+            if not allowed:
+                await _show_limit_reached(query, used, limit, "карт")
+                return CARD_MENU
+            
             card = generate_card(card_type)
+            get_db().log_generation(user_id, "cards")
             context.user_data['last_card'] = card
             
-            # Увеличиваем счётчик
-            increment_usage(user_id, "cards")
-            
             text = format_card(card)
             
             await query.edit_message_text(
@@ -289,19 +284,7 @@ async def antidetect_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return SUBSCRIPTION_MENU
     
-    # Проверяем лимиты
-    can_use, used, limit = check_limit(user_id, "antidetect")
-    if not can_use:
-        await query.edit_message_text(
-            f"❌ **Достигнут дневной лимит**\n\n"
-            f"Использовано: {used}/{limit} профилей\n\n"
-            f"Для увеличения лимита приобретите подписку.",
-            reply_markup=get_after_generation_keyboard(),
-            parse_mode="Markdown"
-        )
-        return ANTIDETECT_MENU
-    
-    # Экспорт в JSON
+    # Экспорт в JSON — уже сгенерированного (и списанного) профиля, лимит не проверяется
     if data.startswith("antidetect_export_"):
         profile = context.user_data.get('last_antidetect_profile')
         if profile:
@@ -334,12 +317,16 @@ async def antidetect_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             platforms = ["chrome_win", "chrome_mac", "firefox_win", "safari_mac", "mobile_android", "mobile_ios"]
             platform = random.choice(platforms)
         
+        # Проверяем лимит и списываем использование одной операцией
+        allowed, used, limit = await consume_quota_async(user_id, "antidetect")
+        if not allowed:
+            await _show_limit_reached(query, used, limit, "профилей")
+            return ANTIDETECT_MENU
+        
         profile = generate_antidetect_profile(platform)
+        get_db().log_generation(user_id, "antidetect")
         context.user_data['last_antidetect_profile'] = profile
         
-        # Увеличиваем счётчик
-        increment_usage(user_id, "antidetect")
-        
         text = format_antidetect_profile(profile)
         
         await query.edit_message_text(
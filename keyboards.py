@@ -3,14 +3,66 @@
 Все меню - inline кнопки с навигацией назад
 """
 
+import functools
+import inspect
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from utils.localization import get_text, t
+from utils.localization import get_text, t, get_user_language, on_locales_reload, DEFAULT_LANGUAGE
 
 # Ссылка на канал проекта
 PROJECT_CHANNEL = "https://t.me/+VGUeNxCWYLEzYzU0"
 
 
+# === Кэш клавиатур ===
+# Разметка зависит только от языка и параметров клавиатуры, а не от пользователя:
+# (имя, язык, параметры) -> готовый InlineKeyboardMarkup (объекты PTB неизменяемы)
+_keyboard_cache = {}
+KEYBOARD_CACHE_SIZE = 2048
+
+
+@on_locales_reload
+def clear_keyboard_cache():
+    """Сброс кэша клавиатур (вызывается при перезагрузке локалей)"""
+    _keyboard_cache.clear()
+
+
+def cached_keyboard(func):
+    """Кэширует клавиатуру по (имя, язык пользователя, остальные аргументы)"""
+    params = list(inspect.signature(func).parameters)
+    user_pos = params.index("user_id") if "user_id" in params else None
+    name = func.__name__
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        user_id = kwargs.get("user_id")
+        key_args = args
+        if user_pos is not None and len(args) > user_pos:
+            user_id = args[user_pos]
+            key_args = args[:user_pos] + args[user_pos + 1:]
+        
+        if user_pos is None:
+            lang = None
+        elif user_id is None:
+            lang = DEFAULT_LANGUAGE
+        else:
+            lang = get_user_language(user_id)
+        
+        key_kwargs = tuple(sorted((k, v) for k, v in kwargs.items() if k != "user_id"))
+        key = (name, lang, key_args, key_kwargs)
+        
+        markup = _keyboard_cache.get(key)
+        if markup is None:
+            markup = func(*args, **kwargs)
+            if len(_keyboard_cache) >= KEYBOARD_CACHE_SIZE:
+                _keyboard_cache.clear()
+            _keyboard_cache[key] = markup
+        return markup
+    
+    return wrapper
+
+
 # === ГЛАВНОЕ МЕНЮ (inline кнопки) ===
+@cached_keyboard
 def get_main_menu_keyboard(user_id=None):
     """Главное меню - inline кнопки"""
     keyboard = [
@@ -23,6 +75,7 @@ def get_main_menu_keyboard(user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_language_selection_keyboard():
     """Выбор языка при первом запуске (inline)"""
     keyboard = [
@@ -34,6 +87,7 @@ def get_language_selection_keyboard():
 
 
 # === ПОДМЕНЮ ИНСТРУМЕНТЫ ===
+@cached_keyboard
 def get_tools_menu_keyboard(user_id=None):
     """Подменю инструментов"""
     keyboard = [
@@ -46,6 +100,7 @@ def get_tools_menu_keyboard(user_id=None):
 
 
 # === ПОДМЕНЮ ГЕНЕРАТОРЫ ===
+@cached_keyboard
 def get_generators_menu_keyboard(user_id=None):
     """Подменю генераторов"""
     keyboard = [
@@ -65,6 +120,7 @@ def get_generators_menu_keyboard(user_id=None):
 
 
 # === ПОДМЕНЮ НАСТРОЙКИ ===
+@cached_keyboard
 def get_settings_menu_keyboard(user_id=None):
     """Подменю настроек"""
     keyboard = [
@@ -77,6 +133,7 @@ def get_settings_menu_keyboard(user_id=None):
 
 
 # === Уникализатор ===
+@cached_keyboard
 def get_uniqualizer_menu_keyboard(user_id=None):
     """Меню уникализатора"""
     keyboard = [
@@ -88,6 +145,7 @@ def get_uniqualizer_menu_keyboard(user_id=None):
 
 
 # === Клавиатура настроек уникализатора ===
+@cached_keyboard
 def get_uniqualizer_settings_keyboard(user_id=None):
     """Клавиатура выбора настроек уникализации"""
     keyboard = [
@@ -98,6 +156,7 @@ def get_uniqualizer_settings_keyboard(user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_variation_count_keyboard(media_type="photo", user_id=None):
     """Клавиатура выбора количества вариаций"""
     prefix = f"var_{media_type}_"
@@ -125,6 +184,7 @@ def get_variation_count_keyboard(media_type="photo", user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_video_format_keyboard(user_id=None):
     """Клавиатура выбора формата видео"""
     keyboard = [
@@ -142,6 +202,7 @@ def get_video_format_keyboard(user_id=None):
 
 
 # === EXIF редактор ===
+@cached_keyboard
 def get_exif_menu_keyboard(user_id=None):
     """Меню EXIF редактора"""
     keyboard = [
@@ -154,6 +215,7 @@ def get_exif_menu_keyboard(user_id=None):
 
 
 # === Генератор селфи ===
+@cached_keyboard
 def get_selfie_menu_keyboard(user_id=None):
     """Меню генератора селфи"""
     keyboard = [
@@ -164,6 +226,7 @@ def get_selfie_menu_keyboard(user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_selfie_again_keyboard(user_id=None):
     """Кнопка сделать ещё селфи"""
     keyboard = [
@@ -174,6 +237,7 @@ def get_selfie_again_keyboard(user_id=None):
 
 
 # === Чекер Google Play ===
+@cached_keyboard
 def get_gplay_menu_keyboard(user_id=None):
     """Меню чекера Google Play"""
     keyboard = [
@@ -185,6 +249,7 @@ def get_gplay_menu_keyboard(user_id=None):
 
 
 # === Генератор адресов ===
+@cached_keyboard
 def get_address_menu_keyboard(user_id=None):
     """Меню генератора адресов"""
     keyboard = [
@@ -200,6 +265,7 @@ def get_address_menu_keyboard(user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_address_again_keyboard(country_code, user_id=None):
     """Кнопка сгенерировать ещё адрес"""
     keyboard = [
@@ -210,6 +276,7 @@ def get_address_again_keyboard(country_code, user_id=None):
 
 
 # === Генератор карт ===
+@cached_keyboard
 def get_card_menu_keyboard(user_id=None):
     """Меню генератора карт"""
     keyboard = [
@@ -223,6 +290,7 @@ def get_card_menu_keyboard(user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_card_again_keyboard(card_type, user_id=None):
     """Кнопка сгенерировать ещё карту"""
     keyboard = [
@@ -233,6 +301,7 @@ def get_card_again_keyboard(card_type, user_id=None):
 
 
 # === Антидетект данные ===
+@cached_keyboard
 def get_antidetect_menu_keyboard(user_id=None):
     """Меню антидетект данных"""
     keyboard = [
@@ -248,6 +317,7 @@ def get_antidetect_menu_keyboard(user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_antidetect_again_keyboard(platform, user_id=None):
     """Кнопка сгенерировать ещё профиль"""
     keyboard = [
@@ -259,6 +329,7 @@ def get_antidetect_again_keyboard(platform, user_id=None):
 
 
 # === Подписки ===
+@cached_keyboard
 def get_subscription_menu_keyboard(user_id=None):
     """Меню подписок"""
     keyboard = [
@@ -274,6 +345,7 @@ def get_subscription_menu_keyboard(user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_subscription_buy_keyboard(plan_id, price_usd, price_stars, user_id=None):
     """Кнопки покупки подписки"""
     keyboard = [
@@ -284,6 +356,7 @@ def get_subscription_buy_keyboard(plan_id, price_usd, price_stars, user_id=None)
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_crypto_currency_keyboard(plan_id, user_id=None):
     """Выбор криптовалюты для оплаты"""
     keyboard = [
@@ -307,6 +380,7 @@ def get_payment_link_keyboard(pay_url, plan_id, user_id=None):
 
 
 # === Язык ===
+@cached_keyboard
 def get_language_keyboard(user_id=None):
     """Выбор языка в настройках"""
     keyboard = [
@@ -319,6 +393,7 @@ def get_language_keyboard(user_id=None):
 
 
 # === Общие кнопки ===
+@cached_keyboard
 def get_after_generation_keyboard(user_id=None):
     """Кнопки после генерации"""
     keyboard = [
@@ -332,6 +407,7 @@ def get_ad_buttons_keyboard(user_id=None):
     return get_after_generation_keyboard(user_id)
 
 
+@cached_keyboard
 def get_back_keyboard(callback_data="back_main", user_id=None):
     """Кнопка назад"""
     keyboard = [
@@ -340,6 +416,7 @@ def get_back_keyboard(callback_data="back_main", user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_cancel_keyboard(user_id=None):
     """Кнопка отмены"""
     keyboard = [
@@ -349,6 +426,7 @@ def get_cancel_keyboard(user_id=None):
 
 
 # === Скачать TikTok ===
+@cached_keyboard
 def get_tiktok_menu_keyboard(user_id=None):
     """Меню скачивания TikTok"""
     keyboard = [
@@ -360,6 +438,7 @@ def get_tiktok_menu_keyboard(user_id=None):
 
 
 # === Mimesis генераторы ===
+@cached_keyboard
 def get_mgen_again_keyboard(gen_type, user_id=None):
     """Кнопка сгенерировать ещё"""
     keyboard = [
@@ -370,6 +449,7 @@ def get_mgen_again_keyboard(gen_type, user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_mgen_address_country_keyboard(user_id=None):
     """Выбор страны для адреса"""
     keyboard = [
@@ -388,6 +468,7 @@ def get_mgen_address_country_keyboard(user_id=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_mgen_card_type_keyboard(user_id=None):
     """Выбор типа карты"""
     keyboard = [
@@ -419,6 +500,7 @@ def get_trx_menu_keyboard():
 
 
 # === АДМИН-ПАНЕЛЬ ===
+@cached_keyboard
 def get_admin_panel_keyboard():
     """Главное меню админ-панели"""
     keyboard = [
@@ -434,6 +516,7 @@ def get_admin_panel_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_admin_vip_keyboard():
     """Меню VIP управления"""
     keyboard = [
@@ -445,6 +528,7 @@ def get_admin_vip_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_admin_ban_keyboard():
     """Меню бан управления"""
     keyboard = [
@@ -456,6 +540,7 @@ def get_admin_ban_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
 def get_admin_maintenance_keyboard():
     """Меню maintenance"""
     keyboard = [
@@ -466,9 +551,84 @@ def get_admin_maintenance_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_keyboard
+def get_admin_antiflood_keyboard():
+    """Меню настроек антифлуда"""
+    keyboard = [
+        [InlineKeyboardButton("➕ Лимит +10", callback_data="antiflood_increase"),
+         InlineKeyboardButton("➖ Лимит -10", callback_data="antiflood_decrease")],
+        [InlineKeyboardButton("⏱ 30 сек", callback_data="antiflood_ban_30"),
+         InlineKeyboardButton("⏱ 60 сек", callback_data="antiflood_ban_60"),
+         InlineKeyboardButton("⏱ 5 мин", callback_data="antiflood_ban_300")],
+        [InlineKeyboardButton("🔄 Сбросить баны", callback_data="antiflood_reset")],
+        [InlineKeyboardButton("✅ Включить", callback_data="antiflood_enable"),
+         InlineKeyboardButton("❌ Выключить", callback_data="antiflood_disable")],
+        [InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+@cached_keyboard
 def get_admin_back_keyboard():
     """Кнопка назад в админ-панель"""
     keyboard = [
         [InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]
     ]
     return InlineKeyboardMarkup(keyboard)
+
+
+if __name__ == "__main__":
+    # Навигация по меню, как в main_callback_handler: клавиатуры с кэшем и без (func.__wrapped__).
+    # Кэш отдаёт один и тот же объект для (имя, язык, параметры), разный для разных языков
+    # и сбрасывается при перезагрузке локалей. python keyboards.py [переходов]
+    import os
+    import sys
+    import time
+    import tempfile
+    
+    from utils import localization
+    
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    localization.USER_SETTINGS_FILE = os.path.join(tempfile.mkdtemp(), "user_settings.json")
+    users = {1: "ru", 2: "en", 3: "ua"}
+    for user_id, lang in users.items():
+        localization.set_user_language(user_id, lang)
+    
+    # Переходы по кнопкам: главное меню, разделы, подменю с параметрами, «назад»
+    navigation = [
+        (get_main_menu_keyboard, ()),
+        (get_tools_menu_keyboard, ()),
+        (get_uniqualizer_menu_keyboard, ()),
+        (get_variation_count_keyboard, ("photo",)),
+        (get_generators_menu_keyboard, ()),
+        (get_address_again_keyboard, ("US",)),
+        (get_card_again_keyboard, ("visa",)),
+        (get_subscription_menu_keyboard, ()),
+        (get_settings_menu_keyboard, ()),
+        (get_language_keyboard, ()),
+        (get_back_keyboard, ("back_main",)),
+    ]
+    
+    def run(name, uncached):
+        started = time.perf_counter()
+        for i in range(steps):
+            func, args = navigation[i % len(navigation)]
+            if uncached:
+                func = func.__wrapped__
+            func(*args, user_id=1 + i % len(users))
+        per_step = (time.perf_counter() - started) / steps * 1e6
+        print(f"{name}: {per_step:.2f} мкс на клавиатуру")
+        return per_step
+    
+    uncached = run("без кэша", True)
+    cached = run("с кэшем", False)
+    
+    same_object = get_main_menu_keyboard(user_id=1) is get_main_menu_keyboard(user_id=1)
+    per_language = len({id(get_main_menu_keyboard(user_id=user_id)) for user_id in users}) == len(users)
+    per_params = get_card_again_keyboard("visa", user_id=1) is not get_card_again_keyboard("mastercard", user_id=1)
+    before_reload = get_main_menu_keyboard(user_id=1)
+    localization.compile_locales()
+    reloaded = get_main_menu_keyboard(user_id=1) is not before_reload
+    print(f"один объект на ключ: {same_object}, по языкам: {per_language}, по параметрам: {per_params}, "
+          f"сброс при перезагрузке локалей: {reloaded}, в кэше {len(_keyboard_cache)}")
+    sys.exit(0 if same_object and per_language and per_params and reloaded and cached < uncached else 1)
@@ -2,13 +2,17 @@
 Утилиты для администрирования бота
 """
 
-import json
 import os
+import json
 import logging
+import threading
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set
 from dotenv import load_dotenv
 
+from utils import json_store
+from utils.database import get_db
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -30,83 +34,93 @@ if ADMIN_OPERATOR_ID not in ADMIN_IDS:
     ADMIN_IDS.append(ADMIN_OPERATOR_ID)
 
 
-def _ensure_data_dir():
-    """Создаёт директорию data если её нет"""
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
-
-
 def _load_json(filepath: str, default: dict = None) -> dict:
-    """Загружает JSON файл"""
-    _ensure_data_dir()
-    if default is None:
-        default = {}
-    
-    if not os.path.exists(filepath):
-        return default
-    
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        return default
+    """Загружает JSON файл (из кэша utils/json_store; результат не изменять)"""
+    return json_store.read(filepath, default if default is not None else {})
 
 
 def _save_json(filepath: str, data: dict) -> bool:
-    """Сохраняет JSON файл"""
-    _ensure_data_dir()
-    
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        return True
-    except IOError as e:
-        logger.error(f"Ошибка сохранения {filepath}: {e}")
-        return False
+    """Сохраняет JSON файл атомарно"""
+    return json_store.write(filepath, data)
 
 
 # === Система бана ===
 
+# Конвейер допуска (utils/admission.py) спрашивает бан на каждом апдейте, поэтому
+# ID забаненных держатся во множестве в памяти: is_banned — просто поиск в множестве.
+# Множество меняется вместе с файлом в ban_user/unban_user (запись сразу и атомарно),
+# перечитать файл после ручной правки — reload_banned() (команда /reloadlists)
+
+def _get_banned() -> Dict[str, Dict]:
+    """Словарь банов (только чтение)"""
+    return _load_json(BANNED_FILE, {"banned_users": {}}).get("banned_users", {})
+
+
+def _get_bot_state() -> Dict[str, Any]:
+    """Состояние бота (только чтение)"""
+    return _load_json(BOT_STATE_FILE, {})
+
+
+def _load_banned_ids() -> Set[int]:
+    return {int(uid) for uid in _get_banned() if uid.lstrip("-").isdigit()}
+
+
+# Загружается один раз при старте
+_banned_ids: Set[int] = _load_banned_ids()
+
+
+def reload_banned() -> int:
+    """Перечитывает бан-лист с диска. Returns: количество забаненных"""
+    global _banned_ids
+    json_store.invalidate(BANNED_FILE)
+    _banned_ids = _load_banned_ids()
+    return len(_banned_ids)
+
+
+def _resync_banned_ids():
+    """Файл не записан и изменение откатано — множество снова строится по бан-листу"""
+    global _banned_ids
+    _banned_ids = _load_banned_ids()
+
+
 def is_banned(user_id: int) -> bool:
     """Проверяет, забанен ли пользователь"""
-    data = _load_json(BANNED_FILE, {"banned_users": {}})
-    return str(user_id) in data.get("banned_users", {})
+    return user_id in _banned_ids
 
 
 def ban_user(user_id: int, banned_by: int, reason: str = None) -> bool:
     """Банит пользователя"""
-    data = _load_json(BANNED_FILE, {"banned_users": {}})
-    
-    if "banned_users" not in data:
-        data["banned_users"] = {}
-    
-    data["banned_users"][str(user_id)] = {
-        "banned_at": datetime.now().isoformat(),
-        "banned_by": banned_by,
-        "reason": reason
-    }
+    def mutate(data):
+        data.setdefault("banned_users", {})[str(user_id)] = {
+            "banned_at": datetime.now().isoformat(),
+            "banned_by": banned_by,
+            "reason": reason
+        }
+        _banned_ids.add(int(user_id))
+        return True
     
-    return _save_json(BANNED_FILE, data)
+    banned, saved = json_store.update(BANNED_FILE, mutate, {"banned_users": {}})
+    if not saved:
+        _resync_banned_ids()
+    return banned and saved
 
 
 def unban_user(user_id: int) -> bool:
     """Разбанивает пользователя"""
-    data = _load_json(BANNED_FILE, {"banned_users": {}})
+    def mutate(data):
+        _banned_ids.discard(int(user_id))
+        return data.get("banned_users", {}).pop(str(user_id), None) is not None
     
-    if str(user_id) in data.get("banned_users", {}):
-        del data["banned_users"][str(user_id)]
-        return _save_json(BANNED_FILE, data)
-    
-    return False
+    unbanned, saved = json_store.update(BANNED_FILE, mutate, {"banned_users": {}})
+    if not saved:
+        _resync_banned_ids()
+    return unbanned and saved
 
 
 def get_banned_list() -> List[Dict]:
     """Получает список забаненных пользователей"""
-    data = _load_json(BANNED_FILE, {"banned_users": {}})
-    banned = data.get("banned_users", {})
-    
     result = []
-    for user_id, info in banned.items():
+    for user_id, info in list(_get_banned().items()):
         result.append({
             "user_id": int(user_id),
             "banned_at": info.get("banned_at"),
@@ -121,23 +135,24 @@ def get_banned_list() -> List[Dict]:
 
 def is_maintenance_mode() -> bool:
     """Проверяет, включен ли режим обслуживания"""
-    data = _load_json(BOT_STATE_FILE, {"maintenance": False})
-    return data.get("maintenance", False)
+    return _get_bot_state().get("maintenance", False)
 
 
 def set_maintenance_mode(enabled: bool, message: str = None) -> bool:
     """Устанавливает режим обслуживания"""
-    data = _load_json(BOT_STATE_FILE, {})
-    data["maintenance"] = enabled
-    data["maintenance_message"] = message or "🔧 Бот на техническом обслуживании. Пожалуйста, подождите."
-    data["maintenance_updated"] = datetime.now().isoformat()
-    return _save_json(BOT_STATE_FILE, data)
+    def mutate(data):
+        data["maintenance"] = enabled
+        data["maintenance_message"] = message or "🔧 Бот на техническом обслуживании. Пожалуйста, подождите."
+        data["maintenance_updated"] = datetime.now().isoformat()
+        return True
+    
+    changed, saved = json_store.update(BOT_STATE_FILE, mutate, {})
+    return changed and saved
 
 
 def get_maintenance_message() -> str:
     """Получает сообщение о режиме обслуживания"""
-    data = _load_json(BOT_STATE_FILE, {})
-    custom_msg = data.get("maintenance_message", "")
+    custom_msg = _get_bot_state().get("maintenance_message", "")
     
     default_msg = (
         "🔧 **Технические работы**\n\n"
@@ -150,83 +165,98 @@ def get_maintenance_message() -> str:
 
 # === Управление пользователями ===
 
-def register_user(user_id: int, username: str = None, first_name: str = None, language: str = "ru"):
-    """Регистрирует нового пользователя"""
-    data = _load_json(USERS_FILE, {"users": {}})
-    
-    if "users" not in data:
-        data["users"] = {}
+# Каталог пользователей хранится в таблице users (utils/database.py): /start только кладёт
+# профиль в буфер отложенной записи, в БД он попадает пачкой вместе с активностью.
+# Старый data/users.json однократно переносится в таблицу при первом обращении
+
+# Ключ в таблице meta, отмечающий завершённый перенос users.json в SQLite
+_USERS_MIGRATION_KEY = "users_json_migrated"
+_users_ready = False
+_users_lock = threading.Lock()
+
+
+def _get_users_db():
+    """БД с каталогом пользователей (при первом обращении переносит users.json)"""
+    global _users_ready
+    db = get_db()
+    if not _users_ready:
+        with _users_lock:
+            if not _users_ready:
+                _migrate_users_json(db)
+                _users_ready = True
+    return db
+
+
+def _migrate_users_json(db):
+    """Однократный перенос пользователей из старого users.json"""
+    if db.get_meta(_USERS_MIGRATION_KEY):
+        return
     
-    user_key = str(user_id)
+    if os.path.exists(USERS_FILE):
+        try:
+            with open(USERS_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"Не удалось прочитать {USERS_FILE} для миграции: {e}")
+            return
     
-    if user_key not in data["users"]:
-        data["users"][user_key] = {
-            "registered_at": datetime.now().isoformat(),
-            "username": username,
-            "first_name": first_name,
-            "language": language,
-            "last_active": datetime.now().isoformat()
-        }
-    else:
-        # Обновляем данные
-        data["users"][user_key]["username"] = username
-        data["users"][user_key]["first_name"] = first_name
-        data["users"][user_key]["last_active"] = datetime.now().isoformat()
+        if isinstance(data, dict):
+            count = db.import_users_json(data)
+            logger.info(f"users.json перенесён в SQLite: {count} пользователей")
     
-    _save_json(USERS_FILE, data)
+    db.set_meta(_USERS_MIGRATION_KEY, datetime.now().isoformat())
+
+
+def register_user(user_id: int, username: str = None, first_name: str = None, language: str = "ru"):
+    """Регистрирует пользователя или обновляет его данные и активность (отложенная запись)"""
+    _get_users_db().register_user(user_id, username, first_name, language)
 
 
 def get_user_info(user_id: int) -> Optional[Dict]:
     """Получает информацию о пользователе"""
-    data = _load_json(USERS_FILE, {"users": {}})
-    return data.get("users", {}).get(str(user_id))
+    row = _get_users_db().get_user(user_id)
+    if row is None:
+        return None
+    
+    return {
+        "registered_at": row["first_seen"],
+        "username": row["username"],
+        "first_name": row["first_name"],
+        "language": row["language"],
+        "last_active": row["last_active"]
+    }
 
 
 def get_all_users() -> List[int]:
     """Получает список всех ID пользователей"""
-    data = _load_json(USERS_FILE, {"users": {}})
-    return [int(uid) for uid in data.get("users", {}).keys()]
+    return _get_users_db().get_all_user_ids()
 
 
 def get_users_count() -> int:
     """Получает количество пользователей"""
-    data = _load_json(USERS_FILE, {"users": {}})
-    return len(data.get("users", {}))
+    return _get_users_db().get_total_users()
 
 
 def get_active_users_today() -> int:
     """Получает количество активных пользователей за сегодня"""
-    data = _load_json(USERS_FILE, {"users": {}})
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    count = 0
-    for user_data in data.get("users", {}).values():
-        last_active = user_data.get("last_active", "")
-        if last_active.startswith(today):
-            count += 1
-    
-    return count
+    return _get_users_db().get_active_users_today()
 
 
 # === Статистика ===
 
 def get_bot_stats() -> Dict[str, Any]:
     """Получает общую статистику бота"""
-    from utils.subscription import load_subscriptions, SUBSCRIPTION_PLANS
+    from utils.subscription import get_plan_counts, get_usage_totals
     
-    users_data = _load_json(USERS_FILE, {"users": {}})
-    subs_data = load_subscriptions()
-    
-    total_users = len(users_data.get("users", {}))
+    total_users = get_users_count()
     active_today = get_active_users_today()
     
-    # Подсчёт подписок
+    # Подсчёт подписок — из сводной таблицы, без обхода всех пользователей
     subscriptions = {"free": 0, "basic": 0, "pro": 0, "premium": 0, "lifetime": 0}
     
-    for user_id, user_sub in subs_data.get("users", {}).items():
-        plan = user_sub.get("plan", "free")
+    for plan, count in get_plan_counts().items():
         if plan in subscriptions:
-            subscriptions[plan] += 1
+            subscriptions[plan] = count
     
     # VIP из вайтлиста
     try:
@@ -236,40 +266,30 @@ def get_bot_stats() -> Dict[str, Any]:
         vip_count = 0
     
     # Забаненные
-    banned_data = _load_json(BANNED_FILE, {"banned_users": {}})
-    banned_count = len(banned_data.get("banned_users", {}))
+    banned_count = len(_banned_ids)
     
     return {
         "total_users": total_users,
         "active_today": active_today,
         "subscriptions": subscriptions,
         "vip_count": vip_count,
-        "banned_count": banned_count
+        "banned_count": banned_count,
+        "usage_today": get_usage_totals()
     }
 
 
 def get_top_users(limit: int = 10) -> List[Dict]:
     """Получает топ активных пользователей по использованию"""
-    from utils.subscription import load_subscriptions
-    
-    subs_data = load_subscriptions()
-    usage_data = subs_data.get("usage", {})
-    
-    # Считаем общее использование за все дни
-    user_totals = {}
-    
-    for user_id, dates in usage_data.items():
-        total = 0
-        for date, usage in dates.items():
-            total += sum(usage.values())
-        user_totals[user_id] = total
+    from utils.subscription import get_top_usage
     
-    # Сортируем и берём топ
-    sorted_users = sorted(user_totals.items(), key=lambda x: x[1], reverse=True)[:limit]
+    # Итоги за всё время ведутся в сводной таблице — читаем только топ
+    top = get_top_usage(limit)
+    if not top:
+        return []
     
     result = []
-    for user_id, total in sorted_users:
-        user_info = get_user_info(int(user_id))
+    for user_id, total in top:
+        user_info = get_user_info(user_id)
         result.append({
             "user_id": int(user_id),
             "username": user_info.get("username") if user_info else None,
@@ -277,3 +297,87 @@ def get_top_users(limit: int = 10) -> List[Dict]:
         })
     
     return result
+
+
+if __name__ == "__main__":
+    # Задержка регистрации на /start при 50k пользователей: прежнее чтение и перезапись users.json
+    # против буфера отложенной записи; однократный перенос users.json в таблицу users.
+    # Временные файлы: python -m utils.admin_utils [пользователей] [регистраций]
+    import sys
+    import time
+    import tempfile
+    
+    from utils import database
+    
+    users_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    starts = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    tmp = tempfile.mkdtemp()
+    USERS_FILE = os.path.join(tmp, "users.json")
+    now = datetime.now().isoformat()
+    legacy = {"users": {
+        str(uid): {"registered_at": now, "username": f"user{uid}", "first_name": "Имя",
+                   "language": "ru", "last_active": now}
+        for uid in range(users_count)
+    }}
+    with open(USERS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(legacy, f, ensure_ascii=False, indent=2)
+    
+    def percentiles(samples):
+        samples.sort()
+        return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+    
+    # Как было: весь файл читается и перезаписывается на каждый /start
+    legacy_samples = []
+    for i in range(10):
+        started = time.perf_counter()
+        with open(USERS_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        data["users"][str(i)]["last_active"] = datetime.now().isoformat()
+        with open(USERS_FILE + ".legacy", 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        legacy_samples.append(time.perf_counter() - started)
+    legacy_p50, legacy_p99 = percentiles(legacy_samples)
+    
+    db = database._db = database.Database(os.path.join(tmp, "bot.db"))
+    started = time.perf_counter()
+    _get_users_db()
+    migration_s = time.perf_counter() - started
+    file_stamp = os.stat(USERS_FILE).st_mtime_ns
+    
+    samples = []
+    for i in range(starts):
+        # Половина — уже известные пользователи, половина — новые
+        user_id = i if i % 2 else users_count + i
+        started = time.perf_counter()
+        register_user(user_id, f"user{user_id}", "Имя", "en")
+        samples.append(time.perf_counter() - started)
+    p50, p99 = percentiles(samples)
+    
+    started = time.perf_counter()
+    flushed = db.flush_writes()
+    flush_ms = (time.perf_counter() - started) * 1000
+    
+    total = get_users_count()
+    expected = users_count + starts // 2
+    migrated = get_user_info(2)
+    new_user = get_user_info(users_count)
+    profiles_ok = (migrated is not None and migrated["username"] == "user2" and migrated["language"] == "ru"
+                   and new_user is not None and new_user["language"] == "en")
+    untouched = os.stat(USERS_FILE).st_mtime_ns == file_stamp
+    
+    # Повторный запуск: перенос уже отмечен в meta и не повторяется
+    db.close()
+    db = database._db = database.Database(os.path.join(tmp, "bot.db"))
+    _users_ready = False
+    started = time.perf_counter()
+    _get_users_db()
+    second_start_ms = (time.perf_counter() - started) * 1000
+    
+    print(f"{users_count} пользователей в users.json ({os.path.getsize(USERS_FILE) / 2 ** 20:.1f} МиБ)")
+    print(f"чтение + перезапись файла: p50 {legacy_p50 * 1000:.0f} мс, p99 {legacy_p99 * 1000:.0f} мс")
+    print(f"register_user через буфер: p50 {p50 * 1e6:.1f} мкс, p99 {p99 * 1e6:.1f} мкс, "
+          f"остаток буфера ({flushed} записей) сброшен за {flush_ms:.1f} мс")
+    print(f"перенос users.json: {migration_s * 1000:.0f} мс, при повторном запуске {second_start_ms:.1f} мс; "
+          f"в таблице {total} из {expected}, профили верны: {profiles_ok}, файл не менялся: {untouched}")
+    db.close()
+    sys.exit(0 if total == expected and profiles_ok and untouched and p99 < 0.001 else 1)
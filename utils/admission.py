@@ -0,0 +1,395 @@
+"""
+Единый конвейер допуска апдейтов
+Бан, тех. работы, флуд, спам и лимит по тарифу проверяются в одном месте,
+до всех остальных хендлеров (TypeHandler в группе -1)
+"""
+
+import time
+import struct
+import logging
+from typing import Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop
+
+from utils.limiter import LimiterStore, TokenBucket, RepeatBucket
+from utils.security import ADMIN_IDS, anti_flood, anti_spam
+from utils.rate_limiter import RateLimiter
+from utils.subscription import get_user_subscription
+from utils.admin_utils import is_banned, is_maintenance_mode, get_maintenance_message, register_user
+
+logger = logging.getLogger(__name__)
+
+# Причины отказа
+BANNED = "banned"
+MAINTENANCE = "maintenance"
+FLOOD = "flood"
+SPAM = "spam"
+RATE = "rate"
+
+# Тарифы SUBSCRIPTION_PLANS (utils/subscription.py) → лимиты запросов RateLimiter.LIMITS
+PLAN_TIERS = {"free": "free", "basic": "pro", "pro": "pro", "premium": "unlimited", "lifetime": "unlimited"}
+
+
+class UserAdmissionState:
+    """Состояние одного пользователя для всех политик допуска (бакеты создаются по мере надобности)"""
+    
+    __slots__ = ("flood", "spam", "rate")
+    
+    def __init__(self):
+        self.flood: Optional[TokenBucket] = None  # антифлуд + бан за флуд
+        self.spam: Optional[RepeatBucket] = None  # повторы текстов за окно
+        self.rate: Optional[TokenBucket] = None  # лимит запросов по тарифу
+    
+    def is_idle(self, now: float, ttl: float) -> bool:
+        return all(b is None or b.is_idle(now, ttl) for b in (self.flood, self.spam, self.rate))
+    
+    # Снимок: маска заданных бакетов + три бакета фиксированного размера
+    STATE = struct.Struct(f'<B{TokenBucket.STATE.size}s{RepeatBucket.STATE.size}s{TokenBucket.STATE.size}s')
+    _EMPTY = (bytes(TokenBucket.STATE.size), bytes(RepeatBucket.STATE.size))
+    
+    def to_bytes(self) -> bytes:
+        flood, spam, rate = self.flood, self.spam, self.rate
+        mask = (flood is not None) | (spam is not None) << 1 | (rate is not None) << 2
+        return self.STATE.pack(
+            mask,
+            flood.to_bytes() if flood is not None else self._EMPTY[0],
+            spam.to_bytes() if spam is not None else self._EMPTY[1],
+            rate.to_bytes() if rate is not None else self._EMPTY[0],
+        )
+    
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        mask, flood, spam, rate = cls.STATE.unpack(data)
+        state = cls()
+        if mask & 1:
+            state.flood = TokenBucket.from_bytes(flood)
+        if mask & 2:
+            state.spam = RepeatBucket.from_bytes(spam)
+        if mask & 4:
+            state.rate = TokenBucket.from_bytes(rate)
+        return state
+
+
+class AdmissionController:
+    """
+    Проверяет апдейт по всем политикам за один захват блокировки
+    Параметры антифлуда/антиспама берутся из anti_flood/anti_spam,
+    поэтому настройки из админки продолжают действовать
+    """
+    
+    def __init__(self, flood=anti_flood, spam=anti_spam, plan_limits: Dict = None):
+        self.flood_config = flood
+        self.spam_config = spam
+        self.plan_limits = plan_limits or RateLimiter.LIMITS
+        self.store = LimiterStore(UserAdmissionState, name='admission')
+        self.checks = 0
+        self.rejected: Dict[str, int] = {}
+        self.total_ns = 0
+    
+    def check(
+        self,
+        user_id: int,
+        text: Optional[str] = None,
+        plan: Optional[str] = None
+    ) -> Tuple[Optional[str], object]:
+        """
+        Проверяет апдейт пользователя
+        text — текст сообщения (для антиспама), plan — тариф (для лимита запросов;
+        None — апдейт не считается запросом, например нажатие кнопки)
+        Returns: (причина отказа или None, подробности для ответа)
+        """
+        started = time.perf_counter_ns()
+        reason, detail = self._evaluate(user_id, text, plan)
+        
+        self.checks += 1
+        self.total_ns += time.perf_counter_ns() - started
+        if reason:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return reason, detail
+    
+    def _evaluate(self, user_id: int, text: Optional[str], plan: Optional[str]):
+        if user_id in ADMIN_IDS:
+            return None, None
+        
+        # Баны и тех. работы — глобальное состояние в памяти, блокировка не нужна
+        if is_banned(user_id):
+            return BANNED, None
+        if is_maintenance_mode():
+            return MAINTENANCE, None
+        
+        flood = self.flood_config
+        spam = self.spam_config
+        msg_hash = spam._hash_message(text) if text else None
+        now = time.time()
+        
+        with self.store.lock:
+            state = self.store.get(user_id)
+            
+            # 1. Антифлуд
+            if flood.enabled:
+                bucket = state.flood
+                if bucket is None:
+                    bucket = state.flood = TokenBucket()
+                
+                remaining = bucket.blocked_for(now)
+                if remaining:
+                    return FLOOD, int(remaining)
+                
+                if not bucket.take(now, flood.max_messages, flood.window_seconds):
+                    bucket.block(now, flood.ban_duration)
+                    logger.warning(f"User {user_id} banned for flooding")
+                    return FLOOD, flood.ban_duration
+            
+            # 2. Антиспам (только текст)
+            if msg_hash is not None:
+                bucket = state.spam
+                if bucket is None:
+                    bucket = state.spam = RepeatBucket()
+                
+                if not bucket.take_key(now, msg_hash, spam.duplicate_threshold, spam.window_seconds):
+                    logger.warning(f"Spam detected from user {user_id}: duplicate messages")
+                    return SPAM, "duplicate_messages"
+            
+            # 3. Лимит запросов по тарифу
+            if plan is not None:
+                bucket = state.rate
+                if bucket is None:
+                    bucket = state.rate = TokenBucket()
+                
+                remaining = bucket.blocked_for(now)
+                if remaining:
+                    return RATE, f"🚫 Временная блокировка. Осталось: {int(remaining)}с"
+                
+                config = self.plan_limits.get(plan, self.plan_limits['free'])
+                if not bucket.take(now, config['requests'], config['window']):
+                    if plan == 'free' and bucket.strikes > config['requests']:
+                        bucket.block(now, 120)
+                        return RATE, "🚫 Обнаружен флуд. Блокировка на 2 минуты."
+                    return RATE, config['message']
+        
+        return None, None
+    
+    def flood_bans(self) -> int:
+        """Количество активных банов за флуд"""
+        now = time.time()
+        with self.store.lock:
+            return sum(
+                1 for s in self.store.records.values()
+                if s.flood is not None and s.flood.blocked_until > now
+            )
+    
+    def reset_flood(self) -> int:
+        """Сбрасывает баны и счётчики антифлуда. Returns: сколько банов снято"""
+        now = time.time()
+        count = 0
+        with self.store.lock:
+            for state in self.store.records.values():
+                if state.flood is not None:
+                    if state.flood.blocked_until > now:
+                        count += 1
+                    state.flood = None
+        return count
+    
+    def get_stats(self) -> Dict:
+        """Статистика конвейера допуска"""
+        return {
+            "checks": self.checks,
+            "rejected": dict(self.rejected),
+            "avg_us": round(self.total_ns / self.checks / 1000, 2) if self.checks else 0.0,
+            "tracked_users": len(self.store),
+            "evicted_users": self.store.evicted,
+        }
+
+
+admission = AdmissionController()
+
+
+def plan_tier(user_id: int) -> str:
+    """Лимит запросов пользователя по тарифу из subscriptions (SQLite; VIP — lifetime)"""
+    return PLAN_TIERS.get(get_user_subscription(user_id), 'free')
+
+
+def _request_plan(update: Update, context) -> Optional[str]:
+    """Тариф для лимита запросов: считаются только сообщения пользователя"""
+    if not update.message:
+        return None
+    return plan_tier(update.effective_user.id)
+
+
+def _is_start(text: Optional[str]) -> bool:
+    """Команда /start (в том числе /start@bot и /start с параметром)"""
+    return bool(text) and text.split(maxsplit=1)[0].split('@')[0] == '/start'
+
+
+async def admission_middleware(update: Update, context):
+    """
+    TypeHandler(Update) в группе -1: пропускает апдейт дальше
+    или отвечает пользователю и останавливает обработку
+    """
+    user = update.effective_user
+    if not user:
+        return
+    
+    # Допускаем только сообщения и кнопки; платежи не трогаем никогда
+    message = update.message
+    query = update.callback_query
+    if not (message or query) or (message and message.successful_payment):
+        return
+    
+    text = message.text if message else None
+    reason, detail = admission.check(user.id, text, _request_plan(update, context))
+    if reason is None:
+        return
+    
+    # /start регистрирует пользователя и при отказе (бан, тех. работы), как и до конвейера допуска
+    if message and _is_start(text):
+        register_user(user.id, user.username, user.first_name)
+    
+    try:
+        if reason == BANNED:
+            if query:
+                await query.answer("🚫 Вы заблокированы", show_alert=True)
+            else:
+                await message.reply_text(
+                    "🚫 **Вы заблокированы**\n\n"
+                    "Доступ к боту ограничен.",
+                    parse_mode="Markdown"
+                )
+        elif reason == MAINTENANCE:
+            if query:
+                await query.answer("🔧 Технические работы. Попробуйте позже.", show_alert=True)
+            else:
+                await message.reply_text(get_maintenance_message(), parse_mode="Markdown")
+        elif reason == FLOOD:
+            if query:
+                await query.answer(f"⚠️ Подождите {detail} сек.", show_alert=True)
+            else:
+                await message.reply_text(
+                    f"⚠️ Слишком много запросов! Подождите {detail} секунд."
+                )
+        elif reason == SPAM:
+            await message.reply_text("⚠️ Пожалуйста, не отправляйте одинаковые сообщения.")
+        elif reason == RATE:
+            await message.reply_text(detail)
+    except Exception as e:
+        logger.debug(f"Не удалось ответить на отклонённый апдейт: {e}")
+    
+    raise ApplicationHandlerStop
+
+
+if __name__ == "__main__":
+    # Стоимость допуска одного апдейта (все пять политик) и срабатывание каждой политики.
+    # python -m utils.admission [проверок] [пользователей]
+    import os
+    import sys
+    import asyncio
+    import tempfile
+    from datetime import datetime, timedelta
+    from types import SimpleNamespace
+    from utils import admin_utils, database, subscription, whitelist
+    from utils.subscription import set_user_subscription
+    
+    checks = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    users_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000
+    logging.basicConfig(level=logging.CRITICAL)
+    
+    def cost_us(controller, text, plan) -> float:
+        started = time.perf_counter()
+        for i in range(checks):
+            controller.check(1_000_000 + i % users_count, text and f"{text} {i}", plan)
+        return (time.perf_counter() - started) / checks * 1e6
+    
+    message_us = cost_us(AdmissionController(), "сообщение", "pro")
+    button_us = cost_us(AdmissionController(), None, None)
+    print(f"{checks} проверок, {users_count} пользователей: сообщение {message_us:.2f} мкс, "
+          f"кнопка {button_us:.2f} мкс на апдейт")
+    
+    # Каждая политика: бан (множество в памяти), флуд, повтор текста, лимит free с блокировкой
+    controller = AdmissionController()
+    admin_utils._banned_ids.add(1)
+    banned = controller.check(1, "привет", "free")[0] == BANNED
+    admin_utils._banned_ids.discard(1)
+    
+    flood_reasons = [controller.check(2)[0] for _ in range(anti_flood.max_messages + 1)]
+    flood = flood_reasons[:-1] == [None] * anti_flood.max_messages and flood_reasons[-1] == FLOOD
+    
+    spam_reasons = [controller.check(3, "одно и то же")[0] for _ in range(anti_spam.duplicate_threshold + 1)]
+    # Повторы считаются по всему окну, а не только подряд: «A», «B», «A», «B»…
+    alternating = [controller.check(5, "AB"[i % 2])[0] for i in range(2 * anti_spam.duplicate_threshold + 1)]
+    spam = (spam_reasons[-1] == SPAM and alternating[-1] == SPAM
+            and alternating.count(None) == 2 * anti_spam.duplicate_threshold)
+    
+    free = controller.plan_limits['free']
+    controller.flood_config.max_messages, max_messages = 10 ** 6, anti_flood.max_messages
+    try:
+        rate_details = [controller.check(4, f"запрос {i}", "free")[1] for i in range(2 * free['requests'] + 2)]
+    finally:
+        controller.flood_config.max_messages = max_messages
+    rate = free['message'] in rate_details and "🚫 Обнаружен флуд. Блокировка на 2 минуты." in rate_details
+    blocked = controller.check(4, "после блокировки", "free")[1].startswith("🚫 Временная блокировка")
+    
+    print(f"бан: {banned}, флуд: {flood}, спам: {spam}, лимит тарифа: {rate}, блокировка free: {blocked}; "
+          f"статистика: {controller.get_stats()}")
+    
+    # Лимит по тарифу из subscriptions (временная БД): оплата звёздами, /setplan, VIP, истёкшая подписка
+    tmp = tempfile.mkdtemp()
+    subscription.SUBSCRIPTIONS_FILE = os.path.join(tmp, "subscriptions.json")
+    database._db = database.Database(os.path.join(tmp, "bot.db"))
+    set_user_subscription(10, "basic")
+    set_user_subscription(11, "premium")
+    set_user_subscription(12, "lifetime")
+    yesterday = (datetime.now() - timedelta(days=1)).isoformat()
+    database._db.set_plan(13, "pro", yesterday, yesterday)
+    whitelist._vip_ids.add(14)
+    tiers = {uid: plan_tier(uid) for uid in (10, 11, 12, 13, 14, 15)}
+    whitelist._vip_ids.discard(14)
+    tiers_ok = tiers == {10: "pro", 11: "unlimited", 12: "unlimited", 13: "free", 14: "unlimited", 15: "free"}
+    
+    started = time.perf_counter()
+    for i in range(checks // 10):
+        plan_tier(10 + i % 6)
+    tier_us = (time.perf_counter() - started) / (checks // 10) * 1e6
+    
+    pro = controller.plan_limits['pro']
+    controller.flood_config.max_messages = 10 ** 6
+    try:
+        paid = [controller.check(10, f"запрос {i}", plan_tier(10))[0] for i in range(pro['requests'] + 1)]
+    finally:
+        controller.flood_config.max_messages = max_messages
+    paid_ok = paid[:-1] == [None] * pro['requests'] and paid[-1] == RATE
+    
+    # /start забаненного и во время тех. работ отклоняется, но пользователь регистрируется
+    admin_utils.USERS_FILE = os.path.join(tmp, "users.json")
+    admin_utils.BOT_STATE_FILE = os.path.join(tmp, "bot_state.json")
+    
+    async def reply_text(text, **kwargs):
+        pass
+    
+    async def start_rejected(user_id) -> bool:
+        user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Имя")
+        message = SimpleNamespace(text="/start", successful_payment=None, reply_text=reply_text)
+        update = SimpleNamespace(effective_user=user, message=message, callback_query=None)
+        try:
+            await admission_middleware(update, None)
+        except ApplicationHandlerStop:
+            return True
+        return False
+    
+    admin_utils._banned_ids.add(20)
+    banned_start = asyncio.run(start_rejected(20))
+    admin_utils._banned_ids.discard(20)
+    admin_utils.set_maintenance_mode(True)
+    maintenance_start = asyncio.run(start_rejected(21))
+    admin_utils.set_maintenance_mode(False)
+    database._db.flush_writes()
+    registered = [uid for uid in (20, 21) if admin_utils.get_user_info(uid)]
+    start_ok = banned_start and maintenance_start and registered == [20, 21]
+    database._db.close()
+    
+    print(f"тарифы: {tiers}, {tier_us:.2f} мкс на чтение тарифа; "
+          f"basic пропущено {paid.count(None)} из {len(paid)} (лимит pro {pro['requests']})")
+    print(f"/start при бане: отклонён {banned_start}, при тех. работах: отклонён {maintenance_start}; "
+          f"зарегистрированы {registered}")
+    sys.exit(0 if banned and flood and spam and rate and blocked and tiers_ok and paid_ok and start_ok
+             and message_us < 50 else 1)
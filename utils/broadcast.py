@@ -0,0 +1,454 @@
+"""
+Фоновая рассылка сообщений пользователям
+Отправка идёт несколькими воркерами с общим темпом (слоты через 1/rate секунды, по умолчанию
+25 сообщений/с — ниже глобального лимита Telegram ~30/с). RetryAfter приостанавливает всех воркеров,
+пользователи, заблокировавшие бота, удаляются из каталога.
+Задания и прогресс хранятся в data/, после перезапуска рассылка продолжается с места остановки
+"""
+
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from utils import json_store
+
+logger = logging.getLogger(__name__)
+
+# Сообщений в секунду на всю рассылку и число одновременных отправок
+DEFAULT_RATE = 25
+DEFAULT_CONCURRENCY = 8
+# Как часто обновлять сообщение с прогрессом (сек)
+PROGRESS_INTERVAL = 5.0
+# Задержка отложенной записи прогресса (сек)
+SAVE_DELAY = 1.0
+# Попыток при сетевых ошибках (RetryAfter не считается)
+MAX_ATTEMPTS = 3
+# Сколько заблокировавших накопить перед удалением из каталога
+PRUNE_BATCH = 100
+# BadRequest с таким текстом означает, что писать пользователю больше некуда
+GONE_ERRORS = ("chat not found", "user is deactivated", "peer_id_invalid", "bot was blocked")
+
+# Итог доставки одному пользователю
+SENT = "sent"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class Broadcaster:
+    """
+    Очередь рассылок: задания выполняются по одному, в порядке постановки
+    Прогресс задания — позиция, до которой все получатели обработаны (cursor),
+    и номера уже обработанных после неё (done); после перезапуска отправка продолжается
+    с cursor, повторно сообщение могут получить только те, кому оно отправлялось
+    в момент остановки (не больше concurrency)
+    """
+
+    def __init__(
+        self,
+        bot,
+        data_dir: str = "data",
+        rate: float = DEFAULT_RATE,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        on_blocked: Optional[Callable[[List[int]], None]] = None
+    ):
+        self.bot = bot
+        self.jobs_file = f"{data_dir}/broadcast_jobs.json"
+        self.progress_file = f"{data_dir}/broadcast_progress.json"
+        self.rate = rate
+        self.concurrency = max(1, concurrency)
+        self.on_blocked = on_blocked
+
+        # Отправки равномерно разнесены на 1/rate секунды, без всплесков, поэтому в любом окне
+        # в 1 с их не больше rate. Слоты выдаются воркерам по очереди обращения
+        self._interval = 1.0 / rate
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._cancelled: Optional[str] = None  # id задания, которое нужно остановить
+        self._blocked: List[int] = []
+        self.retry_after_count = 0
+
+    # === Задания ===
+
+    def pending_jobs(self) -> List[Dict]:
+        """Задания в очереди (первое — текущее)"""
+        return json_store.read(self.jobs_file, {"jobs": []}).get("jobs", [])
+
+    def _update_jobs(self, mutate):
+        _, saved = json_store.update(self.jobs_file, mutate, {"jobs": []})
+        if not saved:
+            # Откат вернул бы прежнюю очередь (а после завершения — повторную рассылку),
+            # поэтому изменение остаётся в памяти и запись повторяется отложенно
+            logger.error(f"Не удалось сохранить очередь рассылок, повтор через {SAVE_DELAY} с")
+            json_store.update(self.jobs_file, mutate, {"jobs": []}, delay=SAVE_DELAY)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def submit(
+        self,
+        text: str,
+        recipients: List[int],
+        parse_mode: Optional[str] = None,
+        report_chat_id: Optional[int] = None,
+        title: str = "📢 Рассылка"
+    ) -> Dict:
+        """Ставит рассылку в очередь. Прогресс выводится в report_chat_id (одно сообщение, обновляется)"""
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "title": title,
+            "text": text,
+            "parse_mode": parse_mode,
+            "recipients": list(recipients),
+            "report_chat_id": report_chat_id,
+            "report_message_id": None,
+            "created_at": datetime.now().isoformat(),
+        }
+
+        queued = len(self.pending_jobs())
+        if report_chat_id:
+            try:
+                message = await self.bot.send_message(
+                    chat_id=report_chat_id,
+                    text=self._format(job, None, "⏳ В очереди" if queued else "📤 Начинаю")
+                )
+                job["report_message_id"] = message.message_id
+            except Exception as e:
+                logger.warning(f"Не удалось отправить отчёт о рассылке: {e}")
+
+        self._update_jobs(lambda data: data.setdefault("jobs", []).append(job))
+        logger.info(f"Рассылка {job['id']} поставлена в очередь: {len(job['recipients'])} получателей")
+        self._ensure_running()
+        return job
+
+    def resume(self) -> int:
+        """Продолжает незавершённые рассылки после перезапуска. Returns: сколько заданий в очереди"""
+        jobs = self.pending_jobs()
+        if jobs:
+            logger.info(f"Продолжаю рассылки после перезапуска: {len(jobs)} в очереди")
+            self._ensure_running()
+        return len(jobs)
+
+    def cancel(self) -> bool:
+        """Останавливает текущую рассылку (задание удаляется из очереди)"""
+        jobs = self.pending_jobs()
+        if not jobs:
+            return False
+        self._cancelled = jobs[0]["id"]
+        if not self.running:
+            self._ensure_running()
+        return True
+
+    def close(self):
+        """Останавливает отправку без удаления заданий (при остановке бота); прогресс уже в json_store"""
+        if self.running:
+            self._task.cancel()
+        self._prune_blocked_sync()
+
+    # === Выполнение ===
+
+    def _ensure_running(self):
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            jobs = self.pending_jobs()
+            if not jobs:
+                return
+            job = jobs[0]
+            try:
+                status = await self._run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Задание не должно блокировать очередь навсегда
+                logger.error(f"Рассылка {job['id']} прервана ошибкой: {e}", exc_info=True)
+                status = "❌ Прервана ошибкой"
+            await self._finish(job, status)
+
+    def _load_progress(self, job: Dict) -> Dict:
+        progress = json_store.read(self.progress_file, {})
+        if progress.get("id") == job["id"]:
+            return dict(progress)
+        return {"id": job["id"], "cursor": 0, "done": [], "sent": 0, "failed": 0, "blocked": 0}
+
+    def _save_progress(self, progress: Dict, done: set):
+        # Новый объект на каждую запись: таймер json_store сериализует его без гонки с воркерами
+        json_store.write(self.progress_file, dict(progress, done=sorted(done)), delay=SAVE_DELAY)
+
+    async def _run_job(self, job: Dict) -> str:
+        recipients = job["recipients"]
+        total = len(recipients)
+        progress = self._load_progress(job)
+        started = time.monotonic()
+        start_cursor = progress["cursor"]
+
+        # Обработанные после cursor (вне очереди) — при продолжении пропускаются
+        done = set(progress.get("done", []))
+        next_index = start_cursor
+        last_report = 0.0
+
+        async def worker():
+            nonlocal next_index, last_report
+            while self._cancelled != job["id"]:
+                while next_index in done:
+                    next_index += 1
+                if next_index >= total:
+                    break
+                index = next_index
+                next_index += 1
+
+                outcome = await self._deliver(recipients[index], job)
+                progress[outcome] += 1
+                if outcome == BLOCKED:
+                    self._blocked.append(recipients[index])
+
+                # Сдвигаем cursor только по непрерывно обработанному префиксу
+                done.add(index)
+                cursor = progress["cursor"]
+                while cursor in done:
+                    done.discard(cursor)
+                    cursor += 1
+                progress["cursor"] = cursor
+                self._save_progress(progress, done)
+
+                if len(self._blocked) >= PRUNE_BATCH:
+                    await self._prune_blocked()
+
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    speed = (cursor - start_cursor) / (now - started) if now > started else 0.0
+                    await self._report(job, progress, "📤 Отправка", speed)
+
+        workers = min(self.concurrency, max(1, total - start_cursor))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+        if self._cancelled == job["id"]:
+            return "⏹ Остановлена"
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Рассылка {job['id']} завершена за {elapsed:.1f} с: "
+            f"доставлено {progress['sent']}, ошибок {progress['failed']}, заблокировали {progress['blocked']}"
+        )
+        return "✅ Завершена"
+
+    async def _finish(self, job: Dict, status: str):
+        await self._prune_blocked()
+        progress = self._load_progress(job)
+        await self._report(job, progress, status)
+
+        def remove(data):
+            data["jobs"] = [j for j in data.get("jobs", []) if j["id"] != job["id"]]
+
+        self._update_jobs(remove)
+        json_store.write(self.progress_file, {})
+        if self._cancelled == job["id"]:
+            self._cancelled = None
+
+    async def _acquire(self):
+        """
+        Ждёт своего слота по общему темпу и паузе после RetryAfter
+        Слот резервируется сразу, поэтому воркеры идут строго по очереди: опрос общего
+        бакета позволял одному воркеру раз за разом проигрывать гонку, и его получатель
+        задерживал cursor до конца рассылки
+        """
+        while True:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + self._interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # Пока ждали, мог прийти RetryAfter — тогда встаём в очередь после паузы
+            if time.monotonic() >= self._paused_until:
+                return
+
+    async def _deliver(self, chat_id: int, job: Dict) -> str:
+        attempts = 0
+        while True:
+            await self._acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=job["text"], parse_mode=job.get("parse_mode"))
+                return SENT
+            except RetryAfter as e:
+                # Лимит Telegram общий для бота — паузу соблюдают все воркеры
+                delay = _retry_seconds(e)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.retry_after_count += 1
+                logger.warning(f"Рассылка: RetryAfter {delay} с")
+            except Forbidden:
+                return BLOCKED
+            except BadRequest as e:
+                if any(marker in str(e).lower() for marker in GONE_ERRORS):
+                    return BLOCKED
+                logger.debug(f"Рассылка: {chat_id} — {e}")
+                return FAILED
+            except NetworkError as e:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.debug(f"Рассылка: {chat_id} — {e}")
+                    return FAILED
+                await asyncio.sleep(attempts)
+            except Exception as e:
+                logger.debug(f"Рассылка: {chat_id} — {e}")
+                return FAILED
+
+    async def _prune_blocked(self):
+        if not self._blocked or self.on_blocked is None:
+            self._blocked.clear()
+            return
+        blocked, self._blocked = self._blocked, []
+        try:
+            await asyncio.to_thread(self.on_blocked, blocked)
+        except Exception as e:
+            logger.error(f"Не удалось удалить заблокировавших бота пользователей: {e}")
+
+    def _prune_blocked_sync(self):
+        if self._blocked and self.on_blocked is not None:
+            blocked, self._blocked = self._blocked, []
+            try:
+                self.on_blocked(blocked)
+            except Exception as e:
+                logger.error(f"Не удалось удалить заблокировавших бота пользователей: {e}")
+
+    # === Отчёт ===
+
+    def _format(self, job: Dict, progress: Optional[Dict], status: str, speed: float = 0.0) -> str:
+        total = len(job["recipients"])
+        progress = progress or {"cursor": 0, "sent": 0, "failed": 0, "blocked": 0}
+        cursor = progress["cursor"]
+        percent = cursor * 100 // total if total else 100
+
+        text = (
+            f"{job['title']}: {status}\n\n"
+            f"📊 {cursor}/{total} ({percent}%)\n"
+            f"✅ Доставлено: {progress['sent']}\n"
+            f"❌ Ошибок: {progress['failed']}\n"
+            f"🚫 Заблокировали бота: {progress['blocked']}"
+        )
+        if speed > 0 and cursor < total:
+            text += f"\n⏱ Осталось ~{int((total - cursor) / speed)} с ({speed:.1f} сообщ./с)"
+        return text
+
+    async def _report(self, job: Dict, progress: Dict, status: str, speed: float = 0.0):
+        if not job.get("report_chat_id") or not job.get("report_message_id"):
+            return
+        try:
+            await self.bot.edit_message_text(
+                chat_id=job["report_chat_id"],
+                message_id=job["report_message_id"],
+                text=self._format(job, progress, status, speed)
+            )
+        except Exception as e:
+            # "message is not modified" и т.п. — не мешают рассылке
+            logger.debug(f"Не удалось обновить отчёт о рассылке: {e}")
+
+
+if __name__ == "__main__":
+    # Проверка на локальном фейковом Bot API: задержка сети, RetryAfter, заблокировавшие,
+    # перезапуск посреди рассылки. Каждый получатель должен получить сообщение
+    # (повторно — не больше concurrency), пауза RetryAfter и темп — соблюдаться
+    import sys
+    import tempfile
+    from collections import Counter
+
+    users_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+    data_dir = tempfile.mkdtemp()
+
+    class _Message:
+        def __init__(self, message_id):
+            self.message_id = message_id
+
+    class FakeBot:
+        """Отвечает как Bot API: ~20 мс на запрос, RetryAfter на каждом 400-м, 5% заблокировали бота"""
+
+        def __init__(self):
+            self.delivered = Counter()
+            self.sent_at: List[float] = []
+            self.calls = 0
+            self.edits = 0
+            self.pause_violations = 0
+            self.pause = (0.0, 0.0)  # окно RetryAfter: от ответа до конца паузы
+
+        async def send_message(self, chat_id, text, parse_mode=None):
+            now = time.monotonic()
+            if self.pause[0] <= now < self.pause[1]:
+                self.pause_violations += 1
+            await asyncio.sleep(0.02)
+            if chat_id < 0:  # чат админа для отчёта
+                return _Message(1)
+            self.calls += 1
+            if self.calls % 400 == 0:
+                # Пауза отсчитывается от ответа: запросы, ушедшие до него, нарушением не считаются
+                answered = time.monotonic()
+                self.pause = (answered, answered + 1)
+                raise RetryAfter(1)
+            if chat_id % 20 == 0:
+                raise Forbidden("Forbidden: bot was blocked by the user")
+            self.delivered[chat_id] += 1
+            self.sent_at.append(now)
+            return _Message(chat_id)
+
+        async def edit_message_text(self, chat_id, message_id, text):
+            self.edits += 1
+
+    pruned: List[int] = []
+    recipients = list(range(1, users_count + 1))
+
+    async def scenario():
+        bot = FakeBot()
+        first = Broadcaster(bot, data_dir, rate=rate, concurrency=DEFAULT_CONCURRENCY, on_blocked=pruned.extend)
+        started = time.monotonic()
+        await first.submit("test", recipients, report_chat_id=-1)
+
+        # «Перезапуск» на середине: задача отменяется, прогресс сбрасывается на диск
+        while json_store.read(first.progress_file, {}).get("cursor", 0) < users_count // 2:
+            await asyncio.sleep(0.05)
+        first.close()
+        json_store.flush()
+        for path in (first.jobs_file, first.progress_file):
+            json_store.invalidate(path)
+        cursor = json_store.read(first.progress_file, {}).get("cursor")
+
+        second = Broadcaster(bot, data_dir, rate=rate, concurrency=DEFAULT_CONCURRENCY, on_blocked=pruned.extend)
+        second.resume()
+        await second._task
+        elapsed = time.monotonic() - started
+
+        blocked = {uid for uid in recipients if uid % 20 == 0}
+        expected = [uid for uid in recipients if uid not in blocked]
+        missing = [uid for uid in expected if bot.delivered[uid] == 0]
+        duplicates = sum(1 for uid in expected if bot.delivered[uid] > 1)
+        # Максимум отправок в любом окне в 1 с
+        window_max, j = 0, 0
+        for i, t in enumerate(bot.sent_at):
+            while bot.sent_at[j] < t - 1.0:
+                j += 1
+            window_max = max(window_max, i - j + 1)
+
+        print(f"{users_count} получателей, темп {rate:g}/с, перезапуск на позиции {cursor}: {elapsed:.1f} с")
+        print(f"не доставлено {len(missing)}, повторно {duplicates} (допустимо до {DEFAULT_CONCURRENCY}), "
+              f"удалено заблокировавших {len(set(pruned))}/{len(blocked)}")
+        print(f"RetryAfter: {first.retry_after_count + second.retry_after_count}, "
+              f"отправок во время паузы {bot.pause_violations}, макс. за 1 с {window_max}, "
+              f"обновлений отчёта {bot.edits}, очередь {len(second.pending_jobs())}")
+        ok = (not missing and duplicates <= DEFAULT_CONCURRENCY and set(pruned) == blocked
+              and bot.pause_violations == 0 and window_max <= rate + 1 and not second.pending_jobs())
+        return ok
+
+    sys.exit(0 if asyncio.run(scenario()) else 1)
@@ -0,0 +1,201 @@
+"""
+Маршрутизация callback кнопок: точные совпадения через словарь,
+префиксы (set_lang_, mgen_, addr_ ...) через префиксное дерево.
+Стоимость диспетчеризации не зависит от количества зарегистрированных маршрутов.
+Время обработки пишется в гистограмму по маршруту (значение или префикс, не сырой callback_data).
+"""
+
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+Handler = Callable[..., Awaitable]
+
+
+class _Route:
+    __slots__ = ("name", "handler", "latency")
+    
+    def __init__(self, name: str, handler: Handler, latency=None):
+        self.name = name
+        self.handler = handler
+        self.latency = latency  # серия гистограммы utils.metrics или None
+
+
+class _TrieNode:
+    __slots__ = ("children", "route")
+    
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.route: Optional[_Route] = None
+
+
+class CallbackRouter:
+    """
+    Реестр обработчиков callback_data.
+    
+    Usage:
+        router = CallbackRouter()
+        
+        @router.exact("back_main", "cancel")
+        async def show_main(update, context): ...
+        
+        @router.prefix("lang_")
+        async def change_language(update, context): ...
+        
+        await router.dispatch(query.data, update, context)
+    
+    Точное совпадение важнее префикса; из префиксов выбирается самый длинный.
+    
+    latency — семейство гистограмм utils.metrics с меткой маршрута; серия для маршрута
+    создаётся при регистрации, поэтому dispatch пишет замер без поиска по словарю.
+    """
+    
+    def __init__(self, latency=None):
+        self._exact: Dict[str, _Route] = {}
+        self._root = _TrieNode()
+        self._prefix_count = 0
+        self._latency = latency
+    
+    def _route(self, name: str, handler: Handler) -> _Route:
+        series = self._latency.labels(name) if self._latency is not None else None
+        return _Route(name, handler, series)
+    
+    def add_exact(self, data: str, handler: Handler):
+        if data in self._exact:
+            raise ValueError(f"Callback '{data}' already registered")
+        self._exact[data] = self._route(data, handler)
+    
+    def add_prefix(self, prefix: str, handler: Handler):
+        node = self._root
+        for char in prefix:
+            node = node.children.setdefault(char, _TrieNode())
+        if node.route is not None:
+            raise ValueError(f"Callback prefix '{prefix}' already registered")
+        node.route = self._route(prefix, handler)
+        self._prefix_count += 1
+    
+    def exact(self, *names: str):
+        """Декоратор: обработчик для точных значений callback_data"""
+        def decorator(handler: Handler) -> Handler:
+            for name in names:
+                self.add_exact(name, handler)
+            return handler
+        return decorator
+    
+    def prefix(self, *prefixes: str):
+        """Декоратор: обработчик для callback_data, начинающихся с префикса"""
+        def decorator(handler: Handler) -> Handler:
+            for prefix in prefixes:
+                self.add_prefix(prefix, handler)
+            return handler
+        return decorator
+    
+    def _match(self, data: str) -> Optional[_Route]:
+        route = self._exact.get(data)
+        if route is not None:
+            return route
+        
+        node = self._root
+        for char in data:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.route is not None:
+                route = node.route
+        return route
+    
+    def resolve(self, data: str) -> Optional[Handler]:
+        """Найти обработчик: точное совпадение, иначе самый длинный префикс"""
+        route = self._match(data)
+        return route.handler if route is not None else None
+    
+    def route_name(self, data: str) -> Optional[str]:
+        """Маршрут (значение или префикс), которым будет обработан data"""
+        route = self._match(data)
+        return route.name if route is not None else None
+    
+    async def dispatch(self, data: str, *args, **kwargs) -> bool:
+        """Вызвать обработчик для data. False — если маршрут не найден"""
+        route = self._match(data)
+        if route is None:
+            return False
+        if route.latency is None:
+            await route.handler(*args, **kwargs)
+            return True
+        
+        started = time.perf_counter()
+        try:
+            await route.handler(*args, **kwargs)
+        finally:
+            route.latency.observe(time.perf_counter() - started)
+        return True
+    
+    def __len__(self) -> int:
+        return len(self._exact) + self._prefix_count
+
+
+if __name__ == "__main__":
+    # Повтор записанной смеси callback_data через старую цепочку if/startswith
+    # (условия main_callback_handler до роутера, в том же порядке) и через роутер.
+    # Каждое значение должно попасть в тот же маршрут. python -m utils.callback_router [нажатий]
+    import sys
+    import random
+    
+    presses = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    
+    # "*" в конце — условие startswith, иначе ==
+    CHAIN = """
+        set_lang_* admin_back admin_vip admin_vip_add admin_vip_remove admin_vip_list admin_ban
+        admin_ban_add admin_ban_remove admin_ban_list admin_stats admin_error_stats admin_subscriptions
+        admin_broadcast admin_maintenance admin_maint_on admin_maint_off admin_restart admin_antiflood
+        antiflood_increase antiflood_decrease antiflood_ban_30 antiflood_ban_60 antiflood_ban_300
+        antiflood_reset antiflood_disable antiflood_enable admin_userinfo main_tools main_generators
+        main_gplay main_subscription main_settings back_main back_tools back_generators back_settings
+        back_subscription sub_pricing sub_mystats sub_pro_new sub_unlimited back_uniq_menu
+        menu_uniqualizer menu_exif menu_site menu_tiktok uniq_photo uniq_video var_photo_* var_video_*
+        vformat_* uniq_default uniq_custom exif_view exif_clear exif_copy tiktok_download
+        tiktok_download_uniq menu_selfie menu_address menu_card menu_twofa menu_antidetect menu_text
+        menu_language menu_sub_info menu_report_error lang_* gplay_add gplay_list sub_crypto_*
+        sub_stars_* sub_* pay_* check_payment_* mgen_* selfie_* addr_* card_* antidetect_* cancel
+    """.split()
+    
+    def chain_route(data: str) -> Optional[str]:
+        for condition in CHAIN:
+            if condition.endswith("*"):
+                if data.startswith(condition[:-1]):
+                    return condition[:-1]
+            elif data == condition:
+                return condition
+        return None
+    
+    router = CallbackRouter()
+    for condition in CHAIN:
+        if condition.endswith("*"):
+            router.add_prefix(condition[:-1], None)
+        else:
+            router.add_exact(condition, None)
+    
+    # Запись нажатий: навигация по меню чаще всего, генераторы и оплата реже, админка изредка
+    recorded = (
+        ["back_main"] * 20 + ["main_tools", "main_generators", "main_subscription", "main_settings"] * 6
+        + ["menu_uniqualizer", "uniq_photo", "var_photo_3", "var_video_10", "vformat_mp4"] * 4
+        + ["mgen_address", "mgen_card", "addr_US", "card_visa", "selfie_male", "antidetect_facebook"] * 3
+        + ["sub_pricing", "sub_pro", "sub_crypto_pro_USDT", "sub_stars_premium", "check_payment_42", "pay_basic"] * 2
+        + ["set_lang_en", "lang_ua", "menu_language", "cancel", "admin_stats", "antiflood_reset", "unknown_button"]
+    )
+    rng = random.Random(1)
+    mix = [rng.choice(recorded) for _ in range(presses)]
+    
+    mismatches = [data for data in set(mix) if chain_route(data) != router.route_name(data)]
+    
+    def measure(resolve) -> float:
+        started = time.perf_counter()
+        for data in mix:
+            resolve(data)
+        return (time.perf_counter() - started) / presses * 1e9
+    
+    chain_ns = measure(chain_route)
+    router_ns = measure(router.resolve)
+    print(f"{presses} нажатий, {len(CHAIN)} условий / {len(router)} маршрутов: "
+          f"цепочка {chain_ns:.0f} нс, роутер {router_ns:.0f} нс на нажатие")
+    print(f"расхождений маршрутов: {len(mismatches)} {sorted(mismatches)[:5]}")
+    sys.exit(0 if not mismatches and router_ns < chain_ns else 1)
@@ -247,10 +247,10 @@ def format_file_size(size_bytes):
 
 # === Асинхронные обёртки для многопользовательского режима ===
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from utils.metrics import InstrumentedExecutor
 
 # Пул потоков для сетевых операций
-_network_executor = ThreadPoolExecutor(max_workers=15, thread_name_prefix='network_')
+_network_executor = InstrumentedExecutor('network', max_workers=15)
 
 
 async def download_website_async(url, output_dir):
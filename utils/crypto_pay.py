@@ -3,13 +3,20 @@
 Документация: https://help.crypt.bot/crypto-pay-api
 """
 
+import time
+import random
+import asyncio
+import logging
 import aiohttp
 import hashlib
 import hmac
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime
 
-from config import CRYPTO_BOT_TOKEN
+from config import CRYPTO_BOT_TOKEN, CRYPTO_PAY_TIMEOUT, CRYPTO_PAY_RETRIES
+from utils import metrics
+
+logger = logging.getLogger(__name__)
 
 # Crypto Bot API настройки
 CRYPTO_BOT_API_TOKEN = CRYPTO_BOT_TOKEN
@@ -26,19 +33,184 @@ SUBSCRIPTION_PRICES_USD = {
     "lifetime": 200.0   # 2000 Stars (пожизненная)
 }
 
+# Сколько держать ответ в кэше (сек): курсы меняются медленно, валюты и getMe — почти никогда
+CACHE_TTL = {
+    "getExchangeRates": 60.0,
+    "getCurrencies": 3600.0,
+    "getMe": 3600.0,
+}
 
-async def crypto_api_request(method: str, params: Dict = None) -> Dict:
-    """Выполнение запроса к Crypto Bot API"""
-    headers = {
-        "Crypto-Pay-API-Token": CRYPTO_BOT_API_TOKEN
-    }
+# Методы без побочных эффектов: их можно повторить после таймаута или ответа 5xx
+IDEMPOTENT_METHODS = frozenset({"getMe", "getBalance", "getExchangeRates", "getCurrencies", "getInvoices"})
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Задержка перед повтором: случайная в [0, RETRY_BASE_DELAY * 2^n], не больше RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 5.0
+# Keep-alive соединений с API в пуле
+POOL_SIZE = 20
+
+
+class CryptoPayClient:
+    """
+    Клиент Crypto Pay API с одной долгоживущей сессией (пул keep-alive соединений)
+    
+    Сессия открывается в post_init (start()) и закрывается при остановке бота (close());
+    запрос до start() откроет её сам. Ответы методов из CACHE_TTL кэшируются, одновременные
+    промахи кэша ждут один общий запрос; если обновить кэш не удалось, отдаётся прежний ответ.
+    Таймауты, обрывы, 429 и 5xx повторяются с экспоненциальной задержкой и случайным разбросом.
+    createInvoice повторяется только если соединение не установлено или ответ 429 — иначе
+    повтор мог бы создать второй счёт
+    """
+    
+    def __init__(
+        self,
+        token: str,
+        base_url: str = CRYPTO_BOT_API_URL,
+        timeout: float = CRYPTO_PAY_TIMEOUT,
+        retries: int = CRYPTO_PAY_RETRIES,
+        pool_size: int = POOL_SIZE
+    ):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._cache: Dict[str, Tuple[float, Dict]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._latency = metrics.registry.histogram(
+            'bot_crypto_pay_request_seconds', 'Время запроса к Crypto Pay API (одна попытка)', 'method'
+        )
+        self.stats = {"requests": 0, "retries": 0, "errors": 0, "cache_hits": 0}
+    
+    async def start(self) -> aiohttp.ClientSession:
+        """Открыть сессию (повторный вызов возвращает открытую)"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=30
+                ),
+                headers={"Crypto-Pay-API-Token": self.token},
+                timeout=aiohttp.ClientTimeout(total=self.timeout, connect=min(self.timeout, 5.0))
+            )
+        return self._session
+    
+    async def close(self):
+        """Закрыть сессию и соединения; кэш остаётся"""
+        session, self._session = self._session, None
+        for task in list(self._inflight.values()):
+            task.cancel()
+        if session is not None and not session.closed:
+            await session.close()
     
-    url = f"{CRYPTO_BOT_API_URL}/{method}"
+    async def request(self, method: str, params: Dict = None) -> Dict:
+        """
+        Вызов метода API. Ответ API возвращается как есть ({"ok": ..., "result"/"error": ...});
+        сетевая ошибка после всех попыток — {"ok": False, "error": {"name": ...}}
+        """
+        ttl = CACHE_TTL.get(method)
+        if ttl is None or params:
+            return await self._request(method, params)
+        
+        cached = self._cache.get(method)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            self.stats["cache_hits"] += 1
+            return cached[1]
+        
+        task = self._inflight.get(method)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(method))
+            self._inflight[method] = task
+            task.add_done_callback(lambda _: self._inflight.pop(method, None))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers, params=params) as response:
-            data = await response.json()
-            return data
+    async def _refresh(self, method: str) -> Dict:
+        result = await self._request(method)
+        if result.get("ok"):
+            self._cache[method] = (time.monotonic(), result)
+            return result
+        cached = self._cache.get(method)
+        if cached is not None:
+            logger.warning(f"Crypto Pay {method}: обновить не удалось, ответ из кэша")
+            return cached[1]
+        return result
+    
+    async def _request(self, method: str, params: Dict = None) -> Dict:
+        session = await self.start()
+        url = f"{self.base_url}/{method}"
+        idempotent = method in IDEMPOTENT_METHODS
+        latency = self._latency.labels(method)
+        error: Any = None
+        retry_after = 0.0
+        
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats["retries"] += 1
+                await asyncio.sleep(_backoff(attempt, retry_after))
+                retry_after = 0.0
+            self.stats["requests"] += 1
+            started = time.perf_counter()
+            try:
+                async with session.get(url, params=params) as response:
+                    if response.status not in RETRY_STATUSES or not (idempotent or response.status == 429):
+                        data = await response.json(content_type=None)
+                        if isinstance(data, dict):
+                            return data
+                        error = f"HTTP {response.status}, ответ без JSON"
+                        break
+                    error = f"HTTP {response.status}"
+                    retry_after = _retry_after(response.headers.get("Retry-After"))
+            except aiohttp.ClientConnectorError as e:
+                # Соединение не установлено — запрос до API не дошёл, повтор безопасен
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+                if not idempotent:
+                    break
+            finally:
+                latency.observe(time.perf_counter() - started)
+        
+        self.stats["errors"] += 1
+        logger.warning(f"Crypto Pay {method}: {error!r}, попыток {attempt + 1}")
+        return {"ok": False, "error": {"name": str(error) or type(error).__name__}}
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "cached": sorted(self._cache)}
+
+
+def _backoff(attempt: int, retry_after: float = 0.0) -> float:
+    """Задержка перед попыткой attempt (1, 2, ...): full jitter, но не меньше Retry-After"""
+    ceiling = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return max(min(retry_after, RETRY_MAX_DELAY), random.uniform(0, ceiling))
+
+
+def _retry_after(value: Optional[str]) -> float:
+    try:
+        return float(value) if value else 0.0
+    except ValueError:
+        return 0.0
+
+
+# Общий клиент процесса; жизненным циклом сессии управляет bot.py (post_init / остановка)
+client = CryptoPayClient(CRYPTO_BOT_API_TOKEN)
+
+
+async def start_session():
+    """Открыть пул соединений с Crypto Pay API"""
+    await client.start()
+
+
+async def close_session():
+    """Закрыть пул соединений с Crypto Pay API"""
+    await client.close()
+
+
+async def crypto_api_request(method: str, params: Dict = None) -> Dict:
+    """Выполнение запроса к Crypto Bot API"""
+    return await client.request(method, params)
 
 
 async def get_me() -> Dict:
@@ -299,3 +471,130 @@ def format_crypto_payment_info(plan_id: str) -> str:
     text += "Выберите валюту для оплаты:"
     
     return text
+
+
+if __name__ == "__main__":
+    # Самопроверка на локальной заглушке Crypto Pay API: python -m utils.crypto_pay
+    from aiohttp import web
+    
+    async def _selfcheck():
+        calls: Dict[str, int] = {}
+        peers = set()
+        mode = {"currencies_fail": 2, "rates_down": False, "invoice_status": 200, "slow": 0.0}
+        
+        async def api(request):
+            method = request.match_info["method"]
+            calls[method] = calls.get(method, 0) + 1
+            peers.add(request.transport.get_extra_info("peername"))
+            assert request.headers.get("Crypto-Pay-API-Token") == "test"
+            if mode["slow"]:
+                await asyncio.sleep(mode["slow"])
+            if method == "getExchangeRates" and mode["rates_down"]:
+                return web.Response(status=502)
+            if method == "getCurrencies" and mode["currencies_fail"]:
+                mode["currencies_fail"] -= 1
+                return web.Response(status=503)
+            if method == "createInvoice" and mode["invoice_status"] != 200:
+                return web.Response(status=mode["invoice_status"], headers={"Retry-After": "0"})
+            results = {
+                "getExchangeRates": [{"source": "TON", "target": "USD", "rate": "5.0"}],
+                "getCurrencies": [{"code": "USDT"}],
+                "getMe": {"app_id": 1},
+                "createInvoice": {"invoice_id": 1, "pay_url": "https://t.me/x"},
+                "getInvoices": {"items": [{"invoice_id": 1, "status": "active"}]},
+            }
+            return web.json_response({"ok": True, "result": results.get(method)})
+        
+        app = web.Application()
+        app.router.add_get("/api/{method}", api)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        base_url = f"http://127.0.0.1:{port}/api"
+        
+        global RETRY_BASE_DELAY
+        RETRY_BASE_DELAY = 0.01
+        
+        # Было: новая ClientSession (новое TCP/TLS соединение) на каждый вызов
+        async def old_request(method):
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{base_url}/{method}", headers={"Crypto-Pay-API-Token": "test"}) as r:
+                    return await r.json()
+        
+        n = 200
+        started = time.perf_counter()
+        for _ in range(n):
+            await old_request("getInvoices")
+        old_ms = (time.perf_counter() - started) / n * 1000
+        old_conns = len(peers)
+        
+        test = CryptoPayClient("test", base_url=base_url, timeout=0.5, retries=3)
+        await test.start()
+        peers.clear()
+        started = time.perf_counter()
+        for _ in range(n):
+            assert (await test.request("getInvoices", {"invoice_ids": "1"}))["ok"]
+        new_ms = (time.perf_counter() - started) / n * 1000
+        print(f"getInvoices x{n}: сессия на вызов {old_ms:.2f} мс, соединений {old_conns}; "
+              f"общая сессия {new_ms:.2f} мс, соединений {len(peers)}")
+        assert len(peers) == 1
+        
+        # Кэш: 500 одновременных открытий меню → один запрос курсов
+        calls.clear()
+        results = await asyncio.gather(*(test.request("getExchangeRates") for _ in range(500)))
+        assert all(r["ok"] for r in results) and calls == {"getExchangeRates": 1}
+        started = time.perf_counter()
+        for _ in range(10000):
+            await test.request("getExchangeRates")
+        hit_us = (time.perf_counter() - started) / 10000 * 1e6
+        print(f"курсы: 500 одновременных + 10000 повторных вызовов → {calls['getExchangeRates']} запрос к API, "
+              f"ответ из кэша {hit_us:.1f} мкс")
+        
+        # Устаревший кэш при недоступном API → прежний ответ
+        mode["rates_down"] = True
+        test._cache["getExchangeRates"] = (0.0, test._cache["getExchangeRates"][1])
+        stale = await test.request("getExchangeRates")
+        assert stale["ok"] and calls["getExchangeRates"] == 1 + 1 + test.retries
+        mode["rates_down"] = False
+        
+        # 503, 503, затем ответ — повторы с задержкой
+        calls.clear()
+        currencies = await test.request("getCurrencies")
+        assert currencies["ok"] and calls["getCurrencies"] == 3
+        
+        # createInvoice: 5xx не повторяется (счёт мог быть создан), 429 — повторяется
+        calls.clear()
+        mode["invoice_status"] = 502
+        assert not (await test.request("createInvoice", {"asset": "USDT", "amount": "1"}))["ok"]
+        assert calls["createInvoice"] == 1
+        mode["invoice_status"] = 429
+        assert not (await test.request("createInvoice", {"asset": "USDT", "amount": "1"}))["ok"]
+        assert calls["createInvoice"] == 1 + 1 + test.retries
+        mode["invoice_status"] = 200
+        
+        # Таймаут: медленный API → ошибка через (retries + 1) * timeout + задержки, а не зависание
+        mode["slow"] = 2.0
+        started = time.perf_counter()
+        failed = await test.request("getBalance")
+        elapsed = time.perf_counter() - started
+        mode["slow"] = 0.0
+        print(f"таймауты: {failed['error']['name']} за {elapsed:.2f} с")
+        assert not failed["ok"] and elapsed < (test.retries + 1) * test.timeout + 1.0
+        
+        # Функции модуля идут через общий клиент; устаревшие курсы обновляются одним запросом
+        global client
+        client = test
+        calls.clear()
+        for _ in range(3):
+            assert await create_subscription_invoice(1, "pro", "TON")
+        assert calls == {"getExchangeRates": 1, "createInvoice": 3}
+        
+        print("статистика клиента:", test.get_stats())
+        await test.close()
+        await runner.cleanup()
+    
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(_selfcheck())
+    print("OK")
@@ -1,30 +1,102 @@
 """
 Error Monitor с уведомлениями админу
 Логирование, статистика, алерты
+
+Ошибка из хендлера только считается и ставится в очередь — хендлер не ждёт ни записи
+на диск, ни отправки сообщений. Фоновая задача пишет лог, группирует ошибки по
+(тип, хендлер) в окне ALERT_WINDOW секунд и шлёт админам первую ошибку окна сразу,
+а остальные — одной сводкой в конце окна. Статистика сохраняется отложенно (json_store)
 """
+import os
+import time
+import asyncio
 import logging
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
-from typing import Optional
+from logging.handlers import BaseRotatingHandler
+from typing import Dict, Optional, Tuple
 from pathlib import Path
-import json
+
+from utils import json_store
+
+# Окно группировки алертов (сек): не больше двух сообщений админу за окно
+ALERT_WINDOW = 60.0
+# Задержка сохранения error_stats.json (сек) — все ошибки за это время пишутся одной записью
+SAVE_INTERVAL = 10.0
+# Очередь необработанных ошибок; при переполнении ошибка только считается
+QUEUE_SIZE = 1000
+# Сколько групп ошибок показывать в сводке
+DIGEST_TOP = 10
+# Уровни, о которых сообщается админам
+ALERT_SEVERITIES = ('ERROR', 'CRITICAL')
+
+
+class DailyFileHandler(BaseRotatingHandler):
+    """Лог в файле logs/bot_YYYYMMDD.log; в полночь запись переходит в файл нового дня"""
+    
+    def __init__(self, log_dir: Path, prefix: str = 'bot'):
+        self.log_dir = Path(log_dir)
+        self.prefix = prefix
+        self.rollover_at = 0.0
+        super().__init__(self._path_for(time.time()), 'a', encoding='utf-8')
+    
+    def _path_for(self, now: float) -> str:
+        day = datetime.fromtimestamp(now)
+        midnight = datetime.combine(day.date() + timedelta(days=1), datetime.min.time())
+        self.rollover_at = midnight.timestamp()
+        return str(self.log_dir / f"{self.prefix}_{day.strftime('%Y%m%d')}.log")
+    
+    def shouldRollover(self, record) -> bool:
+        return record.created >= self.rollover_at
+    
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        # Запись уже после полуночи: файл выбирается не раньше следующего дня
+        self.baseFilename = os.path.abspath(self._path_for(max(time.time(), self.rollover_at)))
+        self.stream = self._open()
+
+
+class _ErrorGroup:
+    """Ошибки одного типа из одного хендлера за окно"""
+    
+    __slots__ = ("severity", "error_type", "handler", "message", "context", "count", "alerted")
+    
+    def __init__(self, severity: str, error_type: str, handler: str, message: str, context: dict):
+        self.severity = severity
+        self.error_type = error_type
+        self.handler = handler
+        self.message = message
+        self.context = context
+        self.count = 1
+        self.alerted = 0  # сколько из count уже ушло отдельным алертом
+
 
 class ErrorMonitor:
     """Мониторинг ошибок с алертами"""
     
-    def __init__(self, admin_ids: list, log_dir: str = 'logs'):
-        self.admin_ids = admin_ids
+    def __init__(
+        self,
+        admin_ids: list,
+        log_dir: str = 'logs',
+        alert_window: float = ALERT_WINDOW,
+        save_interval: float = SAVE_INTERVAL
+    ):
+        # Один и тот же админ может быть указан дважды (ADMIN_ID и ADMIN_OPERATOR_ID)
+        self.admin_ids = [admin_id for admin_id in dict.fromkeys(admin_ids) if admin_id]
         self.log_dir = Path(log_dir)
         self.log_dir.mkdir(exist_ok=True)
+        self.alert_window = alert_window
+        self.save_interval = save_interval
         
         # Настройка логгера
         self.logger = logging.getLogger('docgen_bot')
         self.logger.setLevel(logging.INFO)
         
-        # File handler
-        log_file = self.log_dir / f"bot_{datetime.now().strftime('%Y%m%d')}.log"
-        fh = logging.FileHandler(log_file, encoding='utf-8')
+        # File handler: новый файл каждый день
+        fh = DailyFileHandler(self.log_dir)
         fh.setLevel(logging.INFO)
         
         # Console handler
@@ -46,23 +118,71 @@ class ErrorMonitor:
         self.error_counts = {}
         self.stats_file = self.log_dir / 'error_stats.json'
         self._load_stats()
+        
+        # Фоновая обработка: очередь создаётся в работающем event loop
+        self.bot = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._window: Dict[Tuple[str, str, str], _ErrorGroup] = {}
+        self._window_timer: Optional[asyncio.TimerHandle] = None
+        self._window_alerted = False
+        self._window_dropped = 0
+        self._sends = set()
+        self.dropped = 0
+        self.alerts_sent = 0
     
     def _load_stats(self):
         """Загрузка статистики ошибок"""
-        if self.stats_file.exists():
-            with open(self.stats_file, 'r') as f:
-                self.error_counts = json.load(f)
-        else:
-            self.error_counts = {'total': 0, 'by_type': {}}
+        data = json_store.read(str(self.stats_file), {'total': 0, 'by_type': {}})
+        self.error_counts = {
+            'total': data.get('total', 0),
+            'by_type': dict(data.get('by_type', {}))
+        }
     
-    def _save_stats(self):
-        """Сохранение статистики"""
-        with open(self.stats_file, 'w') as f:
-            json.dump(self.error_counts, f, indent=2)
+    def _save_stats(self, delay: float = 0.0):
+        """Сохранение статистики (delay > 0 — отложенно, изменения сливаются в одну запись)"""
+        snapshot = {'total': self.error_counts['total'], 'by_type': dict(self.error_counts['by_type'])}
+        json_store.write(str(self.stats_file), snapshot, delay=delay)
+    
+    def report(
+        self,
+        error: Exception,
+        context_data: dict = None,
+        bot_instance=None,
+        severity: str = 'ERROR'
+    ) -> bool:
+        """
+        Учитывает ошибку и ставит её в очередь на логирование и алерт (не блокирует)
+        
+        Returns: False — очередь переполнена, ошибка учтена только в статистике
+        """
+        error_type = type(error).__name__
+        counts = self.error_counts
+        counts['total'] += 1
+        counts['by_type'][error_type] = counts['by_type'].get(error_type, 0) + 1
+        if bot_instance is not None:
+            self.bot = bot_instance
+        
+        item = (severity, error, context_data or {})
+        try:
+            self._ensure_running()
+        except RuntimeError:
+            # Нет работающего event loop — пишем в лог сразу
+            self._log(*item)
+            self._save_stats()
+            return True
+        
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self._window_dropped += 1
+            return False
+        return True
     
     async def log_error(
-        self, 
-        error: Exception, 
+        self,
+        error: Exception,
         context_data: dict,
         bot_instance=None,
         severity: str = 'ERROR'
@@ -76,14 +196,75 @@ class ErrorMonitor:
             bot_instance: Экземпляр бота для отправки сообщений
             severity: 'ERROR', 'CRITICAL', 'WARNING'
         """
-        # Формирование сообщения
-        error_type = type(error).__name__
-        error_msg = str(error)
-        tb = traceback.format_exc()
+        self.report(error, context_data, bot_instance, severity)
+    
+    # === Фоновая обработка ===
+    
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            loop = asyncio.get_running_loop()
+            if self._queue is None:
+                self._queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+            self._task = loop.create_task(self._consume())
+    
+    async def _consume(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                self._process(*item)
+            except Exception as e:
+                self.logger.error(f"ErrorMonitor: не удалось обработать ошибку: {e}")
+            if self._queue.empty():
+                # Очередь разобрана — статистика уйдёт на диск одной записью через save_interval
+                self._save_stats(self.save_interval)
+    
+    def _process(self, severity: str, error: Exception, context_data: dict, offline: bool = False):
+        key = (severity, type(error).__name__, str(context_data.get('handler', '-')))
+        group = self._window.get(key)
+        if group is not None:
+            group.count += 1
+            return
+        
+        # Первая ошибка группы в окне — в лог с трейсбеком, повторы — итогом при закрытии окна
+        self._window[key] = group = _ErrorGroup(*key, str(error), context_data)
+        self._log(severity, error, context_data)
+        if offline:
+            return
         
-        # Логирование
+        if self._window_timer is None:
+            loop = asyncio.get_running_loop()
+            self._window_timer = loop.call_later(self.alert_window, self._close_window)
+        
+        if severity in ALERT_SEVERITIES and not self._window_alerted:
+            self._window_alerted = True
+            group.alerted = 1
+            self._send(self._format_alert(group))
+    
+    def _close_window(self):
+        window, dropped = self._window, self._window_dropped
+        self._window = {}
+        self._window_timer = None
+        self._window_alerted = False
+        self._window_dropped = 0
+        
+        for group in window.values():
+            if group.count > 1:
+                self.logger.log(
+                    logging.getLevelName(group.severity),
+                    f"{group.severity} | {group.error_type} в {group.handler}: "
+                    f"ещё {group.count - 1} за {self.alert_window:g} с"
+                )
+        if dropped:
+            self.logger.warning(f"ErrorMonitor: очередь переполнена, {dropped} ошибок только посчитаны")
+        
+        groups = [g for g in window.values() if g.severity in ALERT_SEVERITIES]
+        if sum(g.count - g.alerted for g in groups) or dropped:
+            self._send(self._format_digest(groups, dropped))
+    
+    def _log(self, severity: str, error: Exception, context_data: dict):
+        tb = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
         log_msg = (
-            f"{severity} | {error_type}: {error_msg}\n"
+            f"{severity} | {type(error).__name__}: {error}\n"
             f"Context: {context_data}\n"
             f"Traceback:\n{tb}"
         )
@@ -94,55 +275,62 @@ class ErrorMonitor:
             self.logger.warning(log_msg)
         else:
             self.logger.error(log_msg)
+    
+    # === Алерты ===
+    
+    def _send(self, text: str):
+        """Отправляет алерт всем админам в отдельной задаче — обработка очереди не ждёт Telegram"""
+        if self.bot is None or not self.admin_ids:
+            return
+        self.alerts_sent += 1
+        task = asyncio.get_running_loop().create_task(self._send_alert(self.bot, text))
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+    
+    async def _send_alert(self, bot, text: str):
+        """Отправка алерта админам (параллельно)"""
+        async def send(admin_id):
+            try:
+                await bot.send_message(chat_id=admin_id, text=text)
+            except Exception as e:
+                self.logger.warning(f"Failed to send alert to admin {admin_id}: {e}")
         
-        # Статистика
-        self.error_counts['total'] += 1
-        self.error_counts['by_type'][error_type] = \
-            self.error_counts['by_type'].get(error_type, 0) + 1
-        self._save_stats()
-        
-        # Алерт админу (только для ERROR и CRITICAL)
-        if severity in ['ERROR', 'CRITICAL'] and bot_instance:
-            await self._send_alert(
-                bot_instance, 
-                error_type, 
-                error_msg, 
-                context_data,
-                severity
-            )
-    
-    async def _send_alert(
-        self, 
-        bot, 
-        error_type: str, 
-        error_msg: str, 
-        context: dict,
-        severity: str
-    ):
-        """Отправка алерта админу"""
-        emoji = '🔥' if severity == 'CRITICAL' else '⚠️'
+        await asyncio.gather(*(send(admin_id) for admin_id in self.admin_ids))
+    
+    def _format_alert(self, group: _ErrorGroup) -> str:
+        emoji = '🔥' if group.severity == 'CRITICAL' else '⚠️'
         
         alert = (
-            f"{emoji} **{severity}**: {error_type}\n\n"
-            f"**Message:** {error_msg[:200]}\n\n"
-            f"**Context:**\n"
+            f"{emoji} {group.severity}: {group.error_type}\n\n"
+            f"Message: {group.message[:200]}\n\n"
+            f"Context:\n"
         )
         
-        for key, value in context.items():
-            alert += f"  • {key}: {value}\n"
+        for key, value in group.context.items():
+            alert += f"  • {key}: {str(value)[:100]}\n"
         
         alert += f"\n🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        return alert
+    
+    def _format_digest(self, groups: list, dropped: int) -> str:
+        total = sum(g.count for g in groups) + dropped
+        critical = any(g.severity == 'CRITICAL' for g in groups)
+        emoji = '🔥' if critical else '⚠️'
         
-        # Отправка всем админам
-        for admin_id in self.admin_ids:
-            try:
-                await bot.send_message(
-                    chat_id=admin_id,
-                    text=alert,
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                self.logger.error(f"Failed to send alert to admin {admin_id}: {e}")
+        digest = f"{emoji} Ошибок за {self.alert_window:g} с: {total}\n\n"
+        groups = sorted(groups, key=lambda g: g.count, reverse=True)
+        for g in groups[:DIGEST_TOP]:
+            digest += f"  • {g.count} × {g.error_type} ({g.handler}): {g.message[:100]}\n"
+        if len(groups) > DIGEST_TOP:
+            rest = sum(g.count for g in groups[DIGEST_TOP:])
+            digest += f"  • ещё {len(groups) - DIGEST_TOP} видов: {rest}\n"
+        if dropped:
+            digest += f"  • без подробностей (очередь переполнена): {dropped}\n"
+        
+        digest += f"\n🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        return digest
+    
+    # === Статистика ===
     
     def get_stats(self) -> str:
         """Статистика ошибок для админа"""
@@ -158,12 +346,31 @@ class ErrorMonitor:
             for error_type, count in sorted_errors[:10]:
                 msg += f"  • {error_type}: {count}\n"
         
+        if self.dropped:
+            msg += f"\nDropped (queue full): {self.dropped}\n"
+        
         return msg
     
     def reset_stats(self):
         """Сброс статистики"""
         self.error_counts = {'total': 0, 'by_type': {}}
         self._save_stats()
+    
+    def close(self):
+        """Останавливает фоновую обработку: очередь дописывается в лог, статистика сохраняется"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._window_timer is not None:
+            self._window_timer.cancel()
+            self._window_timer = None
+        
+        # Неразобранное — только в лог: отправлять алерты при остановке уже некуда
+        self.bot = None
+        while self._queue is not None and not self._queue.empty():
+            self._process(*self._queue.get_nowait(), offline=True)
+        self._close_window()
+        self._save_stats()
 
 # Декоратор для автоматической обработки ошибок
 def handle_errors(error_monitor):
@@ -190,8 +397,8 @@ def handle_errors(error_monitor):
                     'message_text': update.message.text if update.message else 'N/A'
                 }
                 
-                # Логирование
-                await error_monitor.log_error(
+                # Логирование и алерт — в фоне
+                error_monitor.report(
                     error=e,
                     context_data=context_data,
                     bot_instance=context.bot,
@@ -207,3 +414,75 @@ def handle_errors(error_monitor):
         
         return wrapper
     return decorator
+
+
+if __name__ == "__main__":
+    # Шторм ошибок: 10 000 ошибок четырёх видов из трёх хендлеров за ~2 с при фейковом
+    # Telegram с задержкой 50 мс. Хендлер не должен ждать (report() — микросекунды),
+    # админам — не больше двух сообщений за окно, в логе — не больше двух строк на группу
+    # за окно (первая ошибка и итог), статистика — точная и на диске
+    import sys
+    import tempfile
+    
+    errors_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    window = 0.5
+    log_dir = tempfile.mkdtemp()
+    
+    class FakeBot:
+        def __init__(self):
+            self.messages = 0
+        
+        async def send_message(self, chat_id, text, parse_mode=None):
+            await asyncio.sleep(0.05)
+            self.messages += 1
+    
+    async def storm():
+        bot = FakeBot()
+        monitor = ErrorMonitor([1, 2, 2], log_dir=log_dir, alert_window=window, save_interval=0.2)
+        monitor.logger.handlers = [h for h in monitor.logger.handlers if isinstance(h, DailyFileHandler)]
+        kinds = (ValueError, KeyError, TimeoutError, ConnectionError)
+        latencies = []
+        started = time.monotonic()
+        for i in range(errors_count):
+            try:
+                raise kinds[i % len(kinds)](f"failure {i % 7}")
+            except Exception as e:
+                t0 = time.perf_counter()
+                monitor.report(e, {'user_id': i, 'handler': f"handler_{i % 3}"}, bot)
+                latencies.append(time.perf_counter() - t0)
+            if i % 50 == 49:
+                await asyncio.sleep(0.01)  # между апдейтами event loop свободен
+        elapsed = time.monotonic() - started
+        await asyncio.sleep(window + 0.3)
+        windows = int((time.monotonic() - started) / window) + 1
+        monitor.close()
+        json_store.flush()
+        
+        latencies.sort()
+        p99_us = latencies[int(len(latencies) * 0.99)] * 1e6
+        json_store.invalidate(str(monitor.stats_file))
+        on_disk = json_store.read(str(monitor.stats_file), {}).get('total')
+        log_files = list(Path(log_dir).glob('bot_*.log'))
+        log_lines = sum(1 for f in log_files for line in open(f, encoding='utf-8') if ' | ' in line)
+        
+        print(f"{errors_count} ошибок за {elapsed:.2f} с: report() p99 {p99_us:.1f} мкс, "
+              f"макс. {latencies[-1] * 1e6:.0f} мкс")
+        print(f"алертов {monitor.alerts_sent} (окон {windows}, админов {len(monitor.admin_ids)}), "
+              f"сообщений {bot.messages}, в статистике {monitor.error_counts['total']}, на диске {on_disk}, "
+              f"отброшено {monitor.dropped}, строк в логе {log_lines}")
+        
+        # Смена дня: запись с временем после полуночи уходит в файл следующего дня
+        handler = next(h for h in monitor.logger.handlers if isinstance(h, DailyFileHandler))
+        record = logging.LogRecord('docgen_bot', logging.ERROR, __file__, 0, "после полуночи", None, None)
+        record.created = handler.rollover_at + 1
+        handler.handle(record)
+        rotated = Path(handler.baseFilename).name
+        print(f"после полуночи: {rotated}")
+        
+        groups = len(kinds) * 3
+        return (p99_us < 100 and monitor.alerts_sent <= 2 * windows
+                and bot.messages == monitor.alerts_sent * len(monitor.admin_ids)
+                and monitor.error_counts['total'] == errors_count and on_disk == errors_count
+                and log_lines <= 2 * groups * windows and rotated != Path(log_files[0]).name)
+    
+    sys.exit(0 if asyncio.run(storm()) else 1)
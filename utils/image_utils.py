@@ -327,10 +327,10 @@ def create_document_image(template_type, user_data, output_path):
 
 # === Асинхронные обёртки для многопользовательского режима ===
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from .metrics import InstrumentedExecutor
 
 # Пул потоков для обработки изображений (макс 20 одновременных)
-_image_executor = ThreadPoolExecutor(max_workers=20, thread_name_prefix='image_')
+_image_executor = InstrumentedExecutor('image', max_workers=20)
 
 
 async def uniqualize_image_async(image_path, output_path, settings=None, add_exif=True):
@@ -0,0 +1,305 @@
+"""
+Общий слой хранения JSON-файлов в data/
+Атомарная запись (временный файл + fsync + os.replace), блокировка на каждый файл,
+отложенная запись со слиянием изменений (много изменений — одна запись)
+и кэш чтения по mtime: неизменённый файл не парсится повторно
+
+Содержимое файла живёт в памяти одним объектом: read() возвращает его без копирования,
+поэтому изменять данные нужно только через update() или write()
+"""
+
+import os
+import copy
+import json
+import time
+import atexit
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# Как часто read() сверяет mtime файла (сек) — между проверками данные отдаются из памяти
+STAT_INTERVAL = 1.0
+# Задержка отложенной записи по умолчанию (сек)
+DEFAULT_DELAY = 1.0
+# Отступ в файлах (как и раньше, файлы остаются читаемыми)
+JSON_INDENT = 2
+
+_MISSING = object()
+
+_read_time = metrics.file_io('json_read')
+_write_time = metrics.file_io('json_write')
+
+
+class _Entry:
+    """Состояние одного файла: данные, отпечаток с диска, отложенная запись"""
+
+    __slots__ = ("lock", "data", "stamp", "checked_at", "dirty", "timer")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = _MISSING
+        self.stamp: Optional[Tuple[int, int]] = None  # (mtime_ns, размер)
+        self.checked_at = 0.0
+        self.dirty = False
+        self.timer: Optional[threading.Timer] = None
+
+
+_entries: Dict[str, _Entry] = {}
+_entries_lock = threading.Lock()
+
+
+def _entry(path: str) -> _Entry:
+    entry = _entries.get(path)
+    if entry is None:
+        with _entries_lock:
+            entry = _entries.get(path)
+            if entry is None:
+                entry = _entries[path] = _Entry()
+    return entry
+
+
+def _stamp(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _refresh(path: str, entry: _Entry, default: Any):
+    """Перечитывает файл, если он изменился на диске (вызывать под entry.lock)"""
+    entry.checked_at = time.monotonic()
+    # Несохранённые изменения важнее содержимого диска
+    if entry.dirty and entry.data is not _MISSING:
+        return
+
+    stamp = _stamp(path)
+    if entry.data is not _MISSING and stamp == entry.stamp:
+        return
+
+    data = _MISSING
+    if stamp is not None:
+        started = time.perf_counter()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError, UnicodeDecodeError) as e:
+            logger.error(f"Ошибка чтения {path}: {e}")
+        _read_time.observe(time.perf_counter() - started)
+    if data is _MISSING:
+        data = copy.deepcopy(default) if default is not None else {}
+
+    entry.data = data
+    entry.stamp = stamp
+
+
+def _flush_entry(path: str, entry: _Entry) -> bool:
+    """Пишет данные файла на диск атомарно (вызывать под entry.lock)"""
+    if entry.timer is not None:
+        entry.timer.cancel()
+        entry.timer = None
+    if not entry.dirty:
+        return True
+
+    tmp_path = path + ".tmp"
+    started = time.perf_counter()
+    try:
+        payload = json.dumps(entry.data, ensure_ascii=False, indent=JSON_INDENT)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.error(f"Ошибка сохранения {path}: {e}")
+        return False
+    finally:
+        _write_time.observe(time.perf_counter() - started)
+
+    entry.dirty = False
+    entry.stamp = _stamp(path)
+    entry.checked_at = time.monotonic()
+    return True
+
+
+def _schedule(path: str, entry: _Entry, delay: float):
+    """Откладывает запись; изменения до её выполнения попадут в ту же запись"""
+    if entry.timer is None:
+        entry.timer = threading.Timer(delay, flush, args=(path,))
+        entry.timer.daemon = True
+        entry.timer.start()
+
+
+def read(path: str, default: Any = None) -> Any:
+    """
+    Содержимое JSON-файла (default, если файла нет или он повреждён)
+    Файл парсится только при изменении mtime/размера; возвращаемый объект общий — не изменять
+    """
+    entry = _entry(path)
+    data = entry.data
+    if data is not _MISSING and (entry.dirty or time.monotonic() - entry.checked_at < STAT_INTERVAL):
+        return data
+
+    with entry.lock:
+        _refresh(path, entry, default)
+        return entry.data
+
+
+def update(
+    path: str,
+    mutate: Callable[[Any], Any],
+    default: Any = None,
+    delay: float = 0.0
+) -> Tuple[Any, bool]:
+    """
+    Изменяет данные файла под его блокировкой (чтение-изменение-запись без потерь)
+    mutate получает текущие данные и меняет их на месте.
+    Returns: (результат mutate, записано ли на диск)
+    delay > 0 — запись откладывается и сливается с последующими изменениями (всегда True).
+    Если немедленная запись не удалась, изменение откатывается: в памяти остаётся то же,
+    что на диске, плюс ранее отложенные изменения — их запись повторяется, как во flush()
+    """
+    entry = _entry(path)
+    with entry.lock:
+        _refresh(path, entry, default)
+        # Копия нужна, только если в памяти есть ещё не записанные изменения —
+        # иначе откат равен повторному чтению файла
+        backup = copy.deepcopy(entry.data) if delay <= 0 and entry.dirty else _MISSING
+        result = mutate(entry.data)
+        entry.dirty = True
+        if delay > 0:
+            _schedule(path, entry, delay)
+            return result, True
+        if _flush_entry(path, entry):
+            return result, True
+
+        if backup is _MISSING:
+            entry.data = _MISSING
+            entry.stamp = None
+            entry.dirty = False
+        else:
+            entry.data = backup
+            _schedule(path, entry, DEFAULT_DELAY)
+        return result, False
+
+
+def write(path: str, data: Any, delay: float = 0.0) -> bool:
+    """Заменяет данные файла целиком; delay > 0 — запись отложенная"""
+    entry = _entry(path)
+    with entry.lock:
+        entry.data = data
+        entry.dirty = True
+        if delay > 0:
+            _schedule(path, entry, delay)
+            return True
+        if _flush_entry(path, entry):
+            return True
+        # Повторим позже, как во flush(): данные остаются в памяти
+        _schedule(path, entry, DEFAULT_DELAY)
+        return False
+
+
+def flush(path: Optional[str] = None) -> bool:
+    """Записывает отложенные изменения одного файла или всех файлов"""
+    if path is not None:
+        entries = [(path, _entries.get(path))]
+    else:
+        with _entries_lock:
+            entries = list(_entries.items())
+
+    ok = True
+    for file_path, entry in entries:
+        if entry is None:
+            continue
+        with entry.lock:
+            if not _flush_entry(file_path, entry):
+                ok = False
+                # Повторим позже, данные остаются в памяти
+                _schedule(file_path, entry, DEFAULT_DELAY)
+    return ok
+
+
+def invalidate(path: str):
+    """Сбрасывает кэш файла (несохранённые изменения записываются)"""
+    entry = _entries.get(path)
+    if entry is not None:
+        with entry.lock:
+            _flush_entry(path, entry)
+            entry.data = _MISSING
+            entry.stamp = None
+
+
+atexit.register(flush)
+
+
+if __name__ == "__main__":
+    # Нагрузочная проверка: много потоков увеличивают счётчики в одном файле,
+    # часть изменений — отложенные, часть — немедленные; ни одно не должно потеряться
+    import sys
+    import tempfile
+
+    threads_count = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    target = os.path.join(tempfile.mkdtemp(), "stress.json")
+
+    def increment(data, key):
+        data[key] = data.get(key, 0) + 1
+        data["total"] = data.get("total", 0) + 1
+
+    def worker(n):
+        for i in range(per_thread):
+            update(target, lambda d: increment(d, f"t{n}"), default={}, delay=0.0 if i % 50 == 0 else 0.01)
+            if i % 25 == 0:
+                read(target, {})
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads_count)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    flush()
+    elapsed = time.perf_counter() - started
+
+    with open(target, 'r', encoding='utf-8') as f:
+        on_disk = json.load(f)
+    expected = threads_count * per_thread
+    lost = expected - on_disk.get("total", 0)
+    per_key_ok = all(on_disk.get(f"t{n}") == per_thread for n in range(threads_count))
+
+    print(f"{threads_count} потоков x {per_thread} изменений: total={on_disk.get('total')} "
+          f"(ожидалось {expected}), потеряно {lost}, счётчики потоков верны: {per_key_ok}, "
+          f"{elapsed:.2f} с")
+
+    # Сбой записи: update() сообщает о нём, изменение откатывается,
+    # а ранее отложенные изменения записываются повторно
+    failing = os.path.join(os.path.dirname(target), "failing.json")
+    write(failing, {"a": 1})
+    real_replace = os.replace
+
+    def broken_replace(src, dst):
+        raise OSError("диск недоступен")
+
+    os.replace = broken_replace
+    try:
+        result, saved = update(failing, lambda d: d.setdefault("b", 2))
+        rolled_back = read(failing) == {"a": 1}
+        update(failing, lambda d: d.update(c=3), delay=60)
+        _, saved_with_pending = update(failing, lambda d: d.update(b=2))
+        kept_pending = read(failing) == {"a": 1, "c": 3}
+        retry_scheduled = _entries[failing].timer is not None
+    finally:
+        os.replace = real_replace
+    flush(failing)
+    with open(failing, 'r', encoding='utf-8') as f:
+        retried = json.load(f) == {"a": 1, "c": 3}
+    failure_ok = (result == 2 and not saved and rolled_back and not saved_with_pending
+                  and kept_pending and retry_scheduled and retried)
+    print(f"сбой записи: сообщён {not saved}, откат {rolled_back}, "
+          f"отложенные изменения сохранены и записаны повторно {kept_pending and retry_scheduled and retried}")
+    sys.exit(0 if lost == 0 and per_key_ok and failure_ok else 1)
@@ -0,0 +1,532 @@
+"""
+Общий примитив ограничения частоты
+Токен-бакет в объекте со __slots__ (O(1) на проверку, постоянная память на пользователя)
+и хранилище записей по пользователям, из которого фоновый поток вытесняет простаивающих.
+Состояние именованных хранилищ периодически сохраняется через LimiterBackend
+(по умолчанию — компактный бинарный снимок в data/) и восстанавливается при старте
+"""
+
+import os
+import time
+import struct
+import logging
+import threading
+import weakref
+from abc import ABC, abstractmethod
+from array import array
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# Запись без активности дольше этого срока вытесняется (должен быть не меньше окна лимита)
+DEFAULT_IDLE_TTL = 600.0
+# Период обхода хранилищ фоновым потоком
+SWEEP_INTERVAL = 60.0
+
+_snapshot_time = metrics.file_io('limiter_snapshot')
+
+
+class TokenBucket:
+    """
+    Токен-бакет: не больше capacity событий подряд, восполнение capacity за period секунд
+    Ёмкость и период передаются в take(), поэтому изменение лимитов на лету
+    (например, из админ-панели) сразу действует на все записи
+    """
+
+    __slots__ = ("tokens", "updated", "blocked_until", "strikes")
+
+    def __init__(self):
+        self.tokens = 0.0
+        self.updated = 0.0  # 0 — бакет ещё не использовался (полный)
+        self.blocked_until = 0.0
+        self.strikes = 0  # отказов подряд
+
+    def take(self, now: float, capacity: int, period: float) -> bool:
+        """Забирает токен, если он есть. Returns: разрешено ли событие"""
+        if self.updated:
+            tokens = self.tokens + (now - self.updated) * capacity / period
+            if tokens > capacity:
+                tokens = capacity
+        else:
+            tokens = capacity
+        self.updated = now
+
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            self.strikes = 0
+            return True
+
+        self.tokens = tokens
+        self.strikes += 1
+        return False
+
+    def used(self, now: float, capacity: int, period: float) -> int:
+        """Сколько событий «занято» в окне (capacity минус доступные токены)"""
+        if not self.updated:
+            return 0
+        tokens = min(capacity, self.tokens + (now - self.updated) * capacity / period)
+        return int(capacity - tokens)
+
+    def retry_after(self, now: float, capacity: int, period: float) -> float:
+        """Через сколько секунд появится следующий токен"""
+        if not self.updated:
+            return 0.0
+        tokens = self.tokens + (now - self.updated) * capacity / period
+        return 0.0 if tokens >= 1 else (1 - tokens) * period / capacity
+
+    def blocked_for(self, now: float) -> float:
+        """Оставшееся время блокировки в секундах (0 — не заблокирован)"""
+        if self.blocked_until:
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.blocked_until = 0.0
+        return 0.0
+
+    def block(self, now: float, seconds: float):
+        self.blocked_until = now + seconds
+
+    def is_idle(self, now: float, ttl: float) -> bool:
+        """Запись можно выбросить: бакет давно полон и блокировки нет"""
+        return now - self.updated >= ttl and self.blocked_until <= now
+
+    # Сериализация для снимков: фиксированный размер записи
+    STATE = struct.Struct('<dddI')
+
+    def to_bytes(self) -> bytes:
+        return self.STATE.pack(self.tokens, self.updated, self.blocked_until, self.strikes)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        bucket = cls()
+        bucket.tokens, bucket.updated, bucket.blocked_until, bucket.strikes = cls.STATE.unpack(data)
+        return bucket
+
+
+class RepeatBucket:
+    """
+    Счётчики повторов ключей (например, хэшей сообщений) за скользящее окно
+    У каждого из SLOTS последних разных ключей свой токен-бакет, поэтому повторы
+    считаются по всему окну, а не только подряд (A, B, A, B… тоже упирается в лимит).
+    Новый ключ занимает слот, в котором за окно меньше всего повторов
+    """
+
+    SLOTS = 8
+
+    __slots__ = ("keys", "state")
+
+    def __init__(self):
+        self.keys = array('Q', bytes(8 * self.SLOTS))  # 0 — слот свободен
+        self.state = array('d', bytes(16 * self.SLOTS))  # (токены, время обновления) на слот
+
+    def take_key(self, now: float, key: int, capacity: int, period: float) -> bool:
+        """Забирает токен ключа, если он есть. Returns: разрешено ли событие"""
+        keys, state = self.keys, self.state
+        try:
+            i = 2 * keys.index(key)
+        except ValueError:
+            i = 2 * self._victim(now, capacity, period)
+            keys[i // 2] = key
+            state[i + 1] = 0.0
+
+        updated = state[i + 1]
+        if updated:
+            tokens = state[i] + (now - updated) * capacity / period
+            if tokens > capacity:
+                tokens = capacity
+        else:
+            tokens = capacity
+        state[i + 1] = now
+
+        if tokens >= 1:
+            state[i] = tokens - 1
+            return True
+        state[i] = tokens
+        return False
+
+    def _victim(self, now: float, capacity: int, period: float) -> int:
+        """Слот для нового ключа: свободный или с наибольшим числом токенов"""
+        state = self.state
+        victim, most = 0, -1.0
+        for slot in range(self.SLOTS):
+            updated = state[2 * slot + 1]
+            if not updated:
+                return slot
+            tokens = state[2 * slot] + (now - updated) * capacity / period
+            if tokens > most:
+                victim, most = slot, tokens
+        return victim
+
+    def is_idle(self, now: float, ttl: float) -> bool:
+        return now - max(self.state[1::2]) >= ttl
+
+    # Ключи — целочисленные хэши (см. AntiSpam._hash_message)
+    STATE = struct.Struct(f'<{SLOTS}Q{2 * SLOTS}d')
+
+    def to_bytes(self) -> bytes:
+        return self.STATE.pack(*self.keys, *self.state)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        bucket = cls()
+        values = cls.STATE.unpack(data)
+        bucket.keys = array('Q', values[:cls.SLOTS])
+        bucket.state = array('d', values[cls.SLOTS:])
+        return bucket
+
+
+class LimiterStore:
+    """
+    Записи ограничителя по ключу (обычно user_id)
+    Все обращения к записям выполняются под self.lock; простаивающие записи
+    (record.is_idle(now, ttl)) вытесняются фоновым потоком раз в SWEEP_INTERVAL секунд.
+    Хранилище с именем (name) попадает в снимки состояния: тогда factory — класс записи
+    с STATE (struct.Struct), to_bytes() и from_bytes(), а ключи — целые числа
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], object],
+        idle_ttl: float = DEFAULT_IDLE_TTL,
+        name: Optional[str] = None
+    ):
+        self.factory = factory
+        self.idle_ttl = idle_ttl
+        self.name = name
+        self.lock = threading.Lock()
+        self.records: Dict[Hashable, object] = {}
+        self.evicted = 0
+        _sweeper.register(self)
+        if name:
+            _named_stores[name] = self
+
+    def get(self, key: Hashable):
+        """Запись по ключу, создаётся при первом обращении (вызывать под self.lock)"""
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = self.factory()
+        return record
+
+    def peek(self, key: Hashable):
+        """Запись по ключу или None (вызывать под self.lock)"""
+        return self.records.get(key)
+
+    def discard(self, key: Hashable):
+        with self.lock:
+            self.records.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Вытесняет простаивающие записи. Returns: сколько вытеснено"""
+        now = time.time() if now is None else now
+        ttl = self.idle_ttl
+
+        # Снимок под блокировкой, проверка — без неё, удаление — с повторной проверкой
+        with self.lock:
+            items = list(self.records.items())
+        idle = [key for key, record in items if record.is_idle(now, ttl)]
+        if not idle:
+            return 0
+
+        evicted = 0
+        with self.lock:
+            for key in idle:
+                record = self.records.get(key)
+                if record is not None and record.is_idle(now, ttl):
+                    del self.records[key]
+                    evicted += 1
+            # Словарь не уменьшает таблицу при удалении: после массового вытеснения — копия
+            if evicted > len(self.records):
+                self.records = dict(self.records)
+        self.evicted += evicted
+        return evicted
+
+    def export(self, now: Optional[float] = None) -> List[Tuple[int, bytes]]:
+        """Записи для снимка: (ключ, байты). Простаивающие не сохраняются — они равны новым"""
+        now = time.time() if now is None else now
+        ttl = self.idle_ttl
+        with self.lock:
+            items = list(self.records.items())
+        # Сериализация вне блокировки: запись могут менять параллельно,
+        # в худшем случае в снимок попадёт состояние на одно событие старше
+        return [(key, record.to_bytes()) for key, record in items if not record.is_idle(now, ttl)]
+
+    def restore(self, entries: List[Tuple[int, bytes]]) -> int:
+        """Загружает записи из снимка (уже существующие ключи не трогает). Returns: сколько загружено"""
+        loaded = 0
+        with self.lock:
+            for key, data in entries:
+                if key not in self.records:
+                    self.records[key] = self.factory.from_bytes(data)
+                    loaded += 1
+        return loaded
+
+
+class _Sweeper:
+    """Фоновый поток, обходящий все созданные LimiterStore"""
+
+    def __init__(self, interval: float = SWEEP_INTERVAL):
+        self.interval = interval
+        self._stores = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, store: LimiterStore):
+        with self._lock:
+            self._stores.add(store)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='limiter-sweeper', daemon=True)
+                self._thread.start()
+
+    def sweep_all(self) -> int:
+        with self._lock:
+            stores = list(self._stores)
+        return sum(store.sweep() for store in stores)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                evicted = self.sweep_all()
+                if evicted:
+                    logger.debug(f"Limiter sweep: evicted {evicted} idle records")
+            except Exception as e:
+                logger.error(f"Limiter sweep failed: {e}")
+
+
+_sweeper = _Sweeper()
+_named_stores: "weakref.WeakValueDictionary[str, LimiterStore]" = weakref.WeakValueDictionary()
+
+
+def sweep_idle() -> int:
+    """Немедленно вытесняет простаивающие записи во всех хранилищах"""
+    return _sweeper.sweep_all()
+
+
+# === Сохранение состояния между перезапусками ===
+
+class LimiterBackend(ABC):
+    """
+    Хранилище состояния ограничителей между перезапусками
+    Данные — {имя хранилища: [(ключ, байты записи)]}; записи фиксированного размера,
+    поэтому Redis-совместимая реализация может держать каждое хранилище в хэше
+    (HSET name key bytes) и читать его через HGETALL
+    """
+
+    @abstractmethod
+    def save(self, snapshot: Dict[str, List[Tuple[int, bytes]]]):
+        ...
+
+    @abstractmethod
+    def load(self) -> Dict[str, List[Tuple[int, bytes]]]:
+        ...
+
+
+class MemoryBackend(LimiterBackend):
+    """Без сохранения: состояние живёт только в процессе"""
+
+    def save(self, snapshot: Dict[str, List[Tuple[int, bytes]]]):
+        pass
+
+    def load(self) -> Dict[str, List[Tuple[int, bytes]]]:
+        return {}
+
+
+class FileSnapshotBackend(LimiterBackend):
+    """
+    Компактный бинарный снимок в файле
+    Формат: MAGIC, затем по каждому хранилищу — длина и имя, размер записи, число записей
+    и записи подряд (int64 ключ + байты состояния). Запись атомарная (tmp + fsync + os.replace)
+    """
+
+    MAGIC = b'LMS1'
+    _HEADER = struct.Struct('<HI')  # размер записи, число записей
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def save(self, snapshot: Dict[str, List[Tuple[int, bytes]]]):
+        chunks = [self.MAGIC]
+        for name, entries in snapshot.items():
+            if not entries:
+                continue
+            size = len(entries[0][1])
+            row = struct.Struct(f'<q{size}s')
+            encoded = name.encode()
+            chunks.append(struct.pack('<B', len(encoded)) + encoded)
+            chunks.append(self._HEADER.pack(size, len(entries)))
+            chunks.append(b''.join(row.pack(key, data) for key, data in entries))
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        started = time.perf_counter()
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(chunks))
+            f.flush()
+            # Без fsync после сбоя на месте снимка мог оказаться пустой или обрезанный файл
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        _snapshot_time.observe(time.perf_counter() - started)
+
+    def load(self) -> Dict[str, List[Tuple[int, bytes]]]:
+        try:
+            with open(self.path, 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return {}
+
+        if not blob.startswith(self.MAGIC):
+            logger.warning(f"Limiter snapshot {self.path}: unknown format, ignored")
+            return {}
+
+        snapshot = {}
+        pos = len(self.MAGIC)
+        try:
+            while pos < len(blob):
+                name_len = blob[pos]
+                name = blob[pos + 1:pos + 1 + name_len].decode()
+                pos += 1 + name_len
+                size, count = self._HEADER.unpack_from(blob, pos)
+                pos += self._HEADER.size
+                row = struct.Struct(f'<q{size}s')
+                end = pos + row.size * count
+                snapshot[name] = list(row.iter_unpack(blob[pos:end]))
+                pos = end
+        except (struct.error, UnicodeDecodeError, IndexError) as e:
+            logger.warning(f"Limiter snapshot {self.path} is damaged: {e}")
+        return snapshot
+
+
+class LimiterSnapshotter:
+    """
+    Периодически сохраняет именованные LimiterStore через backend в фоновом потоке
+    (event loop не блокируется) и восстанавливает их при старте
+    """
+
+    def __init__(self, backend: LimiterBackend, interval: float = 5.0):
+        self.backend = backend
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.saves = 0
+        self.last_records = 0
+        self.last_ms = 0.0
+
+    def restore(self) -> int:
+        """Загружает снимок во все зарегистрированные хранилища. Returns: сколько записей"""
+        snapshot = self.backend.load()
+        loaded = 0
+        for name, store in list(_named_stores.items()):
+            entries = snapshot.get(name)
+            if not entries:
+                continue
+            if len(entries[0][1]) != store.factory.STATE.size:
+                logger.warning(f"Limiter snapshot: record format of '{name}' changed, skipped")
+                continue
+            loaded += store.restore(entries)
+        return loaded
+
+    def save(self) -> int:
+        """Сохраняет снимок. Returns: сколько записей сохранено"""
+        started = time.perf_counter()
+        now = time.time()
+        snapshot = {name: store.export(now) for name, store in list(_named_stores.items())}
+        self.backend.save(snapshot)
+        self.saves += 1
+        self.last_records = sum(len(entries) for entries in snapshot.values())
+        self.last_ms = round((time.perf_counter() - started) * 1000, 2)
+        return self.last_records
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='limiter-snapshot', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                logger.error(f"Limiter snapshot failed: {e}")
+
+    def close(self):
+        """Останавливает поток и сохраняет последний снимок"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.save()
+
+    def get_stats(self) -> Dict:
+        return {
+            "saves": self.saves,
+            "records": self.last_records,
+            "last_ms": self.last_ms,
+        }
+
+
+if __name__ == "__main__":
+    # Память ограничителей на 100k разных пользователей (по 5 событий через все пять классов:
+    # AntiFlood, AntiSpam, BotDetector, RateLimiter по тарифам и utils.performance.RateLimiter)
+    # и вытеснение после простоя. python -m utils.limiter [пользователей] [событий]
+    import sys
+    import tracemalloc
+
+    from utils.security import AntiFlood, AntiSpam, BotDetector
+    from utils.rate_limiter import RateLimiter as PlanRateLimiter
+    from utils.performance import RateLimiter as RequestRateLimiter
+
+    users_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    logging.basicConfig(level=logging.CRITICAL)
+
+    tracemalloc.start()
+    flood = AntiFlood(max_messages=30, window_seconds=60, ban_duration=60)
+    spam = AntiSpam(duplicate_threshold=10, window_seconds=60)
+    detector = BotDetector()
+    plan_limiter = PlanRateLimiter()
+    request_limiter = RequestRateLimiter()
+    stores = [flood.store, spam.store, detector.store, plan_limiter.store, request_limiter.store]
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    for i in range(events):
+        text = f"сообщение {i}"
+        for user_id in range(users_count):
+            flood.check(user_id)
+            spam.check(user_id, text)
+            detector.record_action(user_id, "message")
+            plan_limiter.is_rate_limited(user_id, 'free')
+            request_limiter.is_allowed(user_id)
+    per_event_us = (time.perf_counter() - started) / (users_count * events) * 1e6
+    live = tracemalloc.get_traced_memory()[0] - baseline
+    records = sum(len(store) for store in stores)
+
+    started = time.perf_counter()
+    idle_at = time.time() + max(store.idle_ttl for store in stores) + 1
+    evicted = sum(store.sweep(idle_at) for store in stores)
+    sweep_s = time.perf_counter() - started
+    left = sum(len(store) for store in stores)
+    after_sweep = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    # Повторы по всему окну: чередование «A»/«B» упирается в порог так же, как повтор подряд
+    alternating = AntiSpam(duplicate_threshold=10, window_seconds=60)
+    verdicts = [alternating.check(1, "AB"[i % 2])[0] for i in range(2 * alternating.duplicate_threshold + 1)]
+    repeats = verdicts.count(False) == 2 * alternating.duplicate_threshold and verdicts[-1]
+
+    print(f"{users_count} пользователей x {events} событий: {live / 2 ** 20:.1f} МиБ "
+          f"({live / users_count:.0f} байт на пользователя, {records} записей), "
+          f"{per_event_us:.1f} мкс на событие (5 проверок)")
+    print(f"вытеснение после простоя: {evicted} записей за {sweep_s:.2f} с, осталось {left}, "
+          f"память {after_sweep / 2 ** 20:.1f} МиБ")
+    print(f"чередование двух текстов: спам на {verdicts.index(True) + 1 if True in verdicts else '-'}-м сообщении "
+          f"(порог {alternating.duplicate_threshold} повторов каждого)")
+    sys.exit(0 if records == 5 * users_count and left == 0 and after_sweep < live * 0.1 and repeats else 1)
@@ -3,8 +3,14 @@
 """
 
 import json
+import logging
 import os
-from typing import Dict, Any, Optional
+import threading
+from typing import Dict, Any, Optional, List
+
+from utils import json_store
+
+logger = logging.getLogger(__name__)
 
 # Путь к файлам локализации (относительный путь)
 LOCALES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "locales")
@@ -15,6 +21,19 @@ USER_SETTINGS_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "d
 # Кэш загруженных локализаций
 _locales_cache: Dict[str, Dict] = {}
 
+# Скомпилированные каталоги: язык -> {"ключ.через.точку": строка}, фолбэк на ru уже подставлен
+_catalogs: Dict[str, Dict[str, str]] = {}
+# Ключи строк с подстановками {...} — только их форматируем
+_templates: Dict[str, frozenset] = {}
+# Отчёт валидации: язык -> ключи, которых нет в файле языка (взяты из ru)
+_missing_keys: Dict[str, List[str]] = {}
+_catalogs_lock = threading.Lock()
+# Вызываются после перекомпиляции локалей (сброс кэшей, зависящих от текстов)
+_reload_callbacks: List = []
+
+# Задержка записи настроек на диск (сек) — частые смены языка сливаются в одну запись
+SETTINGS_SAVE_DELAY = 1.0
+
 # Доступные языки
 AVAILABLE_LANGUAGES = {
     "ru": "🇷🇺 Русский",
@@ -45,37 +64,85 @@ def load_locale(lang_code: str) -> Dict:
         return {}
 
 
+def _flatten(data: Dict, prefix: str = "") -> Dict[str, str]:
+    """{"a": {"b": "x"}} -> {"a.b": "x"} (только строковые значения)"""
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, str):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compile_locales() -> Dict[str, List[str]]:
+    """
+    Компиляция всех локалей в плоские каталоги с подставленным фолбэком на ru.
+    Возвращает отчёт: язык -> список отсутствующих ключей.
+    """
+    global _catalogs, _templates, _missing_keys
+    with _catalogs_lock:
+        _locales_cache.clear()
+        base = _flatten(load_locale(DEFAULT_LANGUAGE))
+        
+        catalogs, templates, missing = {}, {}, {}
+        for lang_code in AVAILABLE_LANGUAGES:
+            own = base if lang_code == DEFAULT_LANGUAGE else _flatten(load_locale(lang_code))
+            catalogs[lang_code] = {**base, **own}
+            templates[lang_code] = frozenset(
+                key for key, value in catalogs[lang_code].items() if "{" in value or "}" in value
+            )
+            missing[lang_code] = sorted(base.keys() - own.keys())
+            if missing[lang_code]:
+                logger.warning(
+                    f"Locale {lang_code}: {len(missing[lang_code])} keys missing, "
+                    f"using {DEFAULT_LANGUAGE}: {', '.join(missing[lang_code][:10])}"
+                )
+        
+        _catalogs, _templates, _missing_keys = catalogs, templates, missing
+    
+    for callback in _reload_callbacks:
+        callback()
+    return missing
+
+
+def on_locales_reload(callback):
+    """Регистрация функции, вызываемой после каждой компиляции локалей"""
+    _reload_callbacks.append(callback)
+    return callback
+
+
+def get_missing_keys() -> Dict[str, List[str]]:
+    """Отчёт валидации последней компиляции локалей"""
+    if not _catalogs:
+        compile_locales()
+    return _missing_keys
+
+
 def load_user_settings() -> Dict:
-    """Загрузка настроек пользователей"""
-    if not os.path.exists(USER_SETTINGS_FILE):
-        return {}
-    
-    try:
-        with open(USER_SETTINGS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return {}
+    """Настройки пользователей (из памяти utils/json_store; результат не изменять)"""
+    return json_store.read(USER_SETTINGS_FILE, {})
 
 
 def save_user_settings(settings: Dict):
-    """Сохранение настроек пользователей"""
-    os.makedirs(os.path.dirname(USER_SETTINGS_FILE), exist_ok=True)
-    
-    with open(USER_SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(settings, f, ensure_ascii=False, indent=2)
+    """Сохранение настроек пользователей (в памяти сразу, на диск — отложенно)"""
+    json_store.write(USER_SETTINGS_FILE, settings, delay=SETTINGS_SAVE_DELAY)
+
+
+def flush_user_settings():
+    """Записать отложенные изменения настроек на диск"""
+    json_store.flush(USER_SETTINGS_FILE)
 
 
 def is_new_user(user_id: int) -> bool:
     """Проверка, новый ли пользователь (не выбирал язык)"""
-    settings = load_user_settings()
-    user_data = settings.get(str(user_id), {})
+    user_data = load_user_settings().get(str(user_id), {})
     return "language" not in user_data
 
 
 def get_user_language(user_id: int) -> str:
     """Получение языка пользователя"""
-    settings = load_user_settings()
-    return settings.get(str(user_id), {}).get("language", DEFAULT_LANGUAGE)
+    return load_user_settings().get(str(user_id), {}).get("language", DEFAULT_LANGUAGE)
 
 
 def set_user_language(user_id: int, lang_code: str) -> bool:
@@ -83,16 +150,10 @@ def set_user_language(user_id: int, lang_code: str) -> bool:
     if lang_code not in AVAILABLE_LANGUAGES:
         return False
     
-    settings = load_user_settings()
+    def mutate(settings):
+        settings.setdefault(str(user_id), {})["language"] = lang_code
     
-    if str(user_id) not in settings:
-        settings[str(user_id)] = {}
-    
-    settings[str(user_id)]["language"] = lang_code
-    save_user_settings(settings)
-    
-    # Очистить кэш для обновления
-    _locales_cache.clear()
+    json_store.update(USER_SETTINGS_FILE, mutate, {}, delay=SETTINGS_SAVE_DELAY)
     
     return True
 
@@ -105,41 +166,70 @@ def get_text(key: str, user_id: int = None, **kwargs) -> str:
     get_text("subscription.activated", user_id)
     get_text("welcome", user_id)
     """
+    if not _catalogs:
+        compile_locales()
+    
     if user_id is None:
         lang_code = DEFAULT_LANGUAGE
     else:
         lang_code = get_user_language(user_id)
     
-    locale = load_locale(lang_code)
-    
-    # Разбиваем ключ по точкам для вложенных значений
-    keys = key.split(".")
-    value = locale
-    
-    for k in keys:
-        if isinstance(value, dict) and k in value:
-            value = value[k]
-        else:
-            # Если ключ не найден, пробуем русскую локализацию
-            ru_locale = load_locale(DEFAULT_LANGUAGE)
-            value = ru_locale
-            for k2 in keys:
-                if isinstance(value, dict) and k2 in value:
-                    value = value[k2]
-                else:
-                    return key  # Возвращаем ключ, если не найдено
-            break
+    # Неизвестный язык — каталог по умолчанию
+    catalog = _catalogs.get(lang_code) or _catalogs[DEFAULT_LANGUAGE]
+    value = catalog.get(key)
+    if value is None:
+        return key  # Возвращаем ключ, если не найдено
     
     # Подставляем переменные
-    if isinstance(value, str) and kwargs:
+    if kwargs and key in _templates.get(lang_code, _templates[DEFAULT_LANGUAGE]):
         try:
             value = value.format(**kwargs)
         except:
             pass
     
-    return value if isinstance(value, str) else key
+    return value
 
 
 def t(key: str, user_id: int = None, **kwargs) -> str:
     """Короткий алиас для get_text"""
     return get_text(key, user_id, **kwargs)
+
+
+if __name__ == "__main__":
+    # Проверка локалей и замер t() против прежнего поиска (вложенные словари из _locales_cache,
+    # при промахе — повторный обход ru): python -m utils.localization
+    import sys
+    import timeit
+    
+    def legacy_lookup(key: str, lang_code: str = DEFAULT_LANGUAGE) -> str:
+        value = load_locale(lang_code)
+        keys = key.split(".")
+        for k in keys:
+            if isinstance(value, dict) and k in value:
+                value = value[k]
+            else:
+                value = load_locale(DEFAULT_LANGUAGE)
+                for k2 in keys:
+                    if isinstance(value, dict) and k2 in value:
+                        value = value[k2]
+                    else:
+                        return key
+                break
+        return value if isinstance(value, str) else key
+    
+    for lang, keys in compile_locales().items():
+        print(f"{lang}: {'OK' if not keys else 'missing ' + ', '.join(keys)}")
+    
+    # Каталоги дают те же строки, что и прежний поиск, включая фолбэк на ru
+    mismatches = [
+        (lang, key) for lang in _catalogs for key in _catalogs[DEFAULT_LANGUAGE]
+        if _catalogs[lang].get(key) != legacy_lookup(key, lang)
+    ]
+    
+    sample = list(_catalogs[DEFAULT_LANGUAGE])[:20]
+    runs = 100_000
+    legacy = timeit.timeit(lambda: [legacy_lookup(key) for key in sample], number=runs // len(sample))
+    elapsed = timeit.timeit(lambda: [t(key) for key in sample], number=runs // len(sample))
+    print(f"прежний поиск: {legacy / runs * 1e9:.0f} ns/call, t(): {elapsed / runs * 1e9:.0f} ns/call "
+          f"(x{legacy / elapsed:.1f}); расхождений со старым поиском: {len(mismatches)}")
+    sys.exit(0 if not mismatches and elapsed < legacy else 1)
@@ -0,0 +1,351 @@
+"""
+Метрики процесса в текстовом формате Prometheus (exposition format 0.0.4)
+Гистограммы с фиксированными границами корзин, счётчики и вычисляемые датчики
+
+Запись не берёт блокировок и ничего не выделяет под новые элементы: у каждого потока
+свой шард — список фиксированной длины, наблюдение увеличивает в нём один элемент.
+Шарды складываются только при чтении (scrape, /stats). Датчики (глубина очередей,
+занятость пулов потоков) вычисляются функциями в момент чтения и на горячем пути
+не стоят ничего
+"""
+
+import time
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Границы корзин по умолчанию (сек): от 1 мс до минуты, плюс +Inf
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HISTOGRAM = "histogram"
+COUNTER = "counter"
+GAUGE = "gauge"
+
+
+class _Sharded:
+    """Слоты фиксированного размера, по копии на каждый пишущий поток"""
+
+    __slots__ = ("_size", "_shards", "_local", "_lock")
+
+    def __init__(self, size: int):
+        self._size = size
+        self._shards: List[list] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _new_shard(self) -> list:
+        shard = [0] * self._size
+        with self._lock:
+            self._shards.append(shard)
+        self._local.shard = shard
+        return shard
+
+    def _totals(self) -> list:
+        totals = [0] * self._size
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+
+class Histogram(_Sharded):
+    """Гистограмма одной серии: счётчики по корзинам (le) и сумма значений"""
+
+    __slots__ = ("bounds",)
+
+    def __init__(self, bounds: Sequence[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        # корзины, +Inf, сумма
+        super().__init__(len(self.bounds) + 2)
+
+    def observe(self, value: float):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard[bisect_left(self.bounds, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self) -> "HistogramSnapshot":
+        totals = self._totals()
+        return HistogramSnapshot(self.bounds, totals[:-1], totals[-1])
+
+
+class HistogramSnapshot:
+    """Сложенные шарды гистограммы; оценка квантилей по корзинам"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...], counts: List[int], total: float):
+        self.bounds = bounds
+        self.counts = counts  # по корзинам, не накопительно; последняя — +Inf
+        self.sum = total
+        self.count = sum(counts)
+
+    def merge(self, other: "HistogramSnapshot") -> "HistogramSnapshot":
+        counts = [a + b for a, b in zip(self.counts, other.counts)]
+        return HistogramSnapshot(self.bounds, counts, self.sum + other.sum)
+
+    def quantile(self, q: float) -> float:
+        """
+        Квантиль с линейной интерполяцией внутри корзины (как histogram_quantile в Prometheus)
+        Значения выше последней границы оцениваются этой границей
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+class Counter(_Sharded):
+    """Монотонный счётчик"""
+
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount: int = 1):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard[0] += amount
+
+    @property
+    def value(self):
+        return self._totals()[0]
+
+
+class Gauge:
+    """Датчик: значение вычисляется функцией в момент чтения"""
+
+    __slots__ = ("func",)
+
+    def __init__(self):
+        self.func: Callable[[], float] = lambda: 0
+
+    def set_function(self, func: Callable[[], float]):
+        self.func = func
+
+    @property
+    def value(self):
+        return self.func()
+
+
+_FACTORIES = {HISTOGRAM: Histogram, COUNTER: Counter, GAUGE: Gauge}
+
+
+class Family:
+    """
+    Метрика с одной меткой: по серии на значение метки
+    Серию лучше получить один раз (labels()) и держать ссылку — тогда запись
+    обходится без поиска в словаре
+    """
+
+    def __init__(self, kind: str, name: str, help_text: str, label: Optional[str], **options):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._options = options
+        self._children: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, value: str = ""):
+        child = self._children.get(value)
+        if child is None:
+            with self._lock:
+                child = self._children.get(value)
+                if child is None:
+                    child = self._children[value] = _FACTORIES[self.kind](**self._options)
+        return child
+
+    def items(self) -> List[Tuple[str, object]]:
+        with self._lock:
+            return sorted(self._children.items())
+
+    def merged(self) -> Optional[HistogramSnapshot]:
+        """Гистограмма по всем значениям метки"""
+        result = None
+        for _, child in self.items():
+            snap = child.snapshot()
+            result = snap if result is None else result.merge(snap)
+        return result
+
+    def _labels(self, value: str, extra: str = "") -> str:
+        parts = []
+        if self.label is not None:
+            parts.append(f'{self.label}="{_escape(value)}"')
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self, out: List[str]):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        for value, child in self.items():
+            if self.kind == HISTOGRAM:
+                snap = child.snapshot()
+                cumulative = 0
+                for bound, count in zip(snap.bounds, snap.counts):
+                    cumulative += count
+                    le = 'le="%s"' % _number(bound)
+                    out.append(f"{self.name}_bucket{self._labels(value, le)} {cumulative}")
+                out.append(f"{self.name}_bucket{self._labels(value, _LE_INF)} {snap.count}")
+                out.append(f"{self.name}_sum{self._labels(value)} {_number(snap.sum)}")
+                out.append(f"{self.name}_count{self._labels(value)} {snap.count}")
+            else:
+                out.append(f"{self.name}{self._labels(value)} {_number(child.value)}")
+
+
+_LE_INF = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value) -> str:
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Реестр метрик процесса; повторная регистрация имени возвращает ту же метрику"""
+
+    def __init__(self):
+        self._families: Dict[str, Family] = {}
+        self._lock = threading.Lock()
+
+    def _family(self, kind: str, name: str, help_text: str, label: Optional[str], **options) -> Family:
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = Family(kind, name, help_text, label, **options)
+            elif family.kind != kind or family.label != label:
+                raise ValueError(f"Metric '{name}' already registered as {family.kind}({family.label})")
+        return family
+
+    def histogram(self, name: str, help_text: str, label: Optional[str] = None,
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Family:
+        return self._family(HISTOGRAM, name, help_text, label, bounds=tuple(buckets))
+
+    def counter(self, name: str, help_text: str, label: Optional[str] = None) -> Family:
+        return self._family(COUNTER, name, help_text, label)
+
+    def gauge(self, name: str, help_text: str, label: Optional[str] = None) -> Family:
+        return self._family(GAUGE, name, help_text, label)
+
+    def get(self, name: str) -> Optional[Family]:
+        return self._families.get(name)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            families = sorted(self._families.values(), key=lambda f: f.name)
+        out: List[str] = []
+        for family in families:
+            family.render(out)
+        out.append("")
+        return "\n".join(out)
+
+
+# Общий реестр процесса — его отдаёт /metrics
+registry = Registry()
+
+
+def file_io(op: str) -> Histogram:
+    """Гистограмма времени файловой операции op (json_read, json_write, ...)"""
+    return registry.histogram(
+        'bot_file_io_seconds', 'Время файловых операций (чтение, запись, fsync)', 'op'
+    ).labels(op)
+
+
+# Пулы потоков с метриками по имени (для /stats)
+executors: Dict[str, "InstrumentedExecutor"] = {}
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor с метриками: ожидание в очереди, время выполнения,
+    число занятых потоков и задач в очереди (насыщение пула = busy / workers)
+    """
+
+    def __init__(self, name: str, max_workers: int, metrics: Registry = None, **kwargs):
+        kwargs.setdefault('thread_name_prefix', f'{name}_')
+        super().__init__(max_workers=max_workers, **kwargs)
+        metrics = metrics or registry
+        self.name = name
+        self.max_workers = max_workers
+        self._wait = metrics.histogram(
+            'bot_executor_wait_seconds', 'Ожидание задачи в очереди пула потоков', 'executor'
+        ).labels(name)
+        self._run_time = metrics.histogram(
+            'bot_executor_run_seconds', 'Время выполнения задачи в пуле потоков', 'executor'
+        ).labels(name)
+        self._submitted = metrics.counter(
+            'bot_executor_submitted_total', 'Задачи, отправленные в пул потоков', 'executor'
+        ).labels(name)
+        self._started = Counter()
+        self._finished = Counter()
+        metrics.gauge('bot_executor_workers', 'Размер пула потоков', 'executor') \
+            .labels(name).set_function(lambda: self.max_workers)
+        metrics.gauge('bot_executor_busy', 'Потоки пула, занятые задачами', 'executor') \
+            .labels(name).set_function(lambda: self.load()[0])
+        metrics.gauge('bot_executor_queued', 'Задачи, ждущие свободного потока', 'executor') \
+            .labels(name).set_function(lambda: self.load()[1])
+        executors[name] = self
+
+    def submit(self, fn, /, *args, **kwargs):
+        self._submitted.inc()
+        return super().submit(self._timed, time.perf_counter(), fn, args, kwargs)
+
+    def _timed(self, submitted_at: float, fn, args, kwargs):
+        started = time.perf_counter()
+        self._wait.observe(started - submitted_at)
+        self._started.inc()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._run_time.observe(time.perf_counter() - started)
+            self._finished.inc()
+
+    def load(self) -> Tuple[int, int]:
+        """(занято потоков, задач в очереди)"""
+        # Порядок чтения не даёт отрицательных значений: счётчики только растут
+        finished = self._finished.value
+        started = self._started.value
+        submitted = self._submitted.value
+        return started - finished, submitted - started
+
+    def get_stats(self) -> Dict:
+        busy, queued = self.load()
+        wait = self._wait.snapshot()
+        return {
+            "workers": self.max_workers,
+            "busy": busy,
+            "queued": queued,
+            "saturation": round(busy / self.max_workers, 2) if self.max_workers else 0,
+            "wait_p95_ms": round(wait.quantile(0.95) * 1000, 2),
+            "run_p95_ms": round(self._run_time.snapshot().quantile(0.95) * 1000, 2),
+        }
@@ -0,0 +1,220 @@
+"""
+Входящие события платёжного вебхука (inbox)
+Вебхук только проверяет подпись, записывает событие в таблицу payment_events (ключ — invoice_id,
+повторная доставка того же счёта второй записи не создаёт) и сразу отвечает 200.
+Подписку выдаёт и пользователя уведомляет фоновый обработчик, по одному разу на invoice_id:
+pending → applied (подписка записана в subscriptions той же транзакцией) → done (уведомление
+отправлено через Bot — общий пул соединений бота).
+Временные сбои повторяются с растущей задержкой; после перезапуска необработанные события
+дочитываются из БД
+"""
+
+import json
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Dict, Tuple
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from utils.crypto_pay import parse_invoice_payload
+from utils.subscription import SUBSCRIPTION_PLANS, subscription_period
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+APPLIED = "applied"
+DONE = "done"
+FAILED = "failed"
+
+# Событий за один проход обработчика
+BATCH_SIZE = 50
+# Как часто проверять отложенные повторы, если новых событий нет (сек)
+POLL_INTERVAL = 5.0
+# Тарифы старого формата payload (SubscriptionManager) → тарифы SUBSCRIPTION_PLANS
+LEGACY_PLANS = {"unlimited": "premium"}
+
+# Попыток до статуса failed; задержка между ними удваивается от RETRY_BASE_DELAY до RETRY_MAX_DELAY
+MAX_ATTEMPTS = 8
+RETRY_BASE_DELAY = 5.0
+RETRY_MAX_DELAY = 600.0
+
+
+def parse_activation(invoice: Dict) -> Tuple[int, str]:
+    """
+    (user_id, план) из payload счёта. Форматы:
+    - sub_<план>_<user_id>_<время> — счета бота (utils.crypto_pay.create_subscription_invoice)
+    - JSON {"user_id": ..., "plan": ...}
+    - просто user_id (план pro)
+    ValueError — в счёте нет пользователя или тариф неизвестен
+    """
+    payload = invoice.get('payload') or ''
+    parsed = parse_invoice_payload(payload) if isinstance(payload, str) else {}
+    if parsed:
+        user_id, plan = parsed['user_id'], parsed['plan_id']
+    else:
+        try:
+            payload_data = json.loads(payload or '{}')
+            user_id = payload_data.get('user_id')
+            plan = payload_data.get('plan', 'pro')
+        except (json.JSONDecodeError, TypeError, AttributeError):
+            user_id = payload
+            plan = 'pro'
+    if not user_id:
+        raise ValueError("в payload счёта нет user_id")
+    if not isinstance(plan, str):
+        raise ValueError(f"неизвестный план {plan!r}")
+    plan = LEGACY_PLANS.get(plan, plan)
+    if plan not in SUBSCRIPTION_PLANS or plan == 'free':
+        raise ValueError(f"неизвестный план {plan!r}")
+    if isinstance(user_id, bool) or not isinstance(user_id, (int, str)):
+        raise ValueError(f"некорректный user_id {user_id!r}")
+    try:
+        return int(user_id), plan
+    except ValueError:
+        raise ValueError(f"некорректный user_id {user_id!r}") from None
+
+
+class PaymentInbox:
+    """
+    Очередь платёжных событий в SQLite и фоновый обработчик
+
+    Usage:
+        inbox = PaymentInbox(get_async_db(), bot)
+        inbox.start()                                   # в post_init
+        await inbox.add(invoice_id, update_type, body)  # из вебхука
+        inbox.close()                                   # при остановке
+    """
+
+    def __init__(self, db, bot=None):
+        self.db = db  # AsyncDatabase
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.stats = {"received": 0, "duplicates": 0, "applied": 0, "notified": 0, "retries": 0, "failed": 0}
+
+    async def add(self, invoice_id: str, update_type: str, body: str) -> bool:
+        """Сохранить событие (fsync до возврата); False — повторная доставка"""
+        inserted = await self.db.add_payment_event(invoice_id, update_type, body)
+        if inserted:
+            self.stats["received"] += 1
+            self._wakeup.set()
+        else:
+            self.stats["duplicates"] += 1
+        return inserted
+
+    def start(self):
+        """Запустить обработчик (в работающем event loop); события с прошлого запуска — первыми"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def close(self):
+        """
+        Остановить обработчик. Прерванное событие безопасно обработать заново:
+        выдача подписки и отметка applied — одна транзакция
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            # Сброс до чтения: событие, записанное во время прохода, разбудит следующий
+            self._wakeup.clear()
+            try:
+                events = await self.db.get_due_payment_events(time.time(), BATCH_SIZE)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"PaymentInbox: ошибка чтения событий: {e}")
+                events = []
+            for event in events:
+                # Сбой одного события не должен останавливать остальные платежи
+                try:
+                    await self._process(event)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    try:
+                        await self._retry(event, e)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as retry_error:
+                        logger.error(f"PaymentInbox: счёт {event['invoice_id']} не отложен: {retry_error}")
+            if len(events) < BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _process(self, event):
+        invoice_id = event['invoice_id']
+        try:
+            invoice = json.loads(event['body']).get('payload') or {}
+            user_id, plan = parse_activation(invoice)
+        except (ValueError, TypeError, AttributeError) as e:
+            # Повтор не поможет — событие откладывается для ручного разбора
+            logger.error(f"PaymentInbox: счёт {invoice_id} не обработан: {e}")
+            await self.db.set_payment_event_status(invoice_id, FAILED, str(e))
+            self.stats["failed"] += 1
+            return
+
+        try:
+            if event['status'] == PENDING:
+                start_date, end_date = subscription_period(plan)
+                if await self.db.apply_payment_event(invoice_id, user_id, plan, start_date, end_date):
+                    self.stats["applied"] += 1
+                    logger.info(f"Subscription activated for user {user_id}: {plan}")
+            await self._notify(user_id, plan)
+            await self.db.set_payment_event_status(invoice_id, DONE)
+        except Exception as e:
+            await self._retry(event, e)
+
+    async def _notify(self, user_id: int, plan: str):
+        if not self.bot:
+            return
+        plan_info = SUBSCRIPTION_PLANS[plan]
+        duration = plan_info['duration_days']
+        duration_text = "навсегда ♾" if duration == -1 else f"{duration} дней"
+        try:
+            await self.bot.send_message(
+                chat_id=user_id,
+                text=f"✅ **Подписка активирована!**\n\n"
+                     f"{plan_info.get('icon', '⭐')} **{plan_info['name']}**\n"
+                     f"📅 Срок: {duration_text}\n\n"
+                     f"Спасибо за покупку! 🎉",
+                parse_mode="Markdown"
+            )
+            self.stats["notified"] += 1
+        except (RetryAfter, NetworkError) as e:
+            # BadRequest тоже NetworkError, но повтор его не исправит
+            if isinstance(e, BadRequest):
+                logger.error(f"Failed to notify user {user_id}: {e}")
+            else:
+                raise
+        except TelegramError as e:
+            # Пользователь заблокировал бота и т.п. — подписка выдана, повторять нечего
+            logger.error(f"Failed to notify user {user_id}: {e}")
+
+    async def _retry(self, event, error: Exception):
+        invoice_id = event['invoice_id']
+        attempts = event['attempts'] + 1
+        if attempts >= MAX_ATTEMPTS:
+            logger.error(f"PaymentInbox: счёт {invoice_id} не обработан за {attempts} попыток: {error}")
+            await self.db.set_payment_event_status(invoice_id, FAILED, str(error))
+            self.stats["failed"] += 1
+            return
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+        if isinstance(error, RetryAfter):
+            retry_after = error.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            delay = max(delay, float(retry_after))
+        logger.warning(f"PaymentInbox: счёт {invoice_id}, попытка {attempts}: {error}; повтор через {delay:.0f} с")
+        await self.db.retry_payment_event(invoice_id, str(error), time.time() + delay)
+        self.stats["retries"] += 1
+
+    async def get_stats(self) -> Dict:
+        """Счётчики процесса и события в БД по статусам"""
+        return {**self.stats, "events": await self.db.get_payment_event_counts()}
@@ -5,11 +5,13 @@
 import asyncio
 import time
 import logging
-from collections import defaultdict
 from functools import wraps
 from typing import Dict, Optional, Callable, Any
 import threading
 
+from utils import metrics
+from utils.limiter import LimiterStore, TokenBucket, DEFAULT_IDLE_TTL
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,36 +21,26 @@ class RateLimiter:
     Предотвращает спам и DDoS
     """
     
-    def __init__(self, max_requests: int = 30, window_seconds: int = 60):
+    def __init__(self, max_requests: int = 30, window_seconds: int = 60, name: Optional[str] = None):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests: Dict[int, list] = defaultdict(list)
-        self._lock = threading.Lock()
+        self.store = LimiterStore(TokenBucket, idle_ttl=max(DEFAULT_IDLE_TTL, window_seconds), name=name)
+        self._lock = self.store.lock
     
     def is_allowed(self, user_id: int) -> bool:
         """Проверяет, разрешён ли запрос для пользователя"""
         now = time.time()
         
         with self._lock:
-            # Очищаем старые запросы
-            self.requests[user_id] = [
-                req_time for req_time in self.requests[user_id]
-                if now - req_time < self.window_seconds
-            ]
-            
-            if len(self.requests[user_id]) >= self.max_requests:
-                return False
-            
-            self.requests[user_id].append(now)
-            return True
+            return self.store.get(user_id).take(now, self.max_requests, self.window_seconds)
     
     def get_wait_time(self, user_id: int) -> int:
         """Возвращает время ожидания до следующего разрешённого запроса"""
-        if not self.requests[user_id]:
-            return 0
-        
-        oldest = min(self.requests[user_id])
-        wait = self.window_seconds - (time.time() - oldest)
+        with self._lock:
+            bucket = self.store.peek(user_id)
+            if bucket is None:
+                return 0
+            wait = bucket.retry_after(time.time(), self.max_requests, self.window_seconds)
         return max(0, int(wait))
 
 
@@ -165,51 +157,131 @@ class UserSessionManager:
 class PerformanceMonitor:
     """
     Мониторинг производительности бота
+    Гистограммы задержек по хендлерам и маршрутам callback кнопок, глубина очередей
+    задач — всё в общем реестре utils.metrics, который отдаётся на /metrics
     """
     
-    def __init__(self):
-        self.request_count = 0
-        self.error_count = 0
-        self.response_times: list = []
+    def __init__(self, registry: metrics.Registry = metrics.registry):
         self.start_time = time.time()
-        self._lock = threading.Lock()
+        self.registry = registry
+        self.handler_latency = registry.histogram(
+            'bot_handler_duration_seconds', 'Время обработки апдейта хендлером', 'handler'
+        )
+        self.handler_errors = registry.counter(
+            'bot_handler_errors_total', 'Исключения, вылетевшие из хендлеров', 'handler'
+        )
+        self.callback_latency = registry.histogram(
+            'bot_callback_duration_seconds', 'Время обработки callback кнопки по маршруту', 'route'
+        )
+        self.queue_depth = registry.gauge(
+            'bot_task_queue_depth', 'Задачи в TaskQueue (ожидают и выполняются)', 'queue'
+        )
     
-    def record_request(self, response_time: float, error: bool = False):
+    def record_request(self, response_time: float, error: bool = False, handler: str = "other"):
         """Записывает метрики запроса"""
-        with self._lock:
-            self.request_count += 1
-            if error:
-                self.error_count += 1
-            
-            self.response_times.append(response_time)
-            # Храним только последние 1000 замеров
-            if len(self.response_times) > 1000:
-                self.response_times = self.response_times[-1000:]
+        self.handler_latency.labels(handler).observe(response_time)
+        if error:
+            self.handler_errors.labels(handler).inc()
+    
+    def track(self, name: str, func: Callable) -> Callable:
+        """Оборачивает async-хендлер замером времени; серии метрик берутся один раз"""
+        latency = self.handler_latency.labels(name)
+        errors = self.handler_errors.labels(name)
+        
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+        
+        wrapper.tracked = True
+        return wrapper
+    
+    def instrument(self, application) -> int:
+        """
+        Замер времени для всех хендлеров приложения (метка — имя колбэка)
+        Группы < 0 (конвейер допуска) пропускаются: у них своя статистика
+        Returns: сколько хендлеров обёрнуто
+        """
+        count = 0
+        for group, handlers in application.handlers.items():
+            if group < 0:
+                continue
+            for handler in handlers:
+                callback = handler.callback
+                if getattr(callback, 'tracked', False):
+                    continue
+                handler.callback = self.track(getattr(callback, '__name__', 'handler'), callback)
+                count += 1
+        return count
+    
+    def track_queue(self, name: str, queue: "TaskQueue"):
+        """Публикует глубину очереди задач как датчик"""
+        self.queue_depth.labels(name).set_function(lambda: queue.pending_count)
+    
+    def get_handler_stats(self, top: int = 5) -> list:
+        """Самые нагруженные хендлеры: число вызовов, ошибки, p50/p95/p99 (мс)"""
+        errors = dict(self.handler_errors.items())
+        result = []
+        for name, histogram in self.handler_latency.items():
+            snap = histogram.snapshot()
+            if not snap.count:
+                continue
+            counter = errors.get(name)
+            result.append({
+                "handler": name,
+                "count": snap.count,
+                "errors": counter.value if counter is not None else 0,
+                "p50_ms": round(snap.quantile(0.5) * 1000, 1),
+                "p95_ms": round(snap.quantile(0.95) * 1000, 1),
+                "p99_ms": round(snap.quantile(0.99) * 1000, 1),
+            })
+        result.sort(key=lambda x: x["count"], reverse=True)
+        return result[:top]
+    
+    def get_executor_stats(self) -> dict:
+        """Загрузка пулов потоков: занято / всего, очередь, p95 ожидания и выполнения"""
+        return {name: executor.get_stats() for name, executor in sorted(metrics.executors.items())}
     
     def get_stats(self) -> dict:
         """Возвращает статистику производительности"""
-        with self._lock:
-            uptime = time.time() - self.start_time
-            avg_response = sum(self.response_times) / len(self.response_times) if self.response_times else 0
-            
-            return {
-                "uptime_seconds": int(uptime),
-                "total_requests": self.request_count,
-                "errors": self.error_count,
-                "error_rate": f"{(self.error_count / self.request_count * 100):.2f}%" if self.request_count else "0%",
-                "avg_response_ms": f"{avg_response * 1000:.2f}",
-                "requests_per_minute": f"{self.request_count / (uptime / 60):.2f}" if uptime > 0 else "0"
-            }
+        uptime = time.time() - self.start_time
+        snap = self.handler_latency.merged()
+        requests = snap.count if snap is not None else 0
+        errors = sum(counter.value for _, counter in self.handler_errors.items())
+        
+        def ms(q: float) -> str:
+            return f"{snap.quantile(q) * 1000:.2f}" if snap is not None else "0.00"
+        
+        return {
+            "uptime_seconds": int(uptime),
+            "total_requests": requests,
+            "errors": errors,
+            "error_rate": f"{(errors / requests * 100):.2f}%" if requests else "0%",
+            "avg_response_ms": f"{snap.mean * 1000:.2f}" if snap is not None else "0.00",
+            "p50_response_ms": ms(0.5),
+            "p95_response_ms": ms(0.95),
+            "p99_response_ms": ms(0.99),
+            "requests_per_minute": f"{requests / (uptime / 60):.2f}" if uptime > 0 else "0"
+        }
 
 
 # Глобальные экземпляры
-rate_limiter = RateLimiter(max_requests=30, window_seconds=60)
+rate_limiter = RateLimiter(max_requests=30, window_seconds=60, name='perf_rate_limiter')
 video_queue = TaskQueue(max_concurrent=10)
 image_queue = TaskQueue(max_concurrent=20)
 network_queue = TaskQueue(max_concurrent=15)
 cache = SimpleCache(ttl_seconds=300)
 session_manager = UserSessionManager(max_sessions=1000)
 performance_monitor = PerformanceMonitor()
+performance_monitor.track_queue('video', video_queue)
+performance_monitor.track_queue('image', image_queue)
+performance_monitor.track_queue('network', network_queue)
 
 
 def rate_limit(func):
@@ -228,7 +300,7 @@ def rate_limit(func):
                 pass
             return
         
-        start_time = time.time()
+        start_time = time.perf_counter()
         error = False
         try:
             return await func(update, context, *args, **kwargs)
@@ -236,8 +308,8 @@ def rate_limit(func):
             error = True
             raise
         finally:
-            response_time = time.time() - start_time
-            performance_monitor.record_request(response_time, error)
+            response_time = time.perf_counter() - start_time
+            performance_monitor.record_request(response_time, error, func.__name__)
     
     return wrapper
 
@@ -4,8 +4,9 @@ Rate Limiter с защитой от флуда
 """
 from functools import wraps
 from time import time
-from typing import Dict, List
-from collections import defaultdict
+from typing import Dict, Optional
+
+from utils.limiter import LimiterStore, TokenBucket
 
 class RateLimiter:
     """Rate limiter с поддержкой разных лимитов по тарифам"""
@@ -29,9 +30,10 @@ class RateLimiter:
         }
     }
     
-    def __init__(self):
-        self.user_requests: Dict[int, List[float]] = defaultdict(list)
-        self.blocked_until: Dict[int, float] = {}
+    def __init__(self, name: Optional[str] = None):
+        # Бакет и временная блокировка пользователя — одна запись; простаивающие вытесняются.
+        # name — имя для снимков состояния (utils/limiter.py)
+        self.store = LimiterStore(TokenBucket, name=name)
     
     def is_rate_limited(self, user_id: int, plan: str = 'free') -> tuple[bool, str]:
         """
@@ -39,58 +41,45 @@ class RateLimiter:
         Returns: (заблокирован ли, сообщение)
         """
         now = time()
-        
-        # Проверка временной блокировки (при злоупотреблении)
-        if user_id in self.blocked_until:
-            if now < self.blocked_until[user_id]:
-                remaining = int(self.blocked_until[user_id] - now)
-                return True, f"🚫 Временная блокировка. Осталось: {remaining}с"
-            else:
-                del self.blocked_until[user_id]
-        
         config = self.LIMITS.get(plan, self.LIMITS['free'])
-        window = config['window']
-        max_requests = config['requests']
-        
-        # Очистка старых запросов
-        self.user_requests[user_id] = [
-            req_time for req_time in self.user_requests[user_id]
-            if now - req_time < window
-        ]
         
-        # Проверка лимита
-        if len(self.user_requests[user_id]) >= max_requests:
-            # Для free — блокировка на 2 минуты при злоупотреблении
-            if plan == 'free' and len(self.user_requests[user_id]) > max_requests * 2:
-                self.blocked_until[user_id] = now + 120
-                return True, "🚫 Обнаружен флуд. Блокировка на 2 минуты."
+        with self.store.lock:
+            bucket = self.store.get(user_id)
             
-            return True, config['message']
+            # Проверка временной блокировки (при злоупотреблении)
+            remaining = bucket.blocked_for(now)
+            if remaining:
+                return True, f"🚫 Временная блокировка. Осталось: {int(remaining)}с"
+            
+            # Проверка лимита
+            if not bucket.take(now, config['requests'], config['window']):
+                # Для free — блокировка на 2 минуты, если отказов подряд больше самого лимита
+                if plan == 'free' and bucket.strikes > config['requests']:
+                    bucket.block(now, 120)
+                    return True, "🚫 Обнаружен флуд. Блокировка на 2 минуты."
+                
+                return True, config['message']
         
-        # Добавление запроса
-        self.user_requests[user_id].append(now)
         return False, ""
     
     def reset_user(self, user_id: int):
         """Сброс лимитов для пользователя (админ команда)"""
-        if user_id in self.user_requests:
-            del self.user_requests[user_id]
-        if user_id in self.blocked_until:
-            del self.blocked_until[user_id]
+        self.store.discard(user_id)
     
-    def get_stats(self, user_id: int) -> Dict:
+    def get_stats(self, user_id: int, plan: str = 'free') -> Dict:
         """Статистика по пользователю"""
+        config = self.LIMITS.get(plan, self.LIMITS['free'])
         now = time()
-        recent_requests = [
-            req for req in self.user_requests.get(user_id, [])
-            if now - req < 60
-        ]
         
-        return {
-            'requests_last_minute': len(recent_requests),
-            'is_blocked': user_id in self.blocked_until,
-            'blocked_until': self.blocked_until.get(user_id, 0)
-        }
+        with self.store.lock:
+            bucket = self.store.peek(user_id)
+            if bucket is None:
+                return {'requests_last_minute': 0, 'is_blocked': False, 'blocked_until': 0}
+            return {
+                'requests_last_minute': bucket.used(now, config['requests'], config['window']),
+                'is_blocked': bucket.blocked_for(now) > 0,
+                'blocked_until': bucket.blocked_until
+            }
 
 # Декоратор для хендлеров
 def rate_limit(subscription_manager):
@@ -107,10 +96,8 @@ def rate_limit(subscription_manager):
         async def wrapper(update, context):
             user_id = update.effective_user.id
             
-            # Получаем план пользователя
-            from utils.subscription_manager import SubscriptionManager
-            sub_manager = subscription_manager
-            sub = sub_manager.get_subscription(user_id)
+            # План пользователя из индекса SubscriptionManager (без записи на диск)
+            plan = subscription_manager.get_plan(user_id)
             
             # Проверяем rate limit
             limiter = context.bot_data.get('rate_limiter')
@@ -118,7 +105,7 @@ def rate_limit(subscription_manager):
                 limiter = RateLimiter()
                 context.bot_data['rate_limiter'] = limiter
             
-            is_limited, message = limiter.is_rate_limited(user_id, sub.plan)
+            is_limited, message = limiter.is_rate_limited(user_id, plan)
             
             if is_limited:
                 await update.message.reply_text(message)
@@ -9,12 +9,13 @@ import time
 import hashlib
 import logging
 import threading
-from collections import defaultdict
 from typing import Optional, Tuple, List, Set
 from functools import wraps
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+from utils.limiter import LimiterStore, TokenBucket, RepeatBucket, DEFAULT_IDLE_TTL
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -39,14 +40,15 @@ class AntiFlood:
         self,
         max_messages: int = 30,  # 30 сообщений
         window_seconds: int = 60,  # за 60 секунд
-        ban_duration: int = 60  # 1 минута бан
+        ban_duration: int = 60,  # 1 минута бан
+        name: Optional[str] = None  # имя для снимков состояния (utils/limiter.py)
     ):
         self.max_messages = max_messages
         self.window_seconds = window_seconds
         self.ban_duration = ban_duration
-        self.messages: dict = defaultdict(list)
-        self.banned_until: dict = {}
-        self._lock = threading.Lock()
+        # Бакет и бан пользователя — одна запись; простаивающие вытесняются
+        self.store = LimiterStore(TokenBucket, idle_ttl=max(DEFAULT_IDLE_TTL, window_seconds), name=name)
+        self._lock = self.store.lock
         self.enabled = True  # Флаг включения
     
     def check(self, user_id: int) -> Tuple[bool, Optional[int]]:
@@ -65,28 +67,20 @@ class AntiFlood:
         now = time.time()
         
         with self._lock:
-            # Проверяем бан
-            if user_id in self.banned_until:
-                if now < self.banned_until[user_id]:
-                    remaining = int(self.banned_until[user_id] - now)
-                    return False, remaining
-                else:
-                    del self.banned_until[user_id]
+            bucket = self.store.get(user_id)
             
-            # Очищаем старые сообщения
-            self.messages[user_id] = [
-                t for t in self.messages[user_id]
-                if now - t < self.window_seconds
-            ]
+            # Проверяем бан
+            remaining = bucket.blocked_for(now)
+            if remaining:
+                return False, int(remaining)
             
             # Проверяем лимит
-            if len(self.messages[user_id]) >= self.max_messages:
+            if not bucket.take(now, self.max_messages, self.window_seconds):
                 # Баним за флуд
-                self.banned_until[user_id] = now + self.ban_duration
+                bucket.block(now, self.ban_duration)
                 logger.warning(f"User {user_id} banned for flooding")
                 return False, self.ban_duration
             
-            self.messages[user_id].append(now)
             return True, None
     
     def is_banned(self, user_id: int) -> bool:
@@ -94,17 +88,27 @@ class AntiFlood:
         if user_id in ADMIN_IDS:
             return False
         with self._lock:
-            if user_id in self.banned_until:
-                if time.time() < self.banned_until[user_id]:
-                    return True
-                del self.banned_until[user_id]
-            return False
+            bucket = self.store.peek(user_id)
+            return bool(bucket and bucket.blocked_for(time.time()))
     
     def unban(self, user_id: int):
         """Разбанивает пользователя"""
         with self._lock:
-            if user_id in self.banned_until:
-                del self.banned_until[user_id]
+            bucket = self.store.peek(user_id)
+            if bucket:
+                bucket.blocked_until = 0.0
+    
+    def banned_count(self) -> int:
+        """Количество активных банов за флуд"""
+        now = time.time()
+        with self._lock:
+            return sum(1 for b in self.store.records.values() if b.blocked_until > now)
+    
+    def reset(self) -> int:
+        """Сбрасывает баны и счётчики. Returns: сколько банов снято"""
+        count = self.banned_count()
+        self.store.clear()
+        return count
 
 
 class AntiSpam:
@@ -115,17 +119,20 @@ class AntiSpam:
     def __init__(
         self,
         duplicate_threshold: int = 10,  # 10 одинаковых сообщений
-        window_seconds: int = 60
+        window_seconds: int = 60,
+        name: Optional[str] = None  # имя для снимков состояния (utils/limiter.py)
     ):
         self.duplicate_threshold = duplicate_threshold
         self.window_seconds = window_seconds
-        self.message_hashes: dict = defaultdict(list)
-        self._lock = threading.Lock()
+        # Счётчики повторов последних разных сообщений на пользователя (RepeatBucket)
+        self.store = LimiterStore(RepeatBucket, idle_ttl=max(DEFAULT_IDLE_TTL, window_seconds), name=name)
+        self._lock = self.store.lock
     
-    def _hash_message(self, text: str) -> str:
-        """Создаёт хэш сообщения"""
+    @staticmethod
+    def _hash_message(text: str) -> int:
+        """Создаёт хэш сообщения (64 бита md5 — стабилен между перезапусками)"""
         normalized = text.lower().strip()
-        return hashlib.md5(normalized.encode()).hexdigest()
+        return int.from_bytes(hashlib.md5(normalized.encode()).digest()[:8], 'big')
     
     def check(self, user_id: int, message: str) -> Tuple[bool, str]:
         """
@@ -140,20 +147,10 @@ class AntiSpam:
         msg_hash = self._hash_message(message)
         
         with self._lock:
-            # Очищаем старые записи
-            self.message_hashes[user_id] = [
-                (h, t) for h, t in self.message_hashes[user_id]
-                if now - t < self.window_seconds
-            ]
-            
-            # Считаем дубликаты
-            duplicates = sum(1 for h, _ in self.message_hashes[user_id] if h == msg_hash)
-            
-            if duplicates >= self.duplicate_threshold:
+            bucket = self.store.get(user_id)
+            if not bucket.take_key(now, msg_hash, self.duplicate_threshold, self.window_seconds):
                 logger.warning(f"Spam detected from user {user_id}: duplicate messages")
                 return True, "duplicate_messages"
-            
-            self.message_hashes[user_id].append((msg_hash, now))
             return False, None
 
 
@@ -267,18 +264,34 @@ class SecurityLogger:
             logger.error(f"[{event_type}] User {user_id}: {details}")
 
 
+class _ActionRecord(TokenBucket):
+    """Темп действий пользователя и последнее действие"""
+    
+    __slots__ = ("count", "last_action")
+    
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.last_action = None
+
+
 class BotDetector:
     """Простой детектор ботов (заглушка)"""
     
+    # Темп, выше которого действия считаются подозрительными
+    MAX_ACTIONS = 100
+    WINDOW_SECONDS = 60
+    
     def __init__(self):
-        self.actions = defaultdict(list)
+        self.store = LimiterStore(_ActionRecord)
     
     def record_action(self, user_id: int, action: str):
         """Records user action"""
-        self.actions[user_id].append((time.time(), action))
-        # Keep only last 100 actions
-        if len(self.actions[user_id]) > 100:
-            self.actions[user_id] = self.actions[user_id][-100:]
+        with self.store.lock:
+            record = self.store.get(user_id)
+            record.take(time.time(), self.MAX_ACTIONS, self.WINDOW_SECONDS)
+            record.count += 1
+            record.last_action = action
     
     def is_likely_bot(self, user_id: int) -> bool:
         """Always returns False - disabled"""
@@ -286,8 +299,8 @@ class BotDetector:
 
 
 # Глобальные экземпляры с мягкими лимитами
-anti_flood = AntiFlood(max_messages=30, window_seconds=60, ban_duration=60)
-anti_spam = AntiSpam(duplicate_threshold=10, window_seconds=60)
+anti_flood = AntiFlood(max_messages=30, window_seconds=60, ban_duration=60, name='anti_flood')
+anti_spam = AntiSpam(duplicate_threshold=10, window_seconds=60, name='anti_spam')
 input_validator = InputValidator()
 security_logger = SecurityLogger()
 bot_detector = BotDetector()
@@ -297,6 +310,9 @@ def security_check(func):
     """
     Декоратор для проверки безопасности
     Админы пропускаются без проверок
+    
+    Хендлеры бота проверяются admission_middleware (utils/admission.py);
+    декоратор нужен только для обработчиков вне Application
     """
     @wraps(func)
     async def wrapper(update, context, *args, **kwargs):
@@ -356,8 +372,10 @@ def sanitize_user_input(text: str, max_length: int = 4096) -> str:
 
 def get_security_stats() -> dict:
     """Статистика безопасности"""
+    from utils.admission import admission
+    
     return {
-        "flood_bans": len(anti_flood.banned_until),
+        "flood_bans": anti_flood.banned_count() + admission.flood_bans(),
         "security_events": len(security_logger.events),
         "max_messages": anti_flood.max_messages,
         "window_seconds": anti_flood.window_seconds,
@@ -380,11 +398,9 @@ def set_antiflood_ban_duration(seconds: int):
 
 def reset_all_flood_bans():
     """Сбрасывает все баны за флуд"""
-    with anti_flood._lock:
-        count = len(anti_flood.banned_until)
-        anti_flood.banned_until.clear()
-        anti_flood.messages.clear()
-    return count
+    from utils.admission import admission
+    
+    return anti_flood.reset() + admission.reset_flood()
 
 
 def enable_antiflood():
@@ -4,10 +4,16 @@
 
 import json
 import os
+import logging
+import threading
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
 
-# Путь к файлу с подписками (относительный путь)
+from utils.database import get_db, get_async_db
+
+logger = logging.getLogger(__name__)
+
+# Путь к старому JSON файлу с подписками (данные перенесены в data/bot.db)
 SUBSCRIPTIONS_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "subscriptions.json")
 
 # Ссылка на канал проекта
@@ -168,20 +174,71 @@ def ensure_data_dir():
     os.makedirs(os.path.dirname(SUBSCRIPTIONS_FILE), exist_ok=True)
 
 
-def load_subscriptions() -> Dict[str, Any]:
-    """Загрузка данных о подписках"""
-    ensure_data_dir()
+# Ключ в таблице meta, отмечающий завершённый перенос subscriptions.json в SQLite
+_MIGRATION_KEY = "subscriptions_json_migrated"
+_storage_ready = False
+_storage_lock = threading.Lock()
+
+
+def _get_storage():
+    """
+    Хранилище подписок и дневных счётчиков (SQLite, utils.database).
+    При первом обращении однократно переносит данные из subscriptions.json.
+    """
+    global _storage_ready
+    db = get_db()
+    if not _storage_ready:
+        with _storage_lock:
+            if not _storage_ready:
+                _migrate_json(db)
+                _storage_ready = True
+    return db
+
+
+def _migrate_json(db):
+    """Однократный перенос данных из старого subscriptions.json"""
+    if db.get_meta(_MIGRATION_KEY):
+        return
+    
     if os.path.exists(SUBSCRIPTIONS_FILE):
-        with open(SUBSCRIPTIONS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"users": {}, "usage": {}}
+        try:
+            with open(SUBSCRIPTIONS_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"Не удалось прочитать {SUBSCRIPTIONS_FILE} для миграции: {e}")
+            return
+        
+        # Файл с тем же именем пишет SubscriptionManager в своём формате —
+        # переносим только формат этого модуля ({"users": ..., "usage": ...})
+        if isinstance(data, dict) and ("users" in data or "usage" in data):
+            count = db.import_subscriptions_json(data)
+            logger.info(f"subscriptions.json перенесён в SQLite: {count} записей")
+    
+    db.set_meta(_MIGRATION_KEY, datetime.now().isoformat())
+
+
+def load_subscriptions() -> Dict[str, Any]:
+    """Загрузка данных о подписках (полный снимок в старом JSON формате)"""
+    db = _get_storage()
+    data = {"users": {}, "usage": {}}
+    
+    for row in db.get_all_plans():
+        data["users"][str(row["user_id"])] = {
+            "plan": row["plan"],
+            "activated_at": row["start_date"],
+            "expires_at": row["end_date"]
+        }
+    
+    for row in db.get_all_usage():
+        user_usage = data["usage"].setdefault(str(row["user_id"]), {})
+        user_usage.setdefault(row["date"], {})[row["usage_type"]] = row["count"]
+    
+    return data
 
 
 def save_subscriptions(data: Dict[str, Any]):
     """Сохранение данных о подписках"""
-    ensure_data_dir()
-    with open(SUBSCRIPTIONS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    _get_storage().import_subscriptions_json(data)
 
 
 def get_user_subscription(user_id: int) -> str:
@@ -194,53 +251,49 @@ def get_user_subscription(user_id: int) -> str:
     except ImportError:
         pass
     
-    data = load_subscriptions()
-    user_data = data.get("users", {}).get(str(user_id), {})
+    user_data = _get_storage().get_plan(user_id)
     
     if not user_data:
         return "free"
     
-    plan = user_data.get("plan", "free")
+    plan = user_data["plan"] or "free"
     
     # Пожизненная подписка не истекает
     if plan == "lifetime":
         return "lifetime"
     
     # Проверка срока действия
-    if user_data.get("expires_at"):
-        expires = datetime.fromisoformat(user_data["expires_at"])
+    if user_data["end_date"]:
+        expires = datetime.fromisoformat(user_data["end_date"])
         if datetime.now() > expires:
             return "free"
     
     return plan
 
 
-def set_user_subscription(user_id: int, plan: str, duration_days: int = None):
-    """Установка подписки пользователю"""
-    if plan not in SUBSCRIPTION_PLANS:
-        return False
-    
-    data = load_subscriptions()
-    if "users" not in data:
-        data["users"] = {}
-    
+def subscription_period(plan: str, duration_days: int = None) -> tuple:
+    """(начало, окончание) новой подписки в ISO-формате; окончание None — бессрочно"""
     if duration_days is None:
         duration_days = SUBSCRIPTION_PLANS[plan]["duration_days"]
     
+    now = datetime.now()
     expires_at = None
     if duration_days > 0:
-        expires_at = (datetime.now() + timedelta(days=duration_days)).isoformat()
+        expires_at = (now + timedelta(days=duration_days)).isoformat()
     elif duration_days == -1:
         # Пожизненная подписка
         expires_at = None
     
-    data["users"][str(user_id)] = {
-        "plan": plan,
-        "activated_at": datetime.now().isoformat(),
-        "expires_at": expires_at
-    }
+    return now.isoformat(), expires_at
+
+
+def set_user_subscription(user_id: int, plan: str, duration_days: int = None):
+    """Установка подписки пользователю"""
+    if plan not in SUBSCRIPTION_PLANS:
+        return False
     
-    save_subscriptions(data)
+    start_date, expires_at = subscription_period(plan, duration_days)
+    _get_storage().set_plan(user_id, plan, start_date, expires_at)
     return True
 
 
@@ -255,8 +308,7 @@ def get_user_usage(user_id: int, date: str = None) -> Dict[str, int]:
     if date is None:
         date = datetime.now().strftime("%Y-%m-%d")
     
-    data = load_subscriptions()
-    usage = data.get("usage", {}).get(str(user_id), {}).get(date, {})
+    usage = _get_storage().get_usage(user_id, date)
     
     return {
         "photos": usage.get("photos", 0),
@@ -277,19 +329,24 @@ def get_user_usage(user_id: int, date: str = None) -> Dict[str, int]:
 def increment_usage(user_id: int, usage_type: str, count: int = 1):
     """Увеличение счётчика использования"""
     date = datetime.now().strftime("%Y-%m-%d")
-    
-    data = load_subscriptions()
-    if "usage" not in data:
-        data["usage"] = {}
-    if str(user_id) not in data["usage"]:
-        data["usage"][str(user_id)] = {}
-    if date not in data["usage"][str(user_id)]:
-        data["usage"][str(user_id)][date] = {}
-    
-    current = data["usage"][str(user_id)][date].get(usage_type, 0)
-    data["usage"][str(user_id)][date][usage_type] = current + count
-    
-    save_subscriptions(data)
+    _get_storage().increment_usage(user_id, date, usage_type, count)
+
+
+# Соответствие типа использования ключу дневного лимита в SUBSCRIPTION_PLANS
+USAGE_LIMIT_KEYS = {
+    "photos": "photos_per_day",
+    "videos": "videos_per_day",
+    "exif": "exif_per_day",
+    "selfies": "selfies_per_day",
+    "addresses": "addresses_per_day",
+    "cards": "cards_per_day",
+    "twofa": "twofa_per_day",
+    "antidetect": "antidetect_per_day",
+    "text": "text_per_day",
+    "gplay": "gplay_per_day",
+    "site": "site_per_day",
+    "tiktok": "tiktok_per_day",
+}
 
 
 def check_limit(user_id: int, usage_type: str) -> tuple[bool, int, int]:
@@ -300,22 +357,7 @@ def check_limit(user_id: int, usage_type: str) -> tuple[bool, int, int]:
     limits = get_user_limits(user_id)
     usage = get_user_usage(user_id)
     
-    limit_map = {
-        "photos": "photos_per_day",
-        "videos": "videos_per_day",
-        "exif": "exif_per_day",
-        "selfies": "selfies_per_day",
-        "addresses": "addresses_per_day",
-        "cards": "cards_per_day",
-        "twofa": "twofa_per_day",
-        "antidetect": "antidetect_per_day",
-        "text": "text_per_day",
-        "gplay": "gplay_per_day",
-        "site": "site_per_day",
-        "tiktok": "tiktok_per_day",
-    }
-    
-    limit_key = limit_map.get(usage_type)
+    limit_key = USAGE_LIMIT_KEYS.get(usage_type)
     if not limit_key:
         return True, 0, -1
     
@@ -328,6 +370,49 @@ def check_limit(user_id: int, usage_type: str) -> tuple[bool, int, int]:
     return used < limit, used, limit
 
 
+def consume_quota(user_id: int, usage_type: str, n: int = 1) -> tuple[bool, int, int]:
+    """
+    Атомарная проверка лимита и списание n единиц за один запрос к БД
+    (вместо пары check_limit + increment_usage, которая допускает гонку)
+    Возвращает: (списано, использовано, лимит)
+    """
+    limit_key = USAGE_LIMIT_KEYS.get(usage_type)
+    limit = get_user_limits(user_id).get(limit_key, 0) if limit_key else -1
+    date = datetime.now().strftime("%Y-%m-%d")
+    
+    allowed, used = _get_storage().consume_usage(user_id, date, usage_type, n, limit)
+    return allowed, used, limit
+
+
+async def consume_quota_async(user_id: int, usage_type: str, n: int = 1) -> tuple[bool, int, int]:
+    """consume_quota для async хендлеров — выполняется в потоке БД, не блокируя event loop"""
+    return await get_async_db().run(consume_quota, user_id, usage_type, n)
+
+
+# === Сводная статистика (поддерживается триггерами при записи) ===
+
+def get_plan_counts() -> Dict[str, int]:
+    """Количество пользователей по тарифам"""
+    return _get_storage().get_plan_counts()
+
+
+def get_usage_totals(date: str = None) -> Dict[str, int]:
+    """Суммарное использование всеми пользователями за день"""
+    if date is None:
+        date = datetime.now().strftime("%Y-%m-%d")
+    return _get_storage().get_daily_totals(date)
+
+
+def get_top_usage(limit: int = 10) -> list:
+    """[(user_id, total)] — лидеры по использованию за всё время"""
+    return [(row["user_id"], row["total"]) for row in _get_storage().get_top_usage(limit)]
+
+
+def rebuild_usage_stats() -> int:
+    """Пересчитать сводные таблицы из исходных данных (после ручных правок БД)"""
+    return _get_storage().rebuild_rollups()
+
+
 def format_subscription_info(user_id: int) -> str:
     """Форматирование информации о подписке"""
     # Проверяем VIP статус
@@ -343,8 +428,7 @@ def format_subscription_info(user_id: int) -> str:
     usage = get_user_usage(user_id)
     limits = plan["limits"]
     
-    data = load_subscriptions()
-    user_data = data.get("users", {}).get(str(user_id), {})
+    user_data = _get_storage().get_plan(user_id)
     
     # Если VIP от админа - показываем специальное сообщение
     if is_vip_user:
@@ -355,8 +439,8 @@ def format_subscription_info(user_id: int) -> str:
         
         if plan_id == "lifetime":
             text += "⏳ Срок: **НАВСЕГДА** ♾\n\n"
-        elif user_data.get("expires_at"):
-            expires = datetime.fromisoformat(user_data["expires_at"])
+        elif user_data and user_data["end_date"]:
+            expires = datetime.fromisoformat(user_data["end_date"])
             days_left = (expires - datetime.now()).days
             text += f"⏳ Осталось дней: **{days_left}**\n\n"
     
@@ -467,3 +551,51 @@ def get_plan_stars_price(plan_id: str) -> int:
     if plan_id not in SUBSCRIPTION_PLANS:
         return 0
     return SUBSCRIPTION_PLANS[plan_id].get("price_stars", 0)
+
+
+if __name__ == "__main__":
+    # Гонка за дневной лимит: много пользователей одновременно жмут одну кнопку.
+    # Пара check_limit + increment_usage пропускает лишние списания, consume_quota — ни одного.
+    # Между проверкой и списанием в старой паре хендлер генерирует результат — здесь это
+    # пауза RACE_WINDOW, без неё окно гонки слишком узкое, чтобы воспроизводиться стабильно.
+    # Временная БД: python -m utils.subscription [пользователей] [попыток] [потоков]
+    import sys
+    import time
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    
+    from utils import database
+    
+    users_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    attempts = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    usage_type = "cards"
+    RACE_WINDOW = 0.002
+    limit = SUBSCRIPTION_PLANS["free"]["limits"][USAGE_LIMIT_KEYS[usage_type]]
+    
+    tmp = tempfile.mkdtemp()
+    SUBSCRIPTIONS_FILE = os.path.join(tmp, "subscriptions.json")
+    database._db = database.Database(os.path.join(tmp, "bot.db"))
+    
+    def check_then_increment(user_id):
+        allowed, _, _ = check_limit(user_id, usage_type)
+        if allowed:
+            time.sleep(RACE_WINDOW)
+            increment_usage(user_id, usage_type)
+        return allowed
+    
+    def run(name, attempt, user_offset):
+        user_ids = [user_offset + uid for uid in range(users_count) for _ in range(attempts)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            granted = sum(pool.map(attempt, user_ids))
+        elapsed = time.perf_counter() - started
+        over = sum(max(0, get_user_usage(user_offset + uid)[usage_type] - limit) for uid in range(users_count))
+        print(f"{name}: {len(user_ids) / elapsed:.0f} оп/с, выдано {granted}, сверх лимита {over}")
+        return granted, over
+    
+    print(f"{users_count} пользователей x {attempts} попыток на {usage_type!r} (лимит {limit}), {threads} потоков")
+    _, legacy_over = run("check_limit + increment_usage", check_then_increment, 1_000_000)
+    granted, over = run("consume_quota", lambda user_id: consume_quota(user_id, usage_type)[0], 2_000_000)
+    database._db.close()
+    sys.exit(0 if legacy_over > 0 and over == 0 and granted == users_count * min(limit, attempts) else 1)
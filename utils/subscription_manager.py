@@ -4,11 +4,21 @@
 """
 import json
 import os
+import time
+import logging
+import threading
 from datetime import datetime, timedelta
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple, Iterator, Callable
 from dataclasses import dataclass, asdict
 from pathlib import Path
 
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+_snapshot_time = metrics.file_io('subs_snapshot')
+_fsync_time = metrics.file_io('subs_journal_fsync')
+
 @dataclass
 class Subscription:
     user_id: int
@@ -19,6 +29,113 @@ class Subscription:
     is_active: bool = True
     invoice_id: Optional[str] = None
 
+def _write_json_atomic(path: Path, data):
+    """Пишет JSON во временный файл и подменяет им исходный"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    started = time.perf_counter()
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _snapshot_time.observe(time.perf_counter() - started)
+
+
+class SubscriptionJournal:
+    """
+    Append-only журнал изменений подписок: одна компактная JSON-строка на изменение
+    Строки пишутся в буфер файла, fsync — пачкой раз в fsync_interval секунд
+    из фонового потока. Недописанная последняя строка (сбой при записи) при
+    воспроизведении отбрасывается, остальные данные не страдают
+    """
+    
+    def __init__(self, path: Path, fsync_interval: float = 1.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.records = 0  # записей после последнего снимка
+        self._lock = threading.Lock()
+        self._file = None
+        self._dirty = False
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def replay(self) -> Iterator[dict]:
+        """Записи журнала по порядку; недописанный хвост обрезается"""
+        if not self.path.exists():
+            return
+        good = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+                good += len(line)
+                self.records += 1
+                yield record
+        if good < self.path.stat().st_size:
+            logger.warning(f"{self.path}: недописанная запись журнала отброшена")
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+    
+    def append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._dirty = True
+            self.records += 1
+            if self._thread is None and self.fsync_interval > 0:
+                self._thread = threading.Thread(target=self._run, name='subs-journal', daemon=True)
+                self._thread.start()
+        if self.fsync_interval <= 0:
+            self.sync()
+    
+    def sync(self):
+        """Сбрасывает буфер журнала на диск (flush + fsync)"""
+        with self._lock:
+            if self._dirty and self._file is not None:
+                started = time.perf_counter()
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+                _fsync_time.observe(time.perf_counter() - started)
+    
+    def _run(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except OSError as e:
+                logger.error(f"Ошибка fsync журнала подписок: {e}")
+    
+    def rewrite(self, write_snapshot: Callable[[], None]):
+        """Пишет снимок и очищает журнал; новые записи ждут окончания"""
+        with self._lock:
+            write_snapshot()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            # Снимок уже на диске: если сбой случится до очистки, журнал
+            # просто воспроизведётся поверх него ещё раз
+            open(self.path, 'w').close()
+            self._dirty = False
+            self.records = 0
+    
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
 class SubscriptionManager:
     """Менеджер подписок с персистентностью в JSON"""
     
@@ -54,15 +171,24 @@ class SubscriptionManager:
         }
     }
     
-    def __init__(self, data_dir: str = 'data'):
+    def __init__(
+        self,
+        data_dir: str = 'data',
+        fsync_interval: float = 1.0,
+        compact_threshold: int = 1000
+    ):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
         self.subs_file = self.data_dir / 'subscriptions.json'
         self.usage_file = self.data_dir / 'usage_daily.json'
+        # Изменения дописываются в журнал; раз в compact_threshold записей
+        # журнал сворачивается в снимки subscriptions.json / usage_daily.json
+        self.compact_threshold = compact_threshold
+        self._journal = SubscriptionJournal(self.data_dir / 'subscriptions.journal', fsync_interval)
         self._load_data()
     
     def _load_data(self):
-        """Загрузка данных из JSON"""
+        """Загрузка снимков из JSON и воспроизведение журнала поверх них"""
         # Подписки
         if self.subs_file.exists():
             with open(self.subs_file, 'r', encoding='utf-8') as f:
@@ -79,34 +205,63 @@ class SubscriptionManager:
                 self.daily_usage = json.load(f)
         else:
             self.daily_usage = {}
+        
+        # Изменения после последнего снимка
+        for record in self._journal.replay():
+            self._apply(record)
+        
+        # Индекс тарифов: user_id -> (план, момент окончания в epoch-секундах)
+        self._plan_index: Dict[int, Tuple[str, float]] = {}
+        for sub in self.subscriptions.values():
+            self._index_plan(sub)
+    
+    def _apply(self, record: dict):
+        """Применяет запись журнала (значения абсолютные — повторное применение безопасно)"""
+        kind = record.get('t')
+        if kind == 'sub':
+            sub = Subscription(**record['d'])
+            self.subscriptions[sub.user_id] = sub
+        elif kind == 'use':
+            self.daily_usage[record['k']] = record['n']
+        elif kind == 'gen':
+            sub = self.subscriptions.get(record['u'])
+            if sub is not None:
+                sub.generations_used = record['n']
+    
+    def _log(self, record: dict):
+        """Дописывает изменение в журнал, при накоплении — сворачивает его в снимок"""
+        self._journal.append(record)
+        if self._journal.records >= self.compact_threshold:
+            self.compact()
     
     def _save_data(self):
-        """Сохранение данных в JSON"""
+        """Сохранение снимков в JSON (атомарно: tmp + os.replace)"""
         # Подписки
-        with open(self.subs_file, 'w', encoding='utf-8') as f:
-            data = {str(k): asdict(v) for k, v in self.subscriptions.items()}
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        data = {str(k): asdict(v) for k, v in self.subscriptions.items()}
+        _write_json_atomic(self.subs_file, data)
         
         # Дневное использование
-        with open(self.usage_file, 'w', encoding='utf-8') as f:
-            json.dump(self.daily_usage, f, indent=2)
+        _write_json_atomic(self.usage_file, self.daily_usage)
     
-    def get_subscription(self, user_id: int) -> Subscription:
-        """Получить подписку пользователя (создаёт FREE если нет)"""
-        if user_id not in self.subscriptions:
-            self.create_subscription(user_id, 'free')
-        
-        sub = self.subscriptions[user_id]
-        
-        # Проверка истечения
-        if sub.plan != 'free' and datetime.fromisoformat(sub.end_date) < datetime.now():
-            self.downgrade_to_free(user_id)
-            sub = self.subscriptions[user_id]
-        
-        return sub
+    def compact(self):
+        """Сворачивает журнал: пишет снимки и очищает журнал"""
+        self._journal.rewrite(self._save_data)
     
-    def create_subscription(self, user_id: int, plan: str, invoice_id: Optional[str] = None):
-        """Создать новую подписку"""
+    def close(self):
+        """Сбрасывает журнал на диск и сворачивает его (вызывать при остановке)"""
+        self.compact()
+        self._journal.close()
+    
+    def _index_plan(self, sub: Subscription):
+        """Обновляет запись индекса тарифов для подписки"""
+        if sub.plan == 'free':
+            self._plan_index[sub.user_id] = ('free', float('inf'))
+        else:
+            expires = datetime.fromisoformat(sub.end_date).timestamp()
+            self._plan_index[sub.user_id] = (sub.plan, expires)
+    
+    def _build_subscription(self, user_id: int, plan: str, invoice_id: Optional[str] = None) -> Subscription:
+        """Создаёт подписку в памяти (без записи на диск)"""
         now = datetime.now()
         
         if plan == 'free':
@@ -126,7 +281,40 @@ class SubscriptionManager:
         )
         
         self.subscriptions[user_id] = sub
-        self._save_data()
+        self._index_plan(sub)
+        return sub
+    
+    def get_subscription(self, user_id: int) -> Subscription:
+        """
+        Получить подписку пользователя (создаёт FREE если нет)
+        Чтение не пишет на диск: новая FREE-запись и возврат на FREE после истечения
+        сохранятся вместе со следующим изменением
+        """
+        if user_id not in self.subscriptions:
+            return self._build_subscription(user_id, 'free')
+        
+        sub = self.subscriptions[user_id]
+        
+        # Проверка истечения
+        if sub.plan != 'free' and self.get_plan(user_id) == 'free':
+            sub = self._build_subscription(user_id, 'free')
+        
+        return sub
+    
+    def get_plan(self, user_id: int) -> str:
+        """Текущий тариф из индекса: O(1), без побочных эффектов, FREE ровно с момента end_date"""
+        entry = self._plan_index.get(user_id)
+        if entry is None:
+            return 'free'
+        plan, expires = entry
+        if plan != 'free' and time.time() >= expires:
+            return 'free'
+        return plan
+    
+    def create_subscription(self, user_id: int, plan: str, invoice_id: Optional[str] = None):
+        """Создать новую подписку"""
+        sub = self._build_subscription(user_id, plan, invoice_id)
+        self._log({'t': 'sub', 'd': asdict(sub)})
     
     def upgrade_subscription(self, user_id: int, plan: str, invoice_id: str):
         """Апгрейд подписки после оплаты"""
@@ -170,12 +358,12 @@ class SubscriptionManager:
             today = datetime.now().date().isoformat()
             daily_key = f"{user_id}_{today}"
             self.daily_usage[daily_key] = self.daily_usage.get(daily_key, 0) + 1
+            self._log({'t': 'use', 'k': daily_key, 'n': self.daily_usage[daily_key]})
         
         # PRO/UNLIMITED — общий счётчик
         else:
             sub.generations_used += 1
-        
-        self._save_data()
+            self._log({'t': 'gen', 'u': user_id, 'n': sub.generations_used})
     
     def get_usage_info(self, user_id: int) -> str:
         """Информация об использовании"""
@@ -244,7 +432,7 @@ class SubscriptionManager:
         for key in keys_to_remove:
             del self.daily_usage[key]
         
-        self._save_data()
+        self.compact()
     
     def get_admin_stats(self) -> str:
         """Статистика подписок для админа"""
@@ -311,10 +311,10 @@ def get_video_info(video_path):
 
 # === Асинхронные обёртки для многопользовательского режима ===
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from utils.metrics import InstrumentedExecutor
 
 # Пул потоков для тяжёлых операций (макс 10 одновременных видео)
-_video_executor = ThreadPoolExecutor(max_workers=10, thread_name_prefix='video_')
+_video_executor = InstrumentedExecutor('video', max_workers=10)
 
 
 async def uniqualize_video_async(input_path, output_path, settings=None):
@@ -2,12 +2,14 @@
 Система вайтлиста для бесплатных пожизненных подписок
 """
 
-import json
 import os
 import logging
 from datetime import datetime
+from typing import Set
 from dotenv import load_dotenv
 
+from utils import json_store
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -27,38 +29,9 @@ if ADMIN_OPERATOR_ID not in ADMIN_IDS:
     ADMIN_IDS.append(ADMIN_OPERATOR_ID)
 
 
-def _ensure_data_dir():
-    """Создаёт директорию data если её нет"""
-    data_dir = os.path.dirname(WHITELIST_FILE)
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
-
-
 def _load_whitelist():
-    """Загружает вайтлист из файла"""
-    _ensure_data_dir()
-    
-    if not os.path.exists(WHITELIST_FILE):
-        return {"vip_users": {}}
-    
-    try:
-        with open(WHITELIST_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        return {"vip_users": {}}
-
-
-def _save_whitelist(data):
-    """Сохраняет вайтлист в файл"""
-    _ensure_data_dir()
-    
-    try:
-        with open(WHITELIST_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        return True
-    except IOError as e:
-        logger.error(f"Ошибка сохранения вайтлиста: {e}")
-        return False
+    """Загружает вайтлист (из кэша utils/json_store; результат не изменять)"""
+    return json_store.read(WHITELIST_FILE, {"vip_users": {}})
 
 
 def is_admin(user_id: int) -> bool:
@@ -66,10 +39,35 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 
+# VIP проверяется на каждой проверке квоты (utils/subscription.get_user_subscription),
+# поэтому ID держатся во множестве в памяти; add_vip/remove_vip меняют его вместе с файлом,
+# reload_vips() перечитывает файл после ручной правки (команда /reloadlists)
+
+def _load_vip_ids() -> Set[int]:
+    return {int(uid) for uid in _load_whitelist().get("vip_users", {}) if uid.lstrip("-").isdigit()}
+
+
+# Загружается один раз при старте
+_vip_ids: Set[int] = _load_vip_ids()
+
+
+def reload_vips() -> int:
+    """Перечитывает вайтлист с диска. Returns: количество VIP"""
+    global _vip_ids
+    json_store.invalidate(WHITELIST_FILE)
+    _vip_ids = _load_vip_ids()
+    return len(_vip_ids)
+
+
+def _resync_vip_ids():
+    """Файл не записан и изменение откатано — множество снова строится по вайтлисту"""
+    global _vip_ids
+    _vip_ids = _load_vip_ids()
+
+
 def is_vip(user_id: int) -> bool:
     """Проверяет, есть ли пользователь в вайтлисте (VIP)"""
-    data = _load_whitelist()
-    return str(user_id) in data.get("vip_users", {})
+    return user_id in _vip_ids
 
 
 def add_vip(user_id: int, added_by: int, note: str = None) -> bool:
@@ -84,18 +82,19 @@ def add_vip(user_id: int, added_by: int, note: str = None) -> bool:
     Returns:
         True если успешно, False если ошибка
     """
-    data = _load_whitelist()
-    
-    if "vip_users" not in data:
-        data["vip_users"] = {}
-    
-    data["vip_users"][str(user_id)] = {
-        "added_at": datetime.now().isoformat(),
-        "added_by": added_by,
-        "note": note
-    }
+    def mutate(data):
+        data.setdefault("vip_users", {})[str(user_id)] = {
+            "added_at": datetime.now().isoformat(),
+            "added_by": added_by,
+            "note": note
+        }
+        _vip_ids.add(int(user_id))
+        return True
     
-    return _save_whitelist(data)
+    added, saved = json_store.update(WHITELIST_FILE, mutate, {"vip_users": {}})
+    if not saved:
+        _resync_vip_ids()
+    return added and saved
 
 
 def remove_vip(user_id: int) -> bool:
@@ -108,13 +107,14 @@ def remove_vip(user_id: int) -> bool:
     Returns:
         True если успешно удалён, False если не найден или ошибка
     """
-    data = _load_whitelist()
-    
-    if str(user_id) in data.get("vip_users", {}):
-        del data["vip_users"][str(user_id)]
-        return _save_whitelist(data)
+    def mutate(data):
+        _vip_ids.discard(int(user_id))
+        return data.get("vip_users", {}).pop(str(user_id), None) is not None
     
-    return False
+    removed, saved = json_store.update(WHITELIST_FILE, mutate, {"vip_users": {}})
+    if not saved:
+        _resync_vip_ids()
+    return removed and saved
 
 
 def get_vip_list() -> list:
@@ -141,8 +141,7 @@ def get_vip_list() -> list:
 
 def get_vip_count() -> int:
     """Возвращает количество VIP пользователей"""
-    data = _load_whitelist()
-    return len(data.get("vip_users", {}))
+    return len(_vip_ids)
 
 
 # Алиасы для совместимости
@@ -1,6 +1,9 @@
 # webhook_cryptopay.py
 """
 CryptoPay Webhook для автоматической активации подписок
+Единственный приёмник платежей: работает внутри процесса бота (aiohttp), принимает
+оба формата payload счёта (см. utils.payment_inbox.parse_activation) на /webhook/cryptopay
+и на старом адресе /webhook/crypto
 """
 from aiohttp import web
 import hmac
@@ -9,15 +12,18 @@ import json
 import os
 import logging
 
+from utils import metrics
+
 logger = logging.getLogger(__name__)
 
 CRYPTO_BOT_TOKEN = os.getenv('CRYPTO_BOT_TOKEN', '')
+# Если задан — /metrics отдаётся только с заголовком Authorization: Bearer <токен>
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
 
 class CryptoPayWebhook:
-    def __init__(self, token, sub_manager, bot=None):
+    def __init__(self, token, inbox):
         self.token = token
-        self.sub_manager = sub_manager
-        self.bot = bot
+        self.inbox = inbox
     
     def verify_signature(self, body: bytes, signature: str) -> bool:
         """Проверка подписи вебхука"""
@@ -28,7 +34,11 @@ class CryptoPayWebhook:
         return hmac.compare_digest(check, signature)
     
     async def handle_webhook(self, request):
-        """Обработка вебхука от CryptoPay"""
+        """
+        Обработка вебхука от CryptoPay: событие записывается в inbox (utils/payment_inbox.py)
+        и подтверждается сразу; подписку выдаёт фоновый обработчик. Повторная доставка
+        того же счёта подтверждается без повторной выдачи
+        """
         signature = request.headers.get('Crypto-Pay-Api-Signature', '')
         body = await request.read()
         
@@ -41,60 +51,58 @@ class CryptoPayWebhook:
         except json.JSONDecodeError:
             return web.Response(status=400, text='Invalid JSON')
         
-        logger.info(f"CryptoPay webhook received: {data.get('update_type')}")
+        update_type = data.get('update_type')
+        logger.info(f"CryptoPay webhook received: {update_type}")
         
-        # Обработка успешной оплаты
-        if data.get('update_type') == 'invoice_paid':
-            invoice = data.get('payload', {})
-            
-            # Получаем данные из payload
-            try:
-                payload_data = json.loads(invoice.get('payload', '{}'))
-                user_id = payload_data.get('user_id')
-                plan = payload_data.get('plan', 'pro')
-            except (json.JSONDecodeError, TypeError):
-                # Fallback: пробуем получить из description
-                user_id = invoice.get('payload')
-                plan = 'pro'
-            
-            if user_id:
-                # Активация подписки
-                self.sub_manager.upgrade_subscription(
-                    user_id=int(user_id),
-                    plan=plan,
-                    invoice_id=str(invoice.get('invoice_id', ''))
-                )
-                
-                logger.info(f"Subscription activated for user {user_id}: {plan}")
-                
-                # Уведомление юзеру
-                if self.bot:
-                    try:
-                        await self.bot.send_message(
-                            chat_id=int(user_id),
-                            text=f"✅ **Подписка активирована!**\n\n"
-                                 f"План: {plan.upper()}\n"
-                                 f"Спасибо за покупку! 🎉",
-                            parse_mode="Markdown"
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to notify user {user_id}: {e}")
+        # Сохраняем только успешные оплаты
+        if update_type != 'invoice_paid':
+            return web.Response(status=200, text='OK')
+        
+        invoice = data.get('payload') or {}
+        if invoice.get('status', 'paid') != 'paid':
+            return web.Response(status=200, text='OK')
+        
+        invoice_id = invoice.get('invoice_id')
+        if invoice_id is None:
+            logger.warning("CryptoPay webhook without invoice_id")
+            return web.Response(status=400, text='Missing invoice_id')
+        
+        try:
+            inserted = await self.inbox.add(str(invoice_id), update_type, body.decode('utf-8'))
+        except Exception as e:
+            # Не подтверждаем — CryptoPay доставит событие повторно
+            logger.error(f"CryptoPay webhook: не удалось сохранить счёт {invoice_id}: {e}")
+            return web.Response(status=500, text='Retry later')
         
+        if not inserted:
+            logger.info(f"CryptoPay webhook: счёт {invoice_id} уже получен")
         return web.Response(status=200, text='OK')
 
 
-async def start_webhook(sub_manager, bot=None, port=8443):
-    """Запуск вебхук сервера"""
-    handler = CryptoPayWebhook(CRYPTO_BOT_TOKEN, sub_manager, bot)
+async def start_webhook(inbox, port=8443):
+    """Запуск вебхук сервера; события оплаты пишутся в inbox (PaymentInbox)"""
+    handler = CryptoPayWebhook(CRYPTO_BOT_TOKEN, inbox)
     
     app = web.Application()
     app.router.add_post('/webhook/cryptopay', handler.handle_webhook)
+    # Адрес бывшего отдельного сервера webhook_server.py — для уже настроенных приложений
+    app.router.add_post('/webhook/crypto', handler.handle_webhook)
     
     # Health check endpoint
     async def health_check(request):
         return web.Response(text='OK')
     app.router.add_get('/health', health_check)
     
+    # Метрики в формате Prometheus (utils/metrics.py)
+    async def metrics_endpoint(request):
+        if METRICS_TOKEN:
+            auth = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(auth, f'Bearer {METRICS_TOKEN}'):
+                return web.Response(status=401, text='Unauthorized')
+        body = metrics.registry.render().encode('utf-8')
+        return web.Response(body=body, headers={'Content-Type': metrics.CONTENT_TYPE})
+    app.router.add_get('/metrics', metrics_endpoint)
+    
     runner = web.AppRunner(app)
     await runner.setup()
     
@@ -103,3 +111,159 @@ async def start_webhook(sub_manager, bot=None, port=8443):
     
     logger.info(f"🌐 CryptoPay Webhook запущен на порту {port}")
     return runner
+
+
+
+if __name__ == '__main__':
+    # Нагрузочная проверка и совместимость на локальном сервере: python webhook_cryptopay.py
+    # Оба формата payload (счета бота sub_<план>_<user_id>_<время> на старом /webhook/crypto и
+    # JSON user_id/plan), повторные и одновременные доставки, чужая подпись, битый payload,
+    # перезапуск посреди обработки. Каждая подписка выдаётся и каждое уведомление уходит ровно один раз
+    import asyncio
+    import tempfile
+    import time
+    import aiohttp
+    from pathlib import Path
+    from telegram.error import TimedOut
+    from utils import admission, database, payment_inbox, subscription
+    from utils.database import Database, AsyncDatabase
+    
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+            self.fail_once = {7}
+        
+        async def send_message(self, chat_id, text, **kwargs):
+            await asyncio.sleep(0.05)
+            if chat_id in self.fail_once:
+                self.fail_once.discard(chat_id)
+                raise TimedOut("Timed out")
+            self.sent.append(chat_id)
+    
+    def sign(token: str, body: bytes) -> str:
+        secret = hashlib.sha256(token.encode()).digest()
+        return hmac.new(secret, body, hashlib.sha256).hexdigest()
+    
+    def paid(invoice_id: int, payload: str) -> bytes:
+        return json.dumps({
+            'update_type': 'invoice_paid',
+            'payload': {'invoice_id': invoice_id, 'status': 'paid', 'payload': payload},
+        }).encode()
+    
+    async def drain(db, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            counts = await db.get_payment_event_counts()
+            if not counts.get('pending') and not counts.get('applied'):
+                return counts
+            await asyncio.sleep(0.05)
+        raise AssertionError(f"inbox не разобран: {counts}")
+    
+    async def main():
+        global CRYPTO_BOT_TOKEN
+        CRYPTO_BOT_TOKEN = 'test'
+        payment_inbox.RETRY_BASE_DELAY = 0.05
+        payment_inbox.POLL_INTERVAL = 0.05
+        
+        tmp = Path(tempfile.mkdtemp())
+        db = AsyncDatabase(Database(str(tmp / 'bot.db')))
+        bot = FakeBot()
+        inbox = payment_inbox.PaymentInbox(db, bot)
+        inbox.start()
+        runner = await start_webhook(inbox, port=0)
+        base = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        
+        # Ожидаемый результат по пользователям: (invoice_id, план)
+        expected = {}
+        requests = []
+        for uid in range(1, 201):
+            if uid <= 100:
+                # Счёт бота, старый адрес отдельного сервера
+                path, payload, plan = '/webhook/crypto', f"sub_basic_{uid}_{time.time()}", 'basic'
+            elif uid <= 190:
+                # JSON; тариф unlimited старого формата → premium
+                path, payload, plan = '/webhook/cryptopay', json.dumps({'user_id': uid, 'plan': 'unlimited'}), 'premium'
+            else:
+                # Только user_id → pro
+                path, payload, plan = '/webhook/cryptopay', str(uid), 'pro'
+            expected[uid] = (str(1000 + uid), plan)
+            body = paid(1000 + uid, payload)
+            # Каждый счёт доставлен 5 раз одновременно
+            requests += [(path, body, sign('test', body))] * 5
+        forged = paid(5000, json.dumps({'user_id': 999, 'plan': 'premium'}))
+        requests.append(('/webhook/crypto', forged, sign('wrong', forged)))
+        # Битые payload: без пользователя, не строка, user_id/план не тех типов —
+        # помечаются failed и не задерживают остальные платежи
+        for invoice_id, payload in ((6000, 'no-user'), (6001, {'user_id': 1}),
+                                    (6002, json.dumps({'user_id': [1]})),
+                                    (6003, json.dumps({'user_id': 5, 'plan': ['x']}))):
+            broken = paid(invoice_id, payload)
+            requests.append(('/webhook/cryptopay', broken, sign('test', broken)))
+        
+        latencies = []
+        statuses = {}
+        
+        async with aiohttp.ClientSession() as session:
+            async def fire(path, body, signature):
+                started = time.perf_counter()
+                async with session.post(base + path, data=body, headers={'Crypto-Pay-Api-Signature': signature}) as r:
+                    statuses[r.status] = statuses.get(r.status, 0) + 1
+                latencies.append(time.perf_counter() - started)
+            
+            started = time.perf_counter()
+            await asyncio.gather(*(fire(*request) for request in requests))
+            elapsed = time.perf_counter() - started
+        
+        counts = await drain(db)
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(f"{len(requests)} запросов за {elapsed:.2f} с: ответы {statuses}, "
+              f"подтверждение p50 {p50:.1f} мс, p99 {p99:.1f} мс")
+        print(f"события: {counts}, inbox: {inbox.stats}")
+        print(f"уведомлений: {len(bot.sent)} (уникальных {len(set(bot.sent))})")
+        assert statuses == {200: 1004, 401: 1}
+        assert counts == {'done': 200, 'failed': 4}
+        assert inbox.stats['applied'] == 200 and sorted(bot.sent) == sorted(expected)
+        for uid, (invoice_id, plan) in expected.items():
+            sub = db.sync.get_subscription(uid)
+            assert (sub['invoice_id'], sub['plan']) == (invoice_id, plan), (uid, dict(sub))
+        assert db.sync.get_subscription(999) is None
+        # Лимит запросов конвейера допуска читается из той же таблицы subscriptions
+        database._db = db.sync
+        subscription.SUBSCRIPTIONS_FILE = str(tmp / 'subscriptions.json')
+        tiers = {plan: admission.plan_tier(uid) for uid, (_, plan) in expected.items()}
+        assert tiers == {'basic': 'pro', 'premium': 'unlimited', 'pro': 'pro'}, tiers
+        assert admission.plan_tier(999) == 'free'
+        plans = {}
+        for _, plan in expected.values():
+            plans[plan] = plans.get(plan, 0) + 1
+        print(f"подписки в БД: {plans}")
+        
+        # Тело события без объекта payload — тоже failed, следующий счёт обрабатывается
+        assert await inbox.add('6004', 'invoice_paid', 'null')
+        counts = await drain(db)
+        assert counts == {'done': 200, 'failed': 5}, counts
+        
+        # Остановка после выдачи, но до уведомления: после перезапуска — только уведомление
+        inbox.close()
+        body = paid(7000, 'sub_lifetime_500_0')
+        assert await inbox.add('7000', 'invoice_paid', body.decode())
+        start_date, end_date = payment_inbox.subscription_period('lifetime')
+        assert await db.apply_payment_event('7000', 500, 'lifetime', start_date, end_date)
+        restarted = payment_inbox.PaymentInbox(db, bot)
+        restarted.start()
+        counts = await drain(db)
+        print(f"после перезапуска: выдач {restarted.stats['applied']}, уведомлений пользователю 500: {bot.sent.count(500)}")
+        assert restarted.stats['applied'] == 0 and bot.sent.count(500) == 1 and counts['done'] == 201
+        assert db.sync.get_subscription(500)['end_date'] is None
+        assert admission.plan_tier(500) == 'unlimited'
+        
+        restarted.close()
+        await runner.cleanup()
+        db.close()
+        db.sync.close()
+        print("OK")
+    
+    logging.basicConfig(level=logging.CRITICAL)
+    asyncio.run(main())